@@ -0,0 +1,123 @@
+""" Разбор параметров запросов и сборка ответов действий, общие для controllers.Controller
+и async_controllers.AsyncController (контроллеры различаются только вызовами синхронных или асинхронных моделей)
+"""
+
+from typing import Optional
+from models import Item, parse_fields
+
+
+# Кэшируемые действия: название -> (ttl в секундах, параметры ключа, теги инвалидации), см. controllers.cached
+CACHED_ACTIONS = {
+    "get_bestsellers": (
+        300, ["category", "slug", "quantity", "except", "cursor", "fields", "window"], ["items", "categories"]
+    ),
+    "get_items": (60, ["category", "slug", "quantity", "except", "cursor", "fields", "attr"], ["items", "categories"]),
+    "get_facets": (60, ["category", "slug"], ["items", "categories", "attributes"]),
+    "get_category": (300, ["slug"], ["categories"]),
+    "get_attributes": (300, ["category"], ["attributes"]),
+    "get_item": (300, ["item_id", "fields"], ["item:{item_id}", "attributes"]),
+    "get_items_by_ids": (60, ["ids", "fields"], ["items", "attributes"]),
+}
+
+
+def optional_id(request, name: str) -> Optional[int]:
+    """ Возвращает необязательный идентификатор из параметра запроса (корзины, избранного)
+    :param request:
+    :param name:
+    :return:
+    """
+    return int(request.get(name)) if request.get(name, None) else None
+
+
+def bestsellers_page_args(request) -> tuple:
+    """ Аргументы Catalog.get_bestsellers_page из параметров запроса
+    :param request:
+    :return:
+    """
+    return (
+        request.get("category", False),
+        request.get("slug", False),
+        request.get("quantity", False),
+        request.get("except", []),
+        request.get("cursor", None),
+        parse_fields(request.get("fields", None)),
+        request.get("window", None)
+    )
+
+
+def items_page_args(request) -> tuple:
+    """ Аргументы Catalog.get_items_page из параметров запроса
+    :param request:
+    :return:
+    """
+    return (
+        request.get("category", False),
+        request.get("slug", False),
+        request.get("quantity", False),
+        request.get("except", []),
+        request.get("cursor", None),
+        parse_fields(request.get("fields", None)),
+        request.get("attr", None)
+    )
+
+
+def open_orders_filter_args(request) -> tuple:
+    """ Аргументы фильтра невыполненных заказов (Orders.iter_open_orders) из параметров запроса
+    :param request:
+    :return:
+    """
+    return request.get("state", None), request.get("created_from", None), request.get("created_to", None)
+
+
+def open_orders_page_args(request) -> tuple:
+    """ Аргументы Orders.get_open_orders_page из параметров запроса
+    :param request:
+    :return:
+    """
+    return open_orders_filter_args(request) + (request.get("quantity", None), request.get("cursor", None))
+
+
+def export_args(request) -> tuple:
+    """ Аргументы выгрузки товаров (без коллекции) из параметров запроса. Размер пачки передается как есть: его
+    проверяет генератор выгрузки, и ошибка попадает в поток последней строкой, а не в ответ 500
+    :param request:
+    :return:
+    """
+    return request.get("category", None), request.get("after_id", None), request.get("batch_size", 1000)
+
+
+def fill_item(item: Item, request) -> Item:
+    """ Заполняет товар данными из параметров запроса (кроме аттрибутов, их проверяет каталог)
+    :param item:
+    :param request:
+    :return:
+    """
+    item.title = request.get("title")
+    item.article = request.get("article")
+    item.short = request.get("short")
+    item.imgs = request.get("imgs", [])
+    item.body = request.get("body", "")
+    item.tags = request.get("tags", [])
+    item.categories = request.get("categories", [])
+    item.cost = int(request.get("cost", 0)) if str(request.get("cost")).isnumeric() else None
+    item.discount = int(request.get("discount")) if str(request.get("discount")).isnumeric() else None
+    item.quantity = int(request.get("quantity")) if str(request.get("quantity")).isnumeric() else None
+    return item
+
+
+def page_response(key: str, values: list, next_cursor: Optional[str]) -> dict:
+    """ Ответ со страницей списка и курсором следующей страницы
+    :param key: Название списка в ответе ("items", "orders")
+    :param values:
+    :param next_cursor:
+    :return:
+    """
+    return {key: values, "next_cursor": next_cursor}
+
+
+def orders_response(orders_list: list) -> dict:
+    """ Ответ со списком заказов
+    :param orders_list:
+    :return:
+    """
+    return {"orders": [order.get_data() for order in orders_list]}
@@ -0,0 +1,24 @@
+""" Пересчет рейтинга продаж для get_bestsellers
+
+Запуск: python3 aggregate-bestsellers.py [--interval 600]
+Без --interval выполняет один пересчет (для cron), с ним - пересчитывает рейтинг с указанным интервалом в секундах.
+"""
+
+import time
+import argparse
+from models import mongo_client
+from bestsellers import BestsellersAggregator
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--interval", type=float, default=None, help="интервал пересчета в секундах")
+options = parser.parse_args()
+
+aggregator = BestsellersAggregator(mongo_client.db)
+while True:
+    started = time.time()
+    counts = aggregator.run()
+    print("bestsellers updated in %.1f s: %s" % (time.time() - started, counts))
+    if options.interval is None:
+        break
+    time.sleep(options.interval)
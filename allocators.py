@@ -0,0 +1,136 @@
+""" Генераторы инкрементных идентификаторов для коллекций mongodb """
+
+import os
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from pymongo import DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class IdAllocator(ABC):
+    """ Базовый класс генератора идентификаторов """
+
+    @abstractmethod
+    def next_id(self, collection) -> int:
+        """ Возвращает следующий свободный идентификатор для коллекции
+        :param collection: Коллекция, для документа которой нужен идентификатор
+        :return:
+        """
+
+
+class BlockIdAllocator(IdAllocator):
+    """ Генератор, арендующий блоки идентификаторов у счетчика в коллекции counters
+
+    Счетчик каждой коллекции - отдельный документ {"_id": <имя коллекции>, "seq": <последний выданный id>},
+    который увеличивается атомарным $inc сразу на размер блока. Полученный блок раздается локально,
+    поэтому обращение к бд происходит один раз на block_size вставок, а воркеры не конкурируют за один и тот же id.
+
+    Идентификаторы уникальны, но возрастают только в пределах воркера: воркеры раздают свои блоки одновременно,
+    поэтому порядок по _id (новинки каталога) совпадает с порядком создания лишь с точностью до таких чередований.
+    """
+
+    def __init__(self, counters, block_size: int=100):
+        self.counters = counters
+        self.block_size = block_size
+        self.blocks = {}
+        self.seeded = set()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def next_id(self, collection) -> int:
+        """ Возвращает следующий идентификатор из арендованного блока, при необходимости арендуя новый
+        :param collection:
+        :return:
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                # Блоки, арендованные до fork, достались бы всем дочерним воркерам сразу
+                self.blocks = {}
+                self.pid = os.getpid()
+            next_id, last_id = self.blocks.get(collection.name, (1, 0))
+            if next_id > last_id:
+                next_id, last_id = self._lease(collection)
+            self.blocks[collection.name] = (next_id + 1, last_id)
+            return next_id
+
+    def _lease(self, collection) -> (int, int):
+        """ Арендует новый блок идентификаторов и возвращает его границы (включительно)
+        :param collection:
+        :return:
+        """
+        if collection.name not in self.seeded:
+            self._seed(collection)
+        counter = self.counters.find_one_and_update(
+            {"_id": collection.name}, {"$inc": {"seq": self.block_size}},
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+        return counter["seq"] - self.block_size + 1, counter["seq"]
+
+    def _seed(self, collection):
+        """ Поднимает счетчик до максимального существующего _id коллекции (для уже заполненных коллекций)
+        :param collection:
+        :return:
+        """
+        cursor = collection.find({}, {"_id": 1}).sort([("_id", DESCENDING)]).limit(1)
+        try:
+            max_id = next(cursor)["_id"]
+        except StopIteration:
+            max_id = 0
+        try:
+            self.counters.update_one({"_id": collection.name}, {"$max": {"seq": max_id}}, upsert=True)
+        except DuplicateKeyError:
+            # Счетчик одновременно создал другой воркер - повторный $max просто его обновит
+            self.counters.update_one({"_id": collection.name}, {"$max": {"seq": max_id}})
+        self.seeded.add(collection.name)
+
+
+class AsyncBlockIdAllocator(BlockIdAllocator):
+    """ Тот же генератор блоков для асинхронного драйвера (motor): счетчики общие с BlockIdAllocator,
+    поэтому синхронные и асинхронные воркеры могут вставлять в одни и те же коллекции
+    """
+
+    def __init__(self, counters, block_size: int=100):
+        super().__init__(counters, block_size)
+        self.lock = None
+
+    async def next_id(self, collection) -> int:
+        """ Возвращает следующий идентификатор из арендованного блока, при необходимости арендуя новый
+        :param collection:
+        :return:
+        """
+        if self.lock is None:
+            # asyncio.Lock создается внутри работающего цикла событий
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            next_id, last_id = self.blocks.get(collection.name, (1, 0))
+            if next_id > last_id:
+                next_id, last_id = await self._lease(collection)
+            self.blocks[collection.name] = (next_id + 1, last_id)
+            return next_id
+
+    async def _lease(self, collection) -> (int, int):
+        """ Арендует новый блок идентификаторов и возвращает его границы (включительно)
+        :param collection:
+        :return:
+        """
+        if collection.name not in self.seeded:
+            await self._seed(collection)
+        counter = await self.counters.find_one_and_update(
+            {"_id": collection.name}, {"$inc": {"seq": self.block_size}},
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+        return counter["seq"] - self.block_size + 1, counter["seq"]
+
+    async def _seed(self, collection):
+        """ Поднимает счетчик до максимального существующего _id коллекции (для уже заполненных коллекций)
+        :param collection:
+        :return:
+        """
+        max_ids = await collection.find({}, {"_id": 1}).sort([("_id", DESCENDING)]).limit(1).to_list(1)
+        max_id = max_ids[0]["_id"] if max_ids else 0
+        try:
+            await self.counters.update_one({"_id": collection.name}, {"$max": {"seq": max_id}}, upsert=True)
+        except DuplicateKeyError:
+            await self.counters.update_one({"_id": collection.name}, {"$max": {"seq": max_id}})
+        self.seeded.add(collection.name)
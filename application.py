@@ -4,8 +4,17 @@
 """
 
 from envi import Application
+from streaming import StreamingApplication
 from controllers import Controller
+from models import mongo_client
+from indexes import ensure_indexes
+
+ensure_indexes(mongo_client.db)
+# Клиент мастер-процесса не должен достаться воркерам после fork, они создадут свои при первом запросе
+mongo_client.close()
 
 application = Application()
 application.route("/<action>/", Controller)
-application.route("/v1/<action>/", Controller)
\ No newline at end of file
+application.route("/v1/<action>/", Controller)
+# Списки из STREAMING_ACTIONS с параметром stream=1 отдаются потоком в обход сериализации envi
+application = StreamingApplication(application, Controller)
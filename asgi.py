@@ -0,0 +1,161 @@
+""" Асинхронная (ASGI) точка входа сервиса, рядом с application.py
+
+Запуск: uvicorn asgi:application --host 0.0.0.0 --port 80
+Маршруты те же, что и у application.py: /<action>/ и /v1/<action>/
+"""
+
+import json
+import inspect
+from async_controllers import AsyncController
+from async_models import mongo_client, es_client
+from models import mongo_client as sync_mongo_client
+from indexes import ensure_indexes
+from serializers import dumpb
+from exceptions import IncorrectParameter, error_data
+from streaming import (
+    STREAMING_ACTIONS, JSONL_ACTIONS, JSONL_CONTENT_TYPE, ParamsRequest, parse_params, get_action_name
+)
+
+ensure_indexes(sync_mongo_client.db)
+sync_mongo_client.close()
+
+JSON_HEADERS = [(b"content-type", b"application/json; charset=utf-8")]
+
+
+def get_action(action_name: str):
+    """ Возвращает действие контроллера по названию или None, если такого маршрута нет: маршрутами служат только
+    асинхронные действия и выгрузки из JSONL_ACTIONS (потоковые методы из STREAMING_ACTIONS вызываются только
+    через параметр stream=1 своих действий, прочие аттрибуты класса - не действия)
+    :param action_name:
+    :return:
+    """
+    if not action_name or action_name in STREAMING_ACTIONS.values():
+        return None
+    action = getattr(AsyncController, action_name, None)
+    if action_name in JSONL_ACTIONS or inspect.iscoroutinefunction(action):
+        return action
+    return None
+
+
+async def read_params(scope: dict, receive) -> dict:
+    """ Собирает параметры запроса из строки запроса и тела (json или форма)
+    :param scope:
+    :param receive:
+    :return:
+    :raise IncorrectParameter: Если тело запроса не json-объект или не текст в utf-8
+    """
+    body, more_body = b"", True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    try:
+        params = parse_params(scope.get("query_string", b"").decode())
+        if body:
+            headers = dict(scope.get("headers", []))
+            if headers.get(b"content-type", b"").startswith(b"application/json"):
+                body_params = json.loads(body.decode())
+                if not isinstance(body_params, dict):
+                    raise IncorrectParameter("Тело запроса должно быть json-объектом")
+                params.update(body_params)
+            else:
+                params.update(parse_params(body.decode()))
+    except ValueError:
+        raise IncorrectParameter("Некорректное тело запроса")
+    return params
+
+
+def if_none_match(scope: dict) -> [str]:
+    """ Возвращает etag из заголовка If-None-Match (без кавычек и признака слабого etag, "*" - любой)
+    :param scope:
+    :return:
+    """
+    value = dict(scope.get("headers", [])).get(b"if-none-match", b"").decode("latin-1")
+    etags = [etag.strip() for etag in value.split(",") if etag.strip()]
+    return [(etag[2:] if etag.startswith("W/") else etag).strip('"') for etag in etags]
+
+
+def not_modified(scope: dict, etag: str) -> bool:
+    """ Проверяет, есть ли у клиента актуальная версия ответа (по заголовку If-None-Match)
+    :param scope:
+    :param etag: Версия ответа без кавычек
+    :return:
+    """
+    etags = if_none_match(scope)
+    return "*" in etags or etag in etags
+
+
+async def send_response(send, status: int, result, headers: list=None):
+    """ Отправляет json-ответ целиком
+    :param send:
+    :param status:
+    :param result: Результат действия (словарь или уже сериализованная строка, None - ответ без тела)
+    :param headers: Дополнительные заголовки
+    :return:
+    """
+    body = b"" if result is None else result.encode() if isinstance(result, str) else dumpb(result)
+    headers = (headers or []) if result is None else JSON_HEADERS + (headers or [])
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_stream(send, chunks, headers: list=None):
+    """ Отправляет ответ частями по мере их формирования
+    :param send:
+    :param chunks: Асинхронный итератор частей ответа
+    :param headers: Заголовки ответа (по умолчанию - json)
+    :return:
+    """
+    await send({"type": "http.response.start", "status": 200, "headers": headers or JSON_HEADERS})
+    async for chunk in chunks:
+        await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def application(scope: dict, receive, send):
+    """ ASGI-приложение
+    :param scope:
+    :param receive:
+    :param send:
+    :return:
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                mongo_client.close()
+                await es_client.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] == "websocket":
+        # Websocket-соединения сервис не принимает: закрытие до принятия отклоняет рукопожатие (ответ 403)
+        await receive()
+        await send({"type": "websocket.close"})
+        return
+    if scope["type"] != "http":
+        raise ValueError("Неподдерживаемый тип соединения: %s" % scope["type"])
+    action_name = get_action_name(scope["path"])
+    action = get_action(action_name)
+    if action is None:
+        status, result = 404, {"error": {"code": None, "message": "Not Found"}}
+    else:
+        try:
+            params = await read_params(scope, receive)
+        except IncorrectParameter as e:
+            return await send_response(send, 400, error_data(e))
+        if action_name in JSONL_ACTIONS:
+            stream = action(ParamsRequest(params))
+            return await send_stream(send, stream, [(b"content-type", JSONL_CONTENT_TYPE.encode())])
+        if action_name in STREAMING_ACTIONS and params.get("stream"):
+            stream = getattr(AsyncController, STREAMING_ACTIONS[action_name])(ParamsRequest(params))
+            return await send_stream(send, stream)
+        request = ParamsRequest(params)
+        status, result = 200, await action(request)
+        if request.etag:
+            headers = [(b"etag", ('"%s"' % request.etag).encode())]
+            if not_modified(scope, request.etag):
+                return await send_response(send, 304, None, headers)
+            return await send_response(send, status, result, headers)
+    await send_response(send, status, result)
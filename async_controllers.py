@@ -0,0 +1,538 @@
+""" Асинхронные контроллеры сервиса (ASGI) """
+
+import asyncio
+from models import Item, parse_fields
+from async_models import catalog, customers, carts, orders, response_cache
+from exceptions import error_response
+from streaming import ParamsRequest, async_stream_json_array, async_stream_jsonl
+from exporter import async_iter_export
+from actions import (
+    CACHED_ACTIONS, optional_id, bestsellers_page_args, items_page_args, open_orders_filter_args,
+    open_orders_page_args, export_args, fill_item, page_response, orders_response
+)
+from search import AUTOCOMPLETE_SIZE
+from clients import pool_metrics, primary_reads
+
+
+def async_error_format(func):
+    """ Декоратор для обработки любых исключений возникающих при работе сервиса (формат как у error_format)
+    :param func:
+    """
+    async def wrapper(*args, **kwargs):
+        """ wrapper
+        :param args:
+        :param kwargs:
+        """
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            return error_response(e)
+    return wrapper
+
+
+def async_cached(ttl: float, params: list, tags: list):
+    """ Декоратор кэширования ответа действия (как cached): ключ строится из параметров params,
+    ответ становится недействительным через ttl секунд или при инвалидации любого из тегов
+    (в тегах можно подставлять значения параметров: "item:{item_id}"), запросы с read_primary не кэшируются
+    :param ttl:
+    :param params:
+    :param tags:
+    """
+    def decorator(func):
+        """ decorator
+        :param func:
+        """
+        async def wrapper(cls, request: ParamsRequest, *args, **kwargs):
+            """ wrapper
+            :param cls:
+            :param request:
+            :param args:
+            :param kwargs:
+            """
+            if request.get("read_primary", False):
+                return await func(cls, request, *args, **kwargs)
+            key = await response_cache.request_key(func.__name__, request, params, tags)
+            response = await response_cache.get(key)
+            if response is None:
+                response = await func(cls, request, *args, **kwargs)
+                await response_cache.set(key, response, ttl)
+            return response
+        return wrapper
+    return decorator
+
+
+def async_read_routing(func):
+    """ Декоратор для чтений каталога: с параметром read_primary запрос читает с primary (как read_routing)
+    :param func:
+    """
+    async def wrapper(cls, request: ParamsRequest, *args, **kwargs):
+        """ wrapper
+        :param cls:
+        :param request:
+        :param args:
+        :param kwargs:
+        """
+        if request.get("read_primary", False):
+            with primary_reads():
+                return await func(cls, request, *args, **kwargs)
+        return await func(cls, request, *args, **kwargs)
+    return wrapper
+
+
+def async_read_primary(func):
+    """ Декоратор для действий, изменяющих каталог: их чтения идут на primary (как read_primary)
+    :param func:
+    """
+    async def wrapper(*args, **kwargs):
+        """ wrapper
+        :param args:
+        :param kwargs:
+        """
+        with primary_reads():
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+class AsyncController(object):
+    """ Асинхронный контроллер с теми же действиями, что и controllers.Controller """
+
+    @classmethod
+    @async_error_format
+    @async_read_routing
+    @async_cached(*CACHED_ACTIONS["get_bestsellers"])
+    async def get_bestsellers(cls, request: ParamsRequest, *args, **kwargs):
+        """ Возвращает лучшие товары из каталога с их кратким представлением
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        items, next_cursor = await catalog.get_bestsellers_page(*bestsellers_page_args(request))
+        return page_response("items", items, next_cursor)
+
+    @classmethod
+    @async_error_format
+    @async_read_routing
+    @async_cached(*CACHED_ACTIONS["get_items"])
+    async def get_items(cls, request: ParamsRequest, *args, **kwargs):
+        """ Возвращает товары с их кратким представлением (attr[<id>]=значение, attr[<id>][from|to]=число -
+        фильтр по аттрибутам)
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        items, next_cursor = await catalog.get_items_page(*items_page_args(request))
+        return page_response("items", items, next_cursor)
+
+    @classmethod
+    @async_error_format
+    @async_read_routing
+    @async_cached(*CACHED_ACTIONS["get_facets"])
+    async def get_facets(cls, request: ParamsRequest, *args, **kwargs):
+        """ Возвращает значения аттрибутов товаров рубрики с количеством товаров (для панели фильтров)
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return {"facets": await catalog.get_facets(request.get("category", None), request.get("slug", None))}
+
+    @classmethod
+    @async_error_format
+    @async_read_routing
+    async def get_categories(cls, request: ParamsRequest, *args, **kwargs):
+        """ Возвращает список категорий товаров (заранее сериализованный, с etag для условных запросов: параметр
+        if_none_match или, через ASGI, заголовок If-None-Match с ответом 304)
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        categories_tree = await catalog.get_categories_tree()
+        request.etag = categories_tree.etag
+        if request.get("if_none_match", None) == categories_tree.etag:
+            return categories_tree.not_modified_json
+        return categories_tree.json
+
+    @classmethod
+    @async_error_format
+    @async_read_routing
+    @async_cached(*CACHED_ACTIONS["get_category"])
+    async def get_category(cls, request: ParamsRequest, *args, **kwargs):
+        """ Возвращает категорию товаров по ее идентификатору
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return {"category": (await catalog.get_category(request.get("slug"))).get_data()}
+
+    @classmethod
+    @async_error_format
+    @async_read_routing
+    @async_cached(*CACHED_ACTIONS["get_attributes"])
+    async def get_attributes(cls, request: ParamsRequest, *args, **kwargs):
+        """ Возвращает список аттрибутов товаров
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return {
+            "attributes": [a.get_data() for a in await catalog.get_attributes(request.get("category", None))]
+        }
+
+    @classmethod
+    @async_error_format
+    @async_read_routing
+    @async_cached(*CACHED_ACTIONS["get_item"])
+    async def get_item(cls, request: ParamsRequest, *args, **kwargs):
+        """ Возвращает полные данные о товаре
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        fields = parse_fields(request.get("fields", None))
+        return {"item": (await catalog.get_item(int(request.get("item_id")), fields)).get_data(fields)}
+
+    @classmethod
+    @async_error_format
+    @async_read_routing
+    @async_cached(*CACHED_ACTIONS["get_items_by_ids"])
+    async def get_items_by_ids(cls, request: ParamsRequest, *args, **kwargs):
+        """ Возвращает полные данные о нескольких товарах в порядке запрошенных идентификаторов
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return {
+            "items": await catalog.get_items_by_ids(request.get("ids", []), parse_fields(request.get("fields", None)))
+        }
+
+    @classmethod
+    @async_error_format
+    @async_read_primary
+    async def save(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для сохранения товара
+        :param request:
+        :param kwargs:
+        :return:
+        """
+        if request.get("id", False):
+            item = await catalog.get_item(int(request.get("id")))
+        else:
+            item = Item()
+        fill_item(item, request)
+        await catalog.set_attributes(item, request.get("attributes", []))
+        return {"item_id": await catalog.save_item(item)}
+
+    @classmethod
+    @async_error_format
+    async def delete(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для удаления поста
+        :param request:
+        :param kwargs:
+        :return:
+        """
+        if request.get("id", False):
+            return {"result": await catalog.delete_item(request.get("id"))}
+        return {"result": False}
+
+    @classmethod
+    @async_error_format
+    @async_read_primary
+    async def create_category(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для создания новых рубрик
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        await catalog.create_category(request.get("category_name"), request.get("slug"))
+        return (await catalog.get_categories_tree()).json
+
+    @classmethod
+    @async_error_format
+    async def ensure_customer_existance(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для создания нового пользователя если его еще нет
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        await customers.ensure_existance(int(request.get("customer_id")))
+        return {"result": True}
+
+    @classmethod
+    @async_error_format
+    async def get_customer(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для получения объекта покупателя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        customer = await customers.get_customer(int(request.get("customer_id")))
+        return customer.get_data() if customer else None
+
+    @classmethod
+    @async_error_format
+    async def update_customer(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для изменения объекта покупателя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        customer = await customers.get_customer(int(request.get("customer_id")))
+        await customers.update_customer(customer, request.get("name"), request.get("address"))
+        return customer.get_data() if customer else None
+
+    @classmethod
+    @async_error_format
+    async def get_cart(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для получения объекта корзины покупателя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        cart = await carts.get_cart(optional_id(request, "cart_id"))
+        return {"cart": cart.get_data()}
+
+    @classmethod
+    @async_error_format
+    async def add_to_cart(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для добавления товара в корзину покупателя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        cart = await carts.get_cart(optional_id(request, "cart_id"))
+        await cart.add_item(int(request.get("item_id")), int(request.get("quantity")))
+        return {"cart": cart.get_data()}
+
+    @classmethod
+    @async_error_format
+    async def remove_from_cart(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для удаление товара из корзины покупателя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        cart = await carts.get_cart(optional_id(request, "cart_id"))
+        await cart.remove_item(int(request.get("item_id")))
+        return {"cart": cart.get_data()}
+
+    @classmethod
+    @async_error_format
+    async def set_quantity_for_item(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для установки количества товара в корзине покупателя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        cart = await carts.get_cart(optional_id(request, "cart_id"))
+        await cart.set_quantity_for_item(int(request.get("item_id")), int(request.get("quantity")))
+        return {"cart": cart.get_data()}
+
+    @classmethod
+    @async_error_format
+    async def clear_cart(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для очистки корзины покупателя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        cart = await carts.get_cart(optional_id(request, "cart_id"))
+        await cart.clear()
+        return {"cart": cart.get_data()}
+
+    @classmethod
+    @async_error_format
+    async def search_autocomplete(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод подсказок при поиске товара в каталоге
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return await catalog.autocomplete(request.get("term"), request.get("size", AUTOCOMPLETE_SIZE))
+
+    @classmethod
+    @async_error_format
+    async def get_wishlist(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для получения списка избранных товаров покупателя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        wishlist = await carts.get_cart(optional_id(request, "wishlist_id"))
+        return {"wishlist": wishlist.get_data() if wishlist else None}
+
+    @classmethod
+    @async_error_format
+    async def add_to_wishlist(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для добавления товара в избранное покупателя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        wishlist = await carts.get_cart(optional_id(request, "wishlist_id"))
+        await wishlist.add_item(int(request.get("item_id")), int(request.get("quantity")))
+        return {"wishlist": wishlist.get_data()}
+
+    @classmethod
+    @async_error_format
+    async def remove_from_wishlist(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для удаление товара из избранного покупателя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        wishlist = await carts.get_cart(optional_id(request, "wishlist_id"))
+        await wishlist.remove_item(int(request.get("item_id")))
+        return {"wishlist": wishlist.get_data()}
+
+    @classmethod
+    @async_error_format
+    async def set_quantity_for_wishlist_item(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для установки количества товара в избранном покупателя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        wishlist = await carts.get_cart(optional_id(request, "wishlist_id"))
+        await wishlist.set_quantity_for_item(int(request.get("item_id")), int(request.get("quantity")))
+        return {"wishlist": wishlist.get_data()}
+
+    @classmethod
+    @async_error_format
+    async def clear_wishlist(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для очистки избранного покупателя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        wishlist = await carts.get_cart(optional_id(request, "wishlist_id"))
+        await wishlist.clear()
+        return {"wishlist": wishlist.get_data()}
+
+    @classmethod
+    @async_error_format
+    async def fill_cart_from_wishlist(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для копирования товаров из избранного в корзину пользователя
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        wishlist, cart = await asyncio.gather(
+            carts.get_cart(optional_id(request, "wishlist_id")),
+            carts.get_cart(optional_id(request, "cart_id"))
+        )
+        await wishlist.copy_to(cart)
+        return {"cart": cart.get_data()}
+
+    @classmethod
+    @async_error_format
+    async def create_order(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для создания нового заказа
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        order_id = await orders.create_order(int(request.get("customer_id")))
+        return {"order_id": order_id}
+
+    @classmethod
+    @async_error_format
+    async def confirm_order(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для подтверждения заказа (окончательное списание зарезервированного товара)
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return {"order": (await orders.confirm_order(int(request.get("order_id")))).get_data()}
+
+    @classmethod
+    @async_error_format
+    async def get_order(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для получения данных по заказу
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return {"order": (await orders.get_order(int(request.get("order_id")))).get_data()}
+
+    @classmethod
+    @async_error_format
+    async def get_orders_by_customer_id(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для получения заказов по переданному пользователю
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return orders_response(
+            await orders.get_orders_by_customer_id(int(request.get("customer_id")), limit=request.get("limit", 20))
+        )
+
+    @classmethod
+    @async_error_format
+    async def get_open_orders(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для получения невыполненных заказов (краткие описания, постранично)
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        summaries, next_cursor = await orders.get_open_orders_page(*open_orders_page_args(request))
+        return page_response("orders", summaries, next_cursor)
+
+    @classmethod
+    def stream_open_orders(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для потоковой отдачи невыполненных заказов (get_open_orders с параметром stream=1, без страниц)
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return async_stream_json_array("orders", orders.iter_open_orders(*open_orders_filter_args(request)))
+
+    @classmethod
+    def export_items(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для потоковой выгрузки товаров в JSON Lines (по товару на строку, по возрастанию id)
+        Прерванную выгрузку можно продолжить, передав id последнего полученного товара в after_id
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return async_stream_jsonl(async_iter_export(catalog.reader(catalog.items), *export_args(request)))
+
+    @classmethod
+    @async_error_format
+    async def get_pool_metrics(cls, request: ParamsRequest, *args, **kwargs):
+        """ Метод для получения метрик пула соединений с mongodb текущего воркера
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return {"mongo": pool_metrics.stats()}
@@ -0,0 +1,654 @@
+""" Асинхронные версии моделей для ASGI-приложения (motor и асинхронный клиент elasticsearch)
+
+Объекты предметной области (Item, Cart, Order ...), их сборка и валидация, а также формы запросов к бд
+берутся из models, здесь только ввод-вывод. Независимые обращения к бд выполняются одновременно.
+"""
+
+import asyncio
+from datetime import datetime
+from typing import Optional
+from motor.motor_asyncio import AsyncIOMotorClient
+from elasticsearch import AsyncElasticsearch
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError
+from exceptions import *
+from allocators import AsyncBlockIdAllocator
+from inventory import AsyncInventory
+from clients import pool_metrics, mongo_client_options, es_client_options, routed, transactions_enabled
+from bestsellers import BESTSELLERS_WINDOWS, BESTSELLERS_DEFAULT_WINDOW, BESTSELLERS_SORT, bestsellers_query
+from search import ITEMS_ALIAS, AUTOCOMPLETE_SIZE, autocomplete_query, queue_event
+from facets import FACET_FIELDS_PROJECTION, FACETS_SORT, AsyncFacetCounts, facet_changes, facets_query, group_facets
+from models import (
+    MAX_EXCEPT_IDS, MAX_ITEMS_BY_IDS, COMMON_ATTRIBUTES_QUERY, CART_CLEAR_UPDATE, OrderStates, OrderStatesNames,
+    ORDER_SUMMARY_FIELDS, ORDERS_SORT, orders_query, order_summary, parse_order_states, parse_datetime, datetime_to_ms,
+    Catalog, Customers, Orders, Item, Customer, Cart, Order, ItemInCart, AttributeScheme,
+    Category, CategoriesTree, item_projection, items_query, bestsellers_projection, encode_cursor, decode_cursor,
+    cart_push_update, cart_pull_update, cart_set_quantity_update, catalog as sync_catalog
+)
+from cache import AsyncResponseCache, create_async_cache_backend
+
+
+mongo_client = AsyncIOMotorClient(connect=False, event_listeners=[pool_metrics], **mongo_client_options())
+es_client = AsyncElasticsearch(**es_client_options())
+id_allocator = AsyncBlockIdAllocator(mongo_client.db.counters, block_size=100)
+inventory = AsyncInventory(mongo_client.db.items, mongo_client.db.reservations)
+# Кэш ответов с тем же хранилищем, что и у синхронных контроллеров (см. cache.create_cache_backend)
+response_cache = AsyncResponseCache(create_async_cache_backend(mongo_client.db.response_cache))
+
+
+async def _insert_inc(doc: dict, collection) -> int:
+    """ Вставляет новый документ в коллекцию, получая инкрементный ключ у генератора идентификаторов
+    :param doc: Документ для вставки в коллекцию (без указания _id)
+    :param collection: Коллекция для вставки
+    :return:
+    """
+    doc["_id"] = doc["id"] = await id_allocator.next_id(collection)
+    await collection.insert_one(doc)
+    return doc["_id"]
+
+
+################################################ Catalog #########################################################
+
+
+class AsyncCatalog(object):
+    """ Асинхронная модель для работы с каталогом товаров """
+    def __init__(self):
+        self.client = mongo_client
+        self.items = self.client.db.items
+        self.categories = self.client.db.categories
+        self.attributes = self.client.db.attributes
+        self.bestsellers = self.client.db.bestsellers
+        self.search_queue = self.client.db.search_queue
+        self.facets = AsyncFacetCounts(self.client.db.facets)
+        # Кэши общие с синхронной моделью, чтобы их сброс был виден обеим
+        self.attribute_schemes = sync_catalog.attribute_schemes
+        self.categories_cache = sync_catalog.categories_cache
+        self.read_preference = sync_catalog.read_preference
+
+    def reader(self, collection):
+        """ Возвращает коллекцию для чтения каталога: с реплик, если запрос не требует чтения с primary
+        :param collection:
+        :return:
+        """
+        return routed(collection, self.read_preference)
+
+    async def get_item(self, item_id: int, fields: list=None) -> Item:
+        """ Возвращает товар из коллекции по его идентификатору
+        :param item_id:
+        :param fields: Поля товара, которые нужно загрузить (по умолчанию - все)
+        :return:
+        """
+        item_data = await self.reader(self.items).find_one({"_id": int(item_id)}, item_projection(fields))
+        if not item_data:
+            raise ItemNotFound()
+        if fields and "attributes" not in fields:
+            return Catalog.build_item(item_data, {})
+        attribute_schemes = await self.get_attribute_schemes(
+            [attribute.get("id") for attribute in item_data.get("attributes") or []]
+        )
+        return Catalog.build_item(item_data, attribute_schemes)
+
+    async def get_items_map(self, item_ids: list, fields: list=None) -> dict:
+        """ Возвращает словарь {id: товар} для списка идентификаторов одним запросом к коллекции товаров
+        :param item_ids:
+        :param fields: Поля товара, которые нужно загрузить (по умолчанию - все)
+        :return:
+        """
+        item_ids = list({int(item_id) for item_id in item_ids})
+        if not item_ids:
+            return {}
+        items_data = await self.reader(self.items).find(
+            {"_id": {"$in": item_ids}}, item_projection(fields)
+        ).to_list(None)
+        attribute_schemes = await self.get_attribute_schemes([
+            attribute.get("id") for item_data in items_data for attribute in item_data.get("attributes") or []
+        ])
+        return {item_data.get("_id"): Catalog.build_item(item_data, attribute_schemes) for item_data in items_data}
+
+    async def get_items_by_ids(self, item_ids: list, fields: list=None) -> [dict]:
+        """ Возвращает данные товаров в порядке запрошенных идентификаторов,
+        вместо отсутствующих товаров - маркер с ошибкой ItemNotFound
+        :param item_ids:
+        :param fields: Поля товара, которые нужно вернуть (по умолчанию - все)
+        :return:
+        """
+        if len(item_ids) > MAX_ITEMS_BY_IDS:
+            raise TooManyItemIds()
+        item_ids = [int(item_id) for item_id in item_ids]
+        items = await self.get_items_map(item_ids, fields)
+        return [
+            items[item_id].get_data(fields) if item_id in items else
+            {"id": item_id, "error": {"code": ItemNotFound.code, "message": ItemNotFound.msg}}
+            for item_id in item_ids
+        ]
+
+    async def save_item(self, item: Item) -> int:
+        """ Сохраняет товар в коллекции и возвращает его _id
+        :param item:
+        :return:
+        """
+        item.validate()
+        data = item.get_data()
+        if item.id:
+            old_data = await self.items.find_one_and_update({"_id": item.id}, {"$set": data}, FACET_FIELDS_PROJECTION)
+            if old_data:
+                await self.facets.apply(facet_changes(old_data, data))
+        else:
+            item.id = await _insert_inc(data, self.items)
+            await self.facets.apply(facet_changes(None, data))
+        await self.search_queue.insert_one(queue_event(item.id, "index"))
+        await response_cache.invalidate(["items", "item:%s" % item.id])
+        return item.id
+
+    async def delete_item(self, post_id: int) -> bool:
+        """ Удаляет товар из коллекции
+        :param post_id:
+        :return:
+        """
+        old_data = await self.items.find_one_and_delete({"_id": int(post_id)}, FACET_FIELDS_PROJECTION)
+        if old_data:
+            await self.facets.apply(facet_changes(old_data, None))
+            await self.search_queue.insert_one(queue_event(post_id, "delete"))
+            await response_cache.invalidate(["items", "item:%s" % post_id])
+        return old_data is not None
+
+    async def get_items_page(
+            self, category: str=None, slug: str=None, quantity: int=None, except_ids: list=None, cursor: str=None,
+            fields: list=None, attributes=None
+    ) -> (list, Optional[str]):
+        """ Возвращает страницу товаров из указанных категорий и курсор для получения следующей страницы
+        :param category:
+        :param slug:
+        :param quantity:
+        :param except_ids:
+        :param cursor:
+        :param fields:
+        :param attributes: Фильтр по аттрибутам (см. facets.py)
+        :return:
+        """
+        category = await self.resolve_category(category, slug)
+        quantity = int(quantity or 10)
+        params = items_query(category, except_ids, cursor, attributes)
+        projection = item_projection(fields) or {"body": False}
+        items = await self.reader(self.items).find(params, projection).sort([("_id", DESCENDING)]).limit(quantity + 1) \
+            .to_list(quantity + 1)
+        next_cursor = encode_cursor({"id": items[quantity - 1]["_id"]}) if len(items) > quantity else None
+        return await self.select_fields(items[:quantity], fields), next_cursor
+
+    async def select_fields(self, items_data: list, fields: list=None) -> [dict]:
+        """ Оставляет в данных товаров страницы только запрошенные поля (см. models.Catalog.select_fields)
+        :param items_data:
+        :param fields:
+        :return:
+        """
+        if not fields:
+            return items_data
+        attribute_schemes = await self.get_attribute_schemes([
+            attribute.get("id") for item_data in items_data for attribute in item_data.get("attributes") or []
+        ]) if "attributes" in fields else {}
+        return [Catalog.build_item(item_data, attribute_schemes).get_data(fields) for item_data in items_data]
+
+    async def get_bestsellers_page(
+            self, category: str=None, slug: str=None, quantity: int=None, except_ids: list=None, cursor: str=None,
+            fields: list=None, window: str=None
+    ) -> (list, Optional[str]):
+        """ Возвращает страницу лучших товаров из предрассчитанного рейтинга продаж и курсор для следующей страницы,
+        пока рейтинг пуст - возвращает новинки каталога
+        :param category:
+        :param slug:
+        :param quantity:
+        :param except_ids:
+        :param cursor:
+        :param fields:
+        :param window:
+        :return:
+        """
+        position = decode_cursor(cursor) if cursor else None
+        if position and "quantity" not in position:
+            return await self.get_items_page(category, slug, quantity, except_ids, cursor, fields)
+        category = await self.resolve_category(category, slug)
+        quantity = int(quantity or 10)
+        if except_ids and len(except_ids) > MAX_EXCEPT_IDS:
+            raise TooManyExceptIds()
+        window = window if window in BESTSELLERS_WINDOWS else BESTSELLERS_DEFAULT_WINDOW
+        bestsellers = await self.reader(self.bestsellers).find(
+            bestsellers_query(window, category, position, except_ids), bestsellers_projection(fields)
+        ).sort(BESTSELLERS_SORT).limit(quantity + 1).to_list(quantity + 1)
+        if not bestsellers and not position:
+            return await self.get_items_page(category, None, quantity, except_ids, None, fields)
+        next_cursor = None
+        if len(bestsellers) > quantity:
+            last = bestsellers[quantity - 1]
+            next_cursor = encode_cursor({"id": last["item_id"], "quantity": last["quantity"]})
+        return [bestseller.get("item", {}) for bestseller in bestsellers[:quantity]], next_cursor
+
+    async def get_facets(self, category: str=None, slug: str=None) -> [dict]:
+        """ Возвращает значения аттрибутов товаров рубрики с количеством товаров для каждого значения
+        :param category: Рубрика (по умолчанию - весь каталог)
+        :param slug:
+        :return:
+        """
+        facets_data = await self.reader(self.facets.facets).find(
+            facets_query(await self.resolve_category(category, slug)), {"_id": False}
+        ).sort(FACETS_SORT).to_list(None)
+        attribute_schemes = await self.get_attribute_schemes([facet_data["attribute_id"] for facet_data in facets_data])
+        return group_facets(facets_data, attribute_schemes)
+
+    async def resolve_category(self, category: str=None, slug: str=None) -> Optional[str]:
+        """ Возвращает название категории, при необходимости находя его по slug
+        :param category:
+        :param slug:
+        :return:
+        """
+        if not category and slug:
+            category = await self.reader(self.categories).find_one({"slug": slug})
+            category = category.get("name") if category else None
+        return category
+
+    async def get_categories_tree(self) -> CategoriesTree:
+        """ Возвращает дерево рубрик из процессного кэша, при его отсутствии загружает и сериализует дерево
+        :return:
+        """
+        categories_tree = self.categories_cache.get("tree")
+        if categories_tree is None:
+            categories = await self.reader(self.categories).find({}).to_list(None)
+            categories_tree = CategoriesTree([Category(c).get_data() for c in categories])
+            self.categories_cache.set("tree", categories_tree)
+        return categories_tree
+
+    async def get_category(self, category_slug: str) -> Category:
+        """ Возвращает рубрику из коллекции по ее идентификатору
+        :param category_slug:
+        :return:
+        """
+        category_data = await self.reader(self.categories).find_one({"slug": category_slug})
+        if not category_data:
+            raise CategoryNotFound()
+        return Category(category_data)
+
+    async def create_category(self, category_name: str, slug: str) -> bool:
+        """ Создает новую рубрику
+        :param category_name:
+        :param slug:
+        :return:
+        """
+        if not category_name:
+            raise NoNameForNewCategory()
+        try:
+            await self.categories.insert_one({"_id": slug, "slug": slug, "name": category_name})
+        except DuplicateKeyError:
+            raise CategoryAlreadyExists()
+        self.categories_cache.clear()
+        await response_cache.invalidate(["categories"])
+        return True
+
+    async def get_attributes(self, categories: list=None) -> [AttributeScheme]:
+        """ Возвращает список аттрибутов, доступных товарам из указанных категорий
+        :param categories:
+        :return:
+        """
+        key = ("categories", repr(categories) if categories else None)
+        attribute_schemes = self.attribute_schemes.get(key)
+        if attribute_schemes is None:
+            attributes = self.reader(self.attributes)
+            common, specific = await asyncio.gather(
+                attributes.find(COMMON_ATTRIBUTES_QUERY).to_list(None),
+                attributes.find({"categories": categories}).to_list(None) if categories else _nothing([])
+            )
+            attribute_schemes = [AttributeScheme(a) for a in common + specific]
+            self.attribute_schemes.set(key, attribute_schemes)
+            for attribute_scheme in attribute_schemes:
+                self.attribute_schemes.set(attribute_scheme.id, attribute_scheme)
+        return attribute_schemes
+
+    async def get_attribute_schemes(self, attribute_scheme_ids: list) -> dict:
+        """ Возвращает словарь {id: схема аттрибута} для списка идентификаторов,
+        недостающие в кэше схемы загружаются одним запросом
+        :param attribute_scheme_ids:
+        :return:
+        """
+        result, missing = {}, []
+        for attribute_scheme_id in set(attribute_scheme_ids):
+            attribute_scheme = self.attribute_schemes.get(attribute_scheme_id)
+            if attribute_scheme is None:
+                missing.append(attribute_scheme_id)
+            else:
+                result[attribute_scheme_id] = attribute_scheme
+        if missing:
+            for a in await self.reader(self.attributes).find({"_id": {"$in": missing}}).to_list(None):
+                attribute_scheme = AttributeScheme(a)
+                self.attribute_schemes.set(attribute_scheme.id, attribute_scheme)
+                result[attribute_scheme.id] = attribute_scheme
+        return result
+
+    async def set_attributes(self, item: Item, income_attributes: list):
+        """ Сохраняет аттрибуты товара согласно схеме его категорий (асинхронный вариант Item.set_attributes)
+        :param item:
+        :param income_attributes:
+        :return:
+        """
+        attribute_schemes = await self.get_attributes(item.categories)
+        item.set_attributes(income_attributes, {a.id: a for a in attribute_schemes})
+
+    async def autocomplete(self, term: str, size: int=AUTOCOMPLETE_SIZE):
+        """ Подсказки для поиска товаров по каталогу
+        :param term:
+        :param size:
+        :return:
+        """
+        if not term or not term.strip():
+            return []
+        result = await es_client.search(index=ITEMS_ALIAS, body=autocomplete_query(term.strip(), size))
+        return [
+            {"id": int(m.get("_id")), "title": m.get("_source").get("title")}
+            for m in result.get("hits").get("hits")
+        ]
+
+
+async def _nothing(value):
+    """ Готовый результат для asyncio.gather вместо необязательного запроса """
+    return value
+
+
+catalog = AsyncCatalog()
+
+
+################################################ Customers #########################################################
+
+
+class AsyncCustomers(object):
+    """ Асинхронная модель для работы с покупателем """
+    def __init__(self):
+        self.client = mongo_client
+        self.customers = self.client.db.customers
+
+    async def ensure_existance(self, customer_id: int):
+        """ Создает нового покупателя, если его еще нет (корзина и избранное создаются одновременно)
+        :param customer_id:
+        :return:
+        """
+        try:
+            await self.get_customer(customer_id)
+        except CustomerNotFound:
+            cart, wishlist = await asyncio.gather(carts.get_cart(), carts.get_cart())
+            customer = Customer()
+            customer.cart_id = cart.id
+            customer.wishlist_id = wishlist.id
+            customer.id = await self.save_customer(customer)
+
+    async def get_customer(self, customer_id: int) -> Customer:
+        """ Возвращает покупателя из коллекции по его идентификатору
+        :param customer_id:
+        :return:
+        """
+        customer_data = await self.customers.find_one({"_id": int(customer_id)})
+        if not customer_data:
+            raise CustomerNotFound()
+        return Customers.build_customer(customer_data)
+
+    async def update_customer(self, customer: Customer, name: str, address: str) -> bool:
+        """ Обновляет данные покупателя (асинхронный вариант Customer.update)
+        :param customer:
+        :param name:
+        :param address:
+        :return:
+        """
+        customer.name = name
+        customer.address = address
+        await self.save_customer(customer)
+        return True
+
+    async def save_customer(self, customer: Customer) -> int:
+        """ Сохраняет покупателя в коллекции и возвращает его _id
+        :param customer:
+        :return:
+        """
+        if customer.id:
+            await self.customers.update_one({"_id": customer.id}, {"$set": customer.get_data()})
+            return customer.id
+        else:
+            return await _insert_inc(customer.get_data(), self.customers)
+
+
+customers = AsyncCustomers()
+
+
+################################################## Carts ############################################################
+
+
+class AsyncCarts(object):
+    """ Асинхронная модель для работы с корзиной покупателя """
+    def __init__(self):
+        self.client = mongo_client
+        self.carts = self.client.db.carts
+
+    async def get_cart(self, cart_id: Optional[int]=None) -> 'AsyncCart':
+        """ Возвращает корзину покупателя из коллекции по ее идентификатору
+        :param cart_id:
+        :return:
+        """
+        cart_data = await self.carts.find_one({"_id": int(cart_id)}) if cart_id else None
+        cart = AsyncCart()
+        if not cart_data:
+            cart.id = await _insert_inc(cart.get_data(), self.carts)
+            return cart
+        items_data = cart_data.get("items") or []
+        items = await catalog.get_items_map([iicdata.get("id") for iicdata in items_data])
+        cart.id = cart_data.get("_id")
+        cart.items = [ItemInCart(iicdata, items.get(int(iicdata.get("id")))) for iicdata in items_data]
+        return cart
+
+
+carts = AsyncCarts()
+
+
+class AsyncCart(Cart):
+    """ Корзина покупателя с асинхронными изменениями (те же атомарные обновления, что и у Cart) """
+    def __init__(self):
+        super().__init__()
+        self.carts = carts
+
+    async def add_item(self, item_id: int, quantity: int):
+        """ Добавляет новый товар в корзину
+        :param item_id:
+        :param quantity:
+        :return:
+        """
+        item_in_cart = ItemInCart({"id": item_id, "quantity": quantity}, await catalog.get_item(item_id))
+        self.items.append(item_in_cart)
+        await self.carts.carts.update_one({"_id": self.id}, cart_push_update(item_in_cart))
+
+    async def remove_item(self, item_id: int):
+        """ Удаляет товар из корзины
+        :param item_id:
+        :return:
+        """
+        self.items = [i for i in self.items if i.item.id != item_id]
+        await self.carts.carts.update_one({"_id": self.id}, cart_pull_update(item_id))
+
+    async def set_quantity_for_item(self, item_id: int, quantity: int):
+        """ Меняет количество товара в корзине
+        :param item_id:
+        :param quantity:
+        :return:
+        """
+        item = next((i.item for i in self.items if i.item.id == item_id), None) or await catalog.get_item(item_id)
+        item_in_cart = ItemInCart({"id": item_id, "quantity": quantity}, item)
+        result = await self.carts.carts.update_one(
+            {"_id": self.id, "items.id": item_id}, cart_set_quantity_update(item_in_cart)
+        )
+        if result.matched_count == 1:
+            self.items = [item_in_cart if i.item.id == item_id else i for i in self.items]
+        else:
+            self.items.append(item_in_cart)
+            await self.carts.carts.update_one({"_id": self.id}, cart_push_update(item_in_cart))
+
+    async def clear(self):
+        """ Очищает корзину
+        :return:
+        """
+        self.items = []
+        await self.carts.carts.update_one({"_id": self.id}, CART_CLEAR_UPDATE)
+
+    async def copy_to(self, other_cart: 'AsyncCart') -> bool:
+        """ Копирует одну корзину в другую
+        :param other_cart:
+        :return:
+        """
+        for item_in_cart in self.items:
+            copy = ItemInCart({"id": item_in_cart.item.id, "quantity": item_in_cart.quantity}, item_in_cart.item)
+            other_cart.items.append(copy)
+            await other_cart.carts.carts.update_one({"_id": other_cart.id}, cart_push_update(copy))
+        return True
+
+
+################################################## Orders ############################################################
+
+
+class AsyncOrders(object):
+    """ Асинхронная модель для работы с заказами """
+    def __init__(self):
+        self.client = mongo_client
+        self.orders = self.client.db.orders
+        self.transactions = transactions_enabled()
+
+    async def create_order(self, customer_id: int) -> int:
+        """ Создает новый заказ: покупатель загружается одновременно с выделением идентификатора заказа,
+        товары корзины - одним запросом, заказ записывается одной вставкой, остатки позиций резервируются,
+        корзина очищается. С MONGO_TRANSACTIONS=1 все записи выполняются в одной транзакции
+        :param customer_id:
+        :return:
+        :raise CartIsEmpty:
+        :raise NotEnoughStock: Если какой-либо позиции не хватает на складе (заказ не создается)
+        """
+        customer, order_id = await asyncio.gather(
+            customers.get_customer(customer_id), id_allocator.next_id(self.orders)
+        )
+        cart = await carts.get_cart(customer.cart_id)
+        order = Orders.build_new_order(order_id, customer_id, cart)
+        if self.transactions:
+            async with await self.client.start_session() as session:
+                await session.with_transaction(lambda s: self.insert_order(order, cart.id, s))
+        else:
+            await self.insert_order(order, cart.id)
+        return order.id
+
+    async def insert_order(self, order: Order, cart_id: int, session=None):
+        """ Резервирует товары нового заказа, сохраняет заказ и очищает корзину. Корзина очищается намеренно:
+        заказ уже содержит ее позиции, и повторное оформление той же корзины зарезервировало бы товар еще раз.
+        Если товара не хватает или заказ не записан, корзина остается как была
+        :param order:
+        :param cart_id:
+        :param session: Сессия mongodb с начатой транзакцией (без нее резерв при ошибке снимается вручную)
+        :return:
+        """
+        lines = [iic.get_data() for iic in order.items]
+        if session is not None:
+            await inventory.reserve_in_transaction(order.id, lines, session, order.created_datetime)
+            await self.orders.insert_one(order.get_data(), session=session)
+        else:
+            await inventory.reserve(order.id, lines, order.created_datetime)
+            try:
+                await self.orders.insert_one(order.get_data())
+            except Exception:
+                await inventory.release(order.id)
+                raise
+        await carts.carts.update_one({"_id": cart_id}, CART_CLEAR_UPDATE, session=session)
+
+    async def confirm_order(self, order_id: int) -> Order:
+        """ Подтверждает заказ: товар, зарезервированный под заказ, списывается окончательно
+        :param order_id:
+        :return:
+        :raise ReservationExpired: Если резерв заказа снят по истечении срока
+        """
+        order = await self.get_order(order_id)
+        if order.state == OrderStates.Expired:
+            raise ReservationExpired()
+        if order.state != OrderStates.Created:
+            return order
+        if not await inventory.commit(order.id):
+            raise ReservationExpired()
+        order.state = OrderStates.InProgress
+        await self.orders.update_one(
+            {"_id": order.id, "state": OrderStates.Created},
+            {"$set": {"state": order.state, "state_name": order.state_name}}
+        )
+        return order
+
+    async def expire_orders(self, now: datetime=None) -> [int]:
+        """ Снимает истекшие резервы и переводит их неподтвержденные заказы в статус "Истек"
+        :param now:
+        :return: Идентификаторы заказов, резервы которых сняты
+        """
+        order_ids = await inventory.release_expired(now)
+        if order_ids:
+            # Время истечения нужно пересчету рейтинга продаж: дни истекших заказов пересчитываются заново
+            await self.orders.update_many(
+                {"_id": {"$in": order_ids}, "state": OrderStates.Created},
+                {"$set": {
+                    "state": OrderStates.Expired, "state_name": OrderStatesNames[OrderStates.Expired],
+                    "expired_datetime": now or datetime.now()
+                }}
+            )
+        return order_ids
+
+    async def get_order(self, order_id: int) -> Order:
+        """ Возвращает заказ покупателя из коллекции по его идентификатору
+        :param order_id:
+        :return:
+        """
+        order_data = await self.orders.find_one({"_id": int(order_id)})
+        if not order_data:
+            raise OrderNotFound()
+        return Orders.build_order(order_data)
+
+    async def get_orders_by_customer_id(self, customer_id: int, limit=20) -> [Order]:
+        """ Возвращает список заказов пользователя одним запросом по индексу customer_id_created_datetime
+        :param customer_id:
+        :param limit:
+        :return:
+        """
+        orders_data = await self.orders.find({"customer_id": int(customer_id)}) \
+            .sort([("created_datetime", DESCENDING)]).limit(int(limit)).to_list(None)
+        return [Orders.build_order(order_data) for order_data in orders_data]
+
+    async def get_open_orders_page(
+            self, states=None, created_from=None, created_to=None, quantity: int=None, cursor: str=None
+    ) -> (list, Optional[str]):
+        """ Возвращает страницу кратких описаний заказов (по умолчанию - невыполненных) в порядке создания
+        и курсор для следующей страницы
+        :param states:
+        :param created_from:
+        :param created_to:
+        :param quantity:
+        :param cursor:
+        :return:
+        """
+        quantity = int(quantity or 50)
+        query = orders_query(
+            parse_order_states(states), parse_datetime(created_from), parse_datetime(created_to), cursor
+        )
+        projection = {field: True for field in ORDER_SUMMARY_FIELDS}
+        orders_data = await self.orders.find(query, projection).sort(ORDERS_SORT).limit(quantity + 1) \
+            .to_list(quantity + 1)
+        next_cursor = None
+        if len(orders_data) > quantity:
+            last = orders_data[quantity - 1]
+            next_cursor = encode_cursor({"id": last["_id"], "created": datetime_to_ms(last["created_datetime"])})
+        return [order_summary(order_data) for order_data in orders_data[:quantity]], next_cursor
+
+    async def iter_open_orders(self, states=None, created_from=None, created_to=None, batch_size: int=500):
+        """ Отдает краткие описания заказов по мере чтения курсора
+        :param states:
+        :param created_from:
+        :param created_to:
+        :param batch_size:
+        :return:
+        """
+        query = orders_query(parse_order_states(states), parse_datetime(created_from), parse_datetime(created_to))
+        projection = {field: True for field in ORDER_SUMMARY_FIELDS}
+        async for order_data in self.orders.find(query, projection).sort(ORDERS_SORT).batch_size(batch_size):
+            yield order_summary(order_data)
+
+
+orders = AsyncOrders()
@@ -0,0 +1,76 @@
+""" Разовая миграция: дописывает снимки товаров (ItemInOrder.from_item) в позиции старых заказов
+
+Запуск: python3 backfill-order-items.py [--batch-size 500] [--dry-run]
+Заказы читаются без обращения к каталогу, поэтому каждая позиция должна хранить артикул, название, цену
+и аттрибуты товара. Уже сохраненные в позиции значения не меняются (цена выводится из сохраненной стоимости),
+недостающие берутся из текущего товара; товары загружаются одним запросом на пачку заказов.
+Повторный запуск обрабатывает только оставшиеся заказы.
+"""
+
+import time
+import argparse
+from pymongo import ASCENDING, UpdateOne
+from models import mongo_client, catalog, ItemInOrder
+
+
+# Позиции без снимка товара (нулевая стоимость бесплатного товара - допустима)
+INCOMPLETE_ITEMS_QUERY = {"items": {"$elemMatch": {"$or": [
+    {"title": {"$in": [None, ""]}}, {"cost": None}, {"price": None}, {"attributes": {"$exists": False}}
+]}}}
+
+
+def complete_items(items_data: list, items: dict) -> list:
+    """ Возвращает позиции заказа со снимками товаров (для удаленных из каталога товаров дописываются
+    только поля, которые можно вывести из самой позиции)
+    :param items_data:
+    :param items: Товары {id: Item}
+    :return:
+    """
+    result = []
+    for iicdata in items_data:
+        item = items.get(iicdata.get("id"))
+        snapshot = ItemInOrder.from_item(item, iicdata.get("quantity") or 0).get_data() if item else {}
+        snapshot.update({key: value for key, value in iicdata.items() if value is not None and value != ""})
+        if iicdata.get("price") is None and iicdata.get("cost") is not None and iicdata.get("quantity"):
+            snapshot["price"] = iicdata["cost"] // iicdata["quantity"]
+        result.append(ItemInOrder(snapshot).get_data())
+    return result
+
+
+def backfill(orders, batch_size: int, dry_run: bool=False, report=print) -> int:
+    """ Дописывает позиции заказов пачками и возвращает количество обновленных заказов
+    :param orders:
+    :param batch_size:
+    :param dry_run: Только посчитать заказы, не изменяя их
+    :param report:
+    :return:
+    """
+    updated, last_id, started = 0, None, time.time()
+    while True:
+        query = dict(INCOMPLETE_ITEMS_QUERY, **({"_id": {"$gt": last_id}} if last_id is not None else {}))
+        batch = list(orders.find(query, {"items": True}).sort([("_id", ASCENDING)]).limit(batch_size))
+        if not batch:
+            break
+        last_id = batch[-1]["_id"]
+        items = catalog.get_items_map([
+            iicdata.get("id") for order_data in batch for iicdata in order_data.get("items") or []
+        ], fields=["id", "article", "title", "cost", "discount", "attributes"])
+        requests = [
+            UpdateOne({"_id": order_data["_id"]}, {"$set": {"items": complete_items(order_data["items"], items)}})
+            for order_data in batch
+        ]
+        if not dry_run:
+            orders.bulk_write(requests, ordered=False)
+        updated += len(requests)
+        report("%s orders, %.1f orders/s" % (updated, updated / max(time.time() - started, 0.001)))
+    return updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать заказы для миграции")
+    options = parser.parse_args()
+
+    total = backfill(mongo_client.db.orders, options.batch_size, options.dry_run)
+    print("done: %s orders %s" % (total, "to update" if options.dry_run else "updated"))
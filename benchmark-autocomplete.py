@@ -0,0 +1,80 @@
+""" Сравнение задержки подсказок: прежний wildcard-запрос против edge n-gram индекса
+
+Запуск: python3 benchmark-autocomplete.py [--sizes 1000,10000,100000] [--queries 200]
+Для каждого размера каталога создается временный индекс со сгенерированными названиями товаров.
+"""
+
+import time
+import random
+import argparse
+from elasticsearch.helpers import bulk
+from models import es_client
+from search import ITEMS_INDEX_BODY, autocomplete_query
+
+
+WORDS = [
+    "кроссовки", "ботинки", "куртка", "пальто", "рубашка", "футболка", "джинсы", "брюки", "платье", "юбка",
+    "шапка", "шарф", "перчатки", "сумка", "рюкзак", "ремень", "кеды", "сапоги", "свитер", "толстовка",
+    "мужские", "женские", "детские", "зимние", "летние", "кожаные", "спортивные", "классические", "теплые",
+    "черный", "белый", "синий", "красный", "серый", "зеленый", "бежевый", "nike", "adidas", "puma", "reebok"
+]
+
+
+def wildcard_query(term: str) -> dict:
+    """ Прежний запрос Catalog.autocomplete """
+    return {
+        "size": 2000,
+        "query": {
+            "bool": {
+                "should": [
+                    {"wildcard": {"title": {"value": "*%s*" % single_term}}}
+                    for single_term in term.strip().split(" ") if len(single_term.strip())
+                ]
+            }
+        }
+    }
+
+
+def fill_index(index: str, size: int):
+    """ Создает индекс и заполняет его случайными названиями """
+    es_client.indices.create(index=index, body=ITEMS_INDEX_BODY)
+    bulk(es_client, (
+        {"_index": index, "_id": n, "_source": {"title": " ".join(random.sample(WORDS, 4))}} for n in range(size)
+    ), chunk_size=2000)
+    es_client.indices.refresh(index=index)
+
+
+def measure(index: str, terms: list, build_query) -> (float, float, float):
+    """ Возвращает среднюю и 95-перцентильную задержку (мс) и среднее число возвращенных документов """
+    latencies, returned = [], 0
+    for term in terms:
+        started = time.time()
+        result = es_client.search(index=index, body=build_query(term))
+        latencies.append((time.time() - started) * 1000)
+        returned += len(result["hits"]["hits"])
+    latencies.sort()
+    return sum(latencies) / len(latencies), latencies[int(len(latencies) * 0.95) - 1], returned / len(terms)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--queries", type=int, default=200)
+    options = parser.parse_args()
+
+    search_terms = [
+        " ".join(word[:random.randint(2, len(word))] for word in random.sample(WORDS, random.randint(1, 2)))
+        for _ in range(options.queries)
+    ]
+    print("%10s %-12s %10s %10s %10s" % ("items", "query", "mean, ms", "p95, ms", "hits"))
+    for catalog_size in [int(s) for s in options.sizes.split(",")]:
+        benchmark_index = "benchmark_autocomplete_%s" % catalog_size
+        es_client.indices.delete(index=benchmark_index, ignore=[404])
+        fill_index(benchmark_index, catalog_size)
+        try:
+            for query_name, query_builder in (("wildcard", wildcard_query), ("edge n-gram", autocomplete_query)):
+                print("%10s %-12s %10.2f %10.2f %10.1f" % (
+                    (catalog_size, query_name) + measure(benchmark_index, search_terms, query_builder)
+                ))
+        finally:
+            es_client.indices.delete(index=benchmark_index)
@@ -0,0 +1,142 @@
+""" Количество обращений к бд при оформлении заказа: прежнее копирование корзины по позициям против create_order
+
+Запуск: python3 benchmark-create-order.py [--host mongo] [--lines 1,5,15] [--checkouts 50] [--transactions]
+Использует базу benchmark_orders на сервере mongo и удаляет ее после замеров.
+Без транзакции количество записей заказа и корзины постоянно, а остатки списываются условным обновлением
+на каждый товар (только так частичный резерв можно точно вернуть), в транзакции списание - один bulk-запрос
+и количество записей не зависит от количества позиций.
+Для --transactions сервер должен быть replica set (например, mongod --replSet rs0 с одним узлом).
+"""
+
+import time
+import argparse
+from datetime import datetime
+from collections import Counter
+from pymongo import MongoClient
+from allocators import BlockIdAllocator
+import models
+from models import catalog, customers, carts, orders, inventory, Order, ItemInOrder
+
+
+# Операции, изменяющие данные
+WRITE_METHODS = {
+    "insert_one", "insert_many", "update_one", "update_many", "replace_one", "delete_one", "delete_many",
+    "bulk_write", "find_one_and_update"
+}
+
+
+class CountingCollection(object):
+    """ Обертка над коллекцией, считающая чтения и записи """
+    def __init__(self, collection, stats: dict):
+        self.collection = collection
+        self.stats = stats
+
+    def with_options(self, **kwargs):
+        return CountingCollection(self.collection.with_options(**kwargs), self.stats)
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            if name in WRITE_METHODS:
+                self.stats["writes"] += 1
+                self.stats["%s writes" % self.collection.name] += 1
+            else:
+                self.stats["reads"] += 1
+            return attr(*args, **kwargs)
+        return wrapper
+
+
+def legacy_create_order(customer_id: int) -> int:
+    """ Прежняя реализация Orders.create_order: cart.copy_to(order) добавлял позиции по одной,
+    каждая загружала товар и сохраняла заказ заново
+    """
+    customer = customers.get_customer(customer_id)
+    cart = carts.get_cart(customer.cart_id)
+    order = Order()
+    for iic in cart.items:
+        order.items.append(ItemInOrder.from_item(catalog.get_item(iic.item.id), iic.quantity))
+        orders.save_order(order)
+    order.cost = cart.total_cost
+    order.quantity = cart.quantity
+    order.customer_id = customer_id
+    order.created_datetime = datetime.now()
+    order.state = models.OrderStates.Created
+    return orders.save_order(order)
+
+
+def use_database(client: MongoClient, stats: dict):
+    """ Переключает модели на базу benchmark_orders с подсчетом обращений """
+    db = client.benchmark_orders
+
+    def collection(name):
+        return CountingCollection(db[name], stats)
+
+    models.id_allocator = BlockIdAllocator(db.counters)
+    for name in ("items", "categories", "attributes", "bestsellers"):
+        setattr(catalog, name, collection(name))
+    customers.customers = collection("customers")
+    carts.carts = collection("carts")
+    orders.orders = collection("orders")
+    orders.client = client
+    inventory.items, inventory.reservations = collection("items"), collection("reservations")
+
+
+def prepare_customers(count: int, lines: int) -> [int]:
+    """ Создает покупателей с корзинами из lines позиций """
+    customer_ids = []
+    for _ in range(count):
+        cart = carts.get_cart()
+        for item_id in range(1, lines + 1):
+            cart.add_item(item_id, 1)
+        customer = models.Customer()
+        customer.cart_id = cart.id
+        customer_ids.append(customers.save_customer(customer))
+    return customer_ids
+
+
+def measure(title: str, create_order, customer_ids: list, lines: int, stats: dict):
+    """ Оформляет заказы и печатает среднее количество обращений к бд на заказ """
+    stats.clear()
+    started = time.time()
+    for customer_id in customer_ids:
+        create_order(customer_id)
+    elapsed = time.time() - started
+    count = len(customer_ids)
+    print("%-28s %3d lines %7.2f reads %7.2f writes (orders %5.2f, items %5.2f) %7.2f ms per order" % (
+        title, lines, stats["reads"] / count, stats["writes"] / count, stats["orders writes"] / count,
+        stats["items writes"] / count, elapsed * 1000 / count
+    ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="mongo")
+    parser.add_argument("--lines", default="1,5,15", help="количества позиций в корзине через запятую")
+    parser.add_argument("--checkouts", type=int, default=50, help="заказов на каждое количество позиций")
+    parser.add_argument(
+        "--transactions", action="store_true", help="дополнительно замерить create_order в транзакции"
+    )
+    options = parser.parse_args()
+
+    client = MongoClient(options.host, 27017)
+    client.drop_database("benchmark_orders")
+    stats = Counter()
+    use_database(client, stats)
+    lines_counts = [int(lines) for lines in options.lines.split(",")]
+    client.benchmark_orders.items.insert_many([
+        {"_id": i, "id": i, "title": "Товар %s" % i, "cost": 100, "quantity": 10 ** 9, "imgs": [], "attributes": []}
+        for i in range(1, max(lines_counts) + 1)
+    ])
+    runs = [("copy_to per line", legacy_create_order), ("create_order", orders.create_order)]
+    if options.transactions:
+        runs.append(("create_order (transaction)", orders.create_order))
+    try:
+        for lines in lines_counts:
+            for title, create_order in runs:
+                orders.transactions = title.endswith("(transaction)")
+                measure(title, create_order, prepare_customers(options.checkouts, lines), lines, stats)
+    finally:
+        client.drop_database("benchmark_orders")
@@ -0,0 +1,101 @@
+""" Сравнение старого цикла с DuplicateKeyError и BlockIdAllocator при конкурентных вставках
+
+Запуск: python3 benchmark-id-allocator.py [--workers 8] [--inserts 500] [--block-size 100]
+Использует базу benchmark_ids на сервере mongo и удаляет ее после замеров.
+"""
+
+import argparse
+import time
+from multiprocessing import Pool
+from pymongo import MongoClient, DESCENDING
+from pymongo.errors import DuplicateKeyError
+from allocators import BlockIdAllocator
+
+
+def legacy_insert_inc(doc: dict, collection) -> (int, int):
+    """ Прежняя реализация _insert_inc, дополнительно возвращает количество обращений к бд """
+    round_trips = 0
+    while True:
+        cursor = collection.find({}, {"_id": 1}).sort([("_id", DESCENDING)]).limit(1)
+        round_trips += 1
+        try:
+            doc["_id"] = next(cursor)["_id"] + 1
+        except StopIteration:
+            doc["_id"] = 1
+        try:
+            doc["id"] = doc["_id"]
+            round_trips += 1
+            collection.insert_one(doc)
+            break
+        except DuplicateKeyError:
+            pass
+    return doc["_id"], round_trips
+
+
+def run_legacy(args) -> int:
+    """ Воркер, вставляющий документы старым способом """
+    host, inserts = args
+    collection = MongoClient(host, 27017).benchmark_ids.legacy
+    return sum(legacy_insert_inc({"n": n}, collection)[1] for n in range(inserts))
+
+
+def run_allocator(args) -> int:
+    """ Воркер, вставляющий документы через BlockIdAllocator """
+    host, inserts, block_size = args
+    db = MongoClient(host, 27017).benchmark_ids
+    counters, collection = CountingCollection(db.counters), db.allocator
+    allocator = BlockIdAllocator(counters, block_size=block_size)
+    for n in range(inserts):
+        doc_id = allocator.next_id(collection)
+        collection.insert_one({"_id": doc_id, "id": doc_id, "n": n})
+    return inserts + counters.calls
+
+
+class CountingCollection(object):
+    """ Обертка над коллекцией, считающая обращения к бд """
+    def __init__(self, collection):
+        self.collection = collection
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            self.calls += 1
+            return attr(*args, **kwargs)
+        return wrapper
+
+
+def measure(title: str, worker, tasks: list, total: int):
+    """ Запускает воркеры параллельно и печатает результаты """
+    started = time.time()
+    with Pool(len(tasks)) as pool:
+        round_trips = sum(pool.map(worker, tasks))
+    elapsed = time.time() - started
+    print("%-16s %8d docs %8.2f s %10.1f docs/s %8.2f round trips/doc" % (
+        title, total, elapsed, total / elapsed, round_trips / total
+    ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="mongo")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--inserts", type=int, default=500, help="вставок на воркер")
+    parser.add_argument("--block-size", type=int, default=100)
+    options = parser.parse_args()
+
+    client = MongoClient(options.host, 27017)
+    client.drop_database("benchmark_ids")
+    total_docs = options.workers * options.inserts
+    try:
+        measure("_insert_inc loop", run_legacy, [(options.host, options.inserts)] * options.workers, total_docs)
+        measure(
+            "BlockIdAllocator", run_allocator,
+            [(options.host, options.inserts, options.block_size)] * options.workers, total_docs
+        )
+        assert client.benchmark_ids.allocator.count_documents({}) == total_docs
+    finally:
+        client.drop_database("benchmark_ids")
@@ -0,0 +1,176 @@
+""" Рейтинг продаж товаров, предрассчитанный по заказам """
+
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, DESCENDING
+from order_states import OrderStates
+
+
+# Окна рейтинга: название -> количество дней (None - за все время)
+BESTSELLERS_WINDOWS = {"week": 7, "month": 30, "all": None}
+BESTSELLERS_DEFAULT_WINDOW = "month"
+BESTSELLERS_SORT = [("quantity", DESCENDING), ("item_id", DESCENDING)]
+
+# Поля товара, сохраняемые в рейтинге, чтобы отдавать его одним запросом
+ITEM_SUMMARY_FIELDS = ["id", "article", "title", "short", "img", "imgs", "tags", "categories", "cost", "discount",
+                       "cost_with_discount", "quantity"]
+
+
+def rerun_since(last_run: datetime=None, first_expired: datetime=None):
+    """ Возвращает начало первого пересчитываемого дня: дня предыдущего запуска или более раннего дня создания
+    заказа, истекшего после него (None - пересчитать все заказы)
+    :param last_run:
+    :param first_expired: Время создания самого раннего заказа, истекшего после предыдущего запуска
+    :return:
+    """
+    if not last_run:
+        return None
+    since = min(last_run, first_expired) if first_expired else last_run
+    return since.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def expired_orders_query(last_run: datetime) -> dict:
+    """ Возвращает фильтр заказов, истекших после предыдущего запуска (их дни уже посчитаны вместе с ними)
+    :param last_run:
+    :return:
+    """
+    return {"state": OrderStates.Expired, "expired_datetime": {"$gte": last_run}}
+
+
+def daily_cleanup_query(since: datetime=None) -> dict:
+    """ Возвращает фильтр дневных продаж, которые пересчитываются заново
+    :param since: Начало первого пересчитываемого дня (None - все дни)
+    :return:
+    """
+    return {"day": {"$gte": since.strftime("%Y-%m-%d")}} if since else {}
+
+
+def daily_sales_pipeline(since: datetime=None) -> [dict]:
+    """ Возвращает агрегацию заказов в дневные продажи товаров {item_id, day, quantity} (с записью в bestsellers_daily),
+    истекшие неподтвержденные заказы продажами не считаются
+    :param since: Начало первого пересчитываемого дня (None - все заказы)
+    :return:
+    """
+    match = {"state": {"$ne": OrderStates.Expired}}
+    if since:
+        match["created_datetime"] = {"$gte": since}
+    return [
+        {"$match": match},
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": {
+                "item_id": "$items.id",
+                "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_datetime"}}
+            },
+            "quantity": {"$sum": "$items.quantity"}
+        }},
+        {"$project": {"_id": False, "item_id": "$_id.item_id", "day": "$_id.day", "quantity": True}},
+        {"$merge": {"into": "bestsellers_daily"}}
+    ]
+
+
+def window_pipeline(window: str, days: int, now: datetime) -> [dict]:
+    """ Возвращает агрегацию дневных продаж в рейтинг окна с кратким описанием товаров (с записью в bestsellers),
+    каждая позиция помечается поколением now
+    :param window:
+    :param days: Количество дней окна, включая текущий (None - за все время)
+    :param now:
+    :return:
+    """
+    return [
+        {"$match": {"day": {"$gte": (now - timedelta(days=days - 1)).strftime("%Y-%m-%d")}} if days else {}},
+        {"$group": {"_id": "$item_id", "quantity": {"$sum": "$quantity"}}},
+        {"$lookup": {"from": "items", "localField": "_id", "foreignField": "_id", "as": "item"}},
+        {"$unwind": "$item"},
+        {"$project": {
+            "_id": {"$concat": [window, ":", {"$toString": "$_id"}]},
+            "window": window, "item_id": "$_id", "quantity": True, "generated": now,
+            "categories": "$item.categories",
+            "item": {field: "$item.%s" % field for field in ITEM_SUMMARY_FIELDS}
+        }},
+        {"$merge": {"into": "bestsellers", "on": "_id", "whenMatched": "replace"}}
+    ]
+
+
+def stale_generation_query(window: str, generated: datetime) -> dict:
+    """ Возвращает фильтр позиций рейтинга окна, не попавших в поколение generated (выпали из окна)
+    :param window:
+    :param generated:
+    :return:
+    """
+    return {"window": window, "generated": {"$ne": generated}}
+
+
+class BestsellersAggregator(object):
+    """ Фоновый пересчет рейтинга продаж
+
+    Продажи копятся в коллекции bestsellers_daily по дням: {item_id, day, quantity}. При каждом запуске заново
+    считаются только дни, начиная с дня предыдущего запуска: заказы прошлых дней меняются, только когда истекает
+    неподтвержденный заказ, и тогда пересчет начинается с дня создания самого раннего из истекших после
+    предыдущего запуска. Поэтому пересчет инкрементальный и идемпотентный. Затем для каждого окна продажи за его
+    дни суммируются и вместе с кратким описанием товара записываются в коллекцию bestsellers, откуда get_bestsellers
+    читает их одним запросом.
+    """
+
+    def __init__(self, db, windows: dict=None):
+        self.db = db
+        self.windows = windows or BESTSELLERS_WINDOWS
+
+    def run(self, now: datetime=None) -> dict:
+        """ Обновляет рейтинг и возвращает количество товаров в каждом окне
+        :param now:
+        :return:
+        """
+        now = now or datetime.now()
+        state = self.db.bestsellers_state.find_one({"_id": "bestsellers"}) or {}
+        self.update_daily(state.get("last_run"))
+        result = {window: self.materialize(window, days, now) for window, days in self.windows.items()}
+        self.db.bestsellers_state.replace_one({"_id": "bestsellers"}, {"_id": "bestsellers", "last_run": now}, upsert=True)
+        return result
+
+    def update_daily(self, last_run: datetime=None):
+        """ Пересчитывает дневные продажи, начиная с дня предыдущего запуска (или дня истекшего после него заказа)
+        :param last_run:
+        :return:
+        """
+        first_expired = None
+        if last_run:
+            expired = self.db.orders.find_one(
+                expired_orders_query(last_run), {"created_datetime": True}, sort=[("created_datetime", ASCENDING)]
+            )
+            first_expired = expired["created_datetime"] if expired else None
+        since = rerun_since(last_run, first_expired)
+        self.db.bestsellers_daily.delete_many(daily_cleanup_query(since))
+        self.db.orders.aggregate(daily_sales_pipeline(since))
+
+    def materialize(self, window: str, days: int, now: datetime) -> int:
+        """ Записывает рейтинг окна в коллекцию bestsellers и удаляет из нее выпавшие из окна товары
+        :param window:
+        :param days:
+        :param now:
+        :return:
+        """
+        self.db.bestsellers_daily.aggregate(window_pipeline(window, days, now))
+        self.db.bestsellers.delete_many(stale_generation_query(window, now))
+        return self.db.bestsellers.count_documents({"window": window})
+
+
+def bestsellers_query(window: str, category: str=None, after: dict=None, except_ids: list=None) -> dict:
+    """ Возвращает фильтр выборки рейтинга для окна и категории
+    :param window:
+    :param category:
+    :param after: Последняя показанная позиция {"id", "quantity"} для продолжения выборки
+    :param except_ids:
+    :return:
+    """
+    query = {"window": window}
+    if category:
+        query["categories"] = category
+    if after:
+        query["$or"] = [
+            {"quantity": {"$lt": after["quantity"]}},
+            {"quantity": after["quantity"], "item_id": {"$lt": after["id"]}}
+        ]
+    if except_ids:
+        query["item_id"] = {"$nin": except_ids}
+    return query
+
@@ -0,0 +1,413 @@
+""" Процессные кэши и кэш ответов контроллеров """
+
+import os
+import json
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from pymongo import UpdateOne
+
+
+class LRUCache(object):
+    """ Кэш с ограниченным размером (вытеснение давно не использованных записей) и временем жизни записей """
+
+    def __init__(self, maxsize: int=1024, ttl: float=300, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.data = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """ Возвращает значение из кэша или default, если записи нет или она устарела
+        :param key:
+        :param default:
+        :return:
+        """
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires <= self.timer():
+                del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float=None):
+        """ Сохраняет значение в кэше, вытесняя самые старые записи при переполнении
+        :param key:
+        :param value:
+        :param ttl: Время жизни записи, если оно отличается от времени жизни кэша
+        :return:
+        """
+        with self.lock:
+            self.data[key] = (self.timer() + (self.ttl if ttl is None else ttl), value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        """ Удаляет запись из кэша
+        :param key:
+        :return:
+        """
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        """ Очищает кэш
+        :return:
+        """
+        with self.lock:
+            self.data.clear()
+
+    def stats(self) -> dict:
+        """ Возвращает счетчики кэша для метрик
+        :return:
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.data), "maxsize": self.maxsize}
+
+
+class CacheBackend(object):
+    """ Хранилище кэша ответов: записи с временем жизни и версии тегов инвалидации
+
+    Инвалидация тега увеличивает его версию, а версии тегов входят в ключ записи, поэтому устаревшие записи
+    просто перестают запрашиваться и вытесняются сами. Так инвалидация не требует поиска зависимых записей
+    и одинаково работает для процессного и разделяемого между воркерами хранилища.
+    """
+
+    def get(self, key: str):
+        """ Возвращает значение записи или None
+        :param key:
+        :return:
+        """
+        raise NotImplementedError()
+
+    def set(self, key: str, value, ttl: float):
+        """ Сохраняет запись на ttl секунд
+        :param key:
+        :param value:
+        :param ttl:
+        :return:
+        """
+        raise NotImplementedError()
+
+    def get_tag_versions(self, tags: list) -> dict:
+        """ Возвращает текущие версии тегов {тег: версия}
+        :param tags:
+        :return:
+        """
+        raise NotImplementedError()
+
+    def bump_tags(self, tags: list):
+        """ Увеличивает версии тегов, делая недействительными все зависящие от них записи
+        :param tags:
+        :return:
+        """
+        raise NotImplementedError()
+
+
+class LocalCacheBackend(CacheBackend):
+    """ Процессное хранилище кэша ответов (LRU). Версии тегов тоже процессные, поэтому инвалидация не видна
+    другим воркерам - только для запуска в одном процессе (тесты, разработка)
+    """
+
+    def __init__(self, maxsize: int=4096, timer=time.monotonic):
+        self.entries = LRUCache(maxsize=maxsize, timer=timer)
+        self.tags = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        return self.entries.get(key)
+
+    def set(self, key: str, value, ttl: float):
+        self.entries.set(key, value, ttl)
+
+    def get_tag_versions(self, tags: list) -> dict:
+        return {tag: self.tags.get(tag, 0) for tag in tags}
+
+    def bump_tags(self, tags: list):
+        with self.lock:
+            for tag in tags:
+                self.tags[tag] = self.tags.get(tag, 0) + 1
+
+
+# Количество тегов в одном bulk-запросе инвалидации
+BUMP_CHUNK_SIZE = 1000
+
+
+def tag_versions_query(tags: list) -> dict:
+    """ Возвращает фильтр документов версий тегов в коллекции mongodb
+    :param tags:
+    :return:
+    """
+    return {"_id": {"$in": ["tag:%s" % tag for tag in tags]}}
+
+
+def tag_versions(entries: list, tags: list) -> dict:
+    """ Возвращает версии тегов из документов версий (у отсутствующих тегов - 0)
+    :param entries:
+    :param tags:
+    :return:
+    """
+    versions = {entry["_id"][len("tag:"):]: entry.get("version", 0) for entry in entries}
+    return {tag: versions.get(tag, 0) for tag in tags}
+
+
+def bump_requests(tags: list) -> [[UpdateOne]]:
+    """ Возвращает пачки запросов увеличения версий тегов
+    :param tags:
+    :return:
+    """
+    return [
+        [
+            UpdateOne({"_id": "tag:%s" % tag}, {"$inc": {"version": 1}}, upsert=True)
+            for tag in tags[start:start + BUMP_CHUNK_SIZE]
+        ]
+        for start in range(0, len(tags), BUMP_CHUNK_SIZE)
+    ]
+
+
+def mongo_tag_versions(collection, tags: list) -> dict:
+    """ Возвращает версии тегов из коллекции mongodb
+    :param collection:
+    :param tags:
+    :return:
+    """
+    return tag_versions(collection.find(tag_versions_query(tags)), tags)
+
+
+def mongo_bump_tags(collection, tags: list):
+    """ Увеличивает версии тегов в коллекции mongodb
+    :param collection:
+    :param tags:
+    :return:
+    """
+    for requests in bump_requests(tags):
+        collection.bulk_write(requests, ordered=False)
+
+
+class SharedTagsCacheBackend(LocalCacheBackend):
+    """ Хранилище по умолчанию: записи - в памяти процесса, версии тегов - в коллекции mongodb, общей для всех
+    воркеров. Инвалидация на любом воркере сразу меняет ключи записей всех воркеров, а чтение ответа из кэша
+    стоит одного запроса версий тегов по _id вместо выполнения действия
+    """
+
+    def __init__(self, collection, maxsize: int=4096, timer=time.monotonic):
+        super().__init__(maxsize, timer)
+        self.collection = collection
+
+    def get_tag_versions(self, tags: list) -> dict:
+        return mongo_tag_versions(self.collection, tags)
+
+    def bump_tags(self, tags: list):
+        mongo_bump_tags(self.collection, tags)
+
+
+class MongoCacheBackend(CacheBackend):
+    """ Хранилище кэша ответов в коллекции mongodb, общее для всех воркеров
+    (устаревшие записи удаляет ttl-индекс по expires_at)
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, key: str):
+        entry = self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.now()}}, {"value": True})
+        return entry.get("value") if entry else None
+
+    def set(self, key: str, value, ttl: float):
+        self.collection.replace_one(
+            {"_id": key}, {"_id": key, "value": value, "expires_at": datetime.now() + timedelta(seconds=ttl)},
+            upsert=True
+        )
+
+    def get_tag_versions(self, tags: list) -> dict:
+        return mongo_tag_versions(self.collection, tags)
+
+    def bump_tags(self, tags: list):
+        mongo_bump_tags(self.collection, tags)
+
+
+def create_cache_backend(collection, name: str=None) -> CacheBackend:
+    """ Создает хранилище кэша ответов по названию (по умолчанию - из RESPONSE_CACHE_BACKEND):
+    shared (по умолчанию) - записи в процессе, версии тегов в mongodb; mongo - все в mongodb;
+    local - все в процессе (инвалидация не видна другим воркерам, только для одного процесса)
+    :param collection: Коллекция mongodb для записей и версий тегов
+    :param name:
+    :return:
+    """
+    name = name or os.environ.get("RESPONSE_CACHE_BACKEND", "shared")
+    if name == "mongo":
+        return MongoCacheBackend(collection)
+    if name == "local":
+        return LocalCacheBackend()
+    if name == "shared":
+        return SharedTagsCacheBackend(collection)
+    raise ValueError("Неизвестное хранилище кэша ответов: %s" % name)
+
+
+def response_key(action: str, params: dict, versions: dict) -> str:
+    """ Возвращает ключ записи для действия, его параметров и версий тегов
+    :param action:
+    :param params:
+    :param versions:
+    :return:
+    """
+    payload = json.dumps([action, params, versions], sort_keys=True, default=str, ensure_ascii=False)
+    return "response:%s" % hashlib.sha1(payload.encode()).hexdigest()
+
+
+class ResponseCache(object):
+    """ Кэш ответов действий контроллеров с инвалидацией по тегам """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+
+    def make_key(self, action: str, params: dict, tags: list) -> str:
+        """ Возвращает ключ записи для действия, его параметров и текущих версий тегов
+        :param action:
+        :param params:
+        :param tags:
+        :return:
+        """
+        return response_key(action, params, self.backend.get_tag_versions(tags))
+
+    def request_key(self, action: str, request, params: list, tags: list) -> str:
+        """ Возвращает ключ записи для запроса: значения параметров params и теги, в которых подставлены
+        значения этих параметров (например "item:{item_id}")
+        :param action:
+        :param request: Запрос с методом get(name, default)
+        :param params:
+        :param tags:
+        :return:
+        """
+        values = {param: request.get(param, None) for param in params}
+        return self.make_key(action, values, [tag.format(**values) for tag in tags])
+
+    def get(self, key: str):
+        """ Возвращает сохраненный ответ или None
+        :param key:
+        :return:
+        """
+        return self.backend.get(key)
+
+    def set(self, key: str, value, ttl: float):
+        """ Сохраняет ответ
+        :param key:
+        :param value:
+        :param ttl:
+        :return:
+        """
+        self.backend.set(key, value, ttl)
+
+    def invalidate(self, tags: list):
+        """ Делает недействительными ответы, зависящие от тегов
+        :param tags:
+        :return:
+        """
+        self.backend.bump_tags(tags)
+
+
+################################################# Async #############################################################
+
+
+class AsyncLocalCacheBackend(LocalCacheBackend):
+    """ Процессное хранилище кэша ответов с интерфейсом асинхронного хранилища (как LocalCacheBackend) """
+
+    async def get(self, key: str):
+        return super().get(key)
+
+    async def set(self, key: str, value, ttl: float):
+        super().set(key, value, ttl)
+
+    async def get_tag_versions(self, tags: list) -> dict:
+        return super().get_tag_versions(tags)
+
+    async def bump_tags(self, tags: list):
+        super().bump_tags(tags)
+
+
+class AsyncSharedTagsCacheBackend(AsyncLocalCacheBackend):
+    """ Записи - в памяти процесса, версии тегов - в mongodb через motor (как SharedTagsCacheBackend) """
+
+    def __init__(self, collection, maxsize: int=4096, timer=time.monotonic):
+        super().__init__(maxsize, timer)
+        self.collection = collection
+
+    async def get_tag_versions(self, tags: list) -> dict:
+        return tag_versions(await self.collection.find(tag_versions_query(tags)).to_list(None), tags)
+
+    async def bump_tags(self, tags: list):
+        for requests in bump_requests(tags):
+            await self.collection.bulk_write(requests, ordered=False)
+
+
+class AsyncMongoCacheBackend(CacheBackend):
+    """ Хранилище кэша ответов в коллекции mongodb через motor (как MongoCacheBackend) """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def get(self, key: str):
+        entry = await self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.now()}}, {"value": True})
+        return entry.get("value") if entry else None
+
+    async def set(self, key: str, value, ttl: float):
+        await self.collection.replace_one(
+            {"_id": key}, {"_id": key, "value": value, "expires_at": datetime.now() + timedelta(seconds=ttl)},
+            upsert=True
+        )
+
+    async def get_tag_versions(self, tags: list) -> dict:
+        return tag_versions(await self.collection.find(tag_versions_query(tags)).to_list(None), tags)
+
+    async def bump_tags(self, tags: list):
+        for requests in bump_requests(tags):
+            await self.collection.bulk_write(requests, ordered=False)
+
+
+def create_async_cache_backend(collection, name: str=None) -> CacheBackend:
+    """ Создает асинхронное хранилище кэша ответов (названия - как в create_cache_backend)
+    :param collection: Коллекция motor
+    :param name:
+    :return:
+    """
+    name = name or os.environ.get("RESPONSE_CACHE_BACKEND", "shared")
+    if name == "mongo":
+        return AsyncMongoCacheBackend(collection)
+    if name == "local":
+        return AsyncLocalCacheBackend()
+    if name == "shared":
+        return AsyncSharedTagsCacheBackend(collection)
+    raise ValueError("Неизвестное хранилище кэша ответов: %s" % name)
+
+
+class AsyncResponseCache(ResponseCache):
+    """ Кэш ответов асинхронных контроллеров: хранилище не блокирует цикл событий """
+
+    async def make_key(self, action: str, params: dict, tags: list) -> str:
+        return response_key(action, params, await self.backend.get_tag_versions(tags))
+
+    async def request_key(self, action: str, request, params: list, tags: list) -> str:
+        values = {param: request.get(param, None) for param in params}
+        return await self.make_key(action, values, [tag.format(**values) for tag in tags])
+
+    async def get(self, key: str):
+        return await self.backend.get(key)
+
+    async def set(self, key: str, value, ttl: float):
+        await self.backend.set(key, value, ttl)
+
+    async def invalidate(self, tags: list):
+        await self.backend.bump_tags(tags)
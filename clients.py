@@ -0,0 +1,350 @@
+""" Клиенты mongodb и elasticsearch
+
+Настройки пулов соединений берутся из переменных окружения (см. MONGO_SETTINGS и ES_SETTINGS).
+Клиенты создаются лениво при первом обращении и заново в каждом процессе, поэтому импорт моделей не открывает
+соединений, а воркеры uwsgi после fork не делят между собой сокеты и фоновые потоки клиента мастер-процесса.
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pymongo import MongoClient, ReadPreference
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_preferences import PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from elasticsearch import Elasticsearch
+
+
+# Переменная окружения -> значение по умолчанию
+MONGO_SETTINGS = {
+    "MONGO_HOST": "mongo",
+    "MONGO_PORT": "27017",
+    "MONGO_MAX_POOL_SIZE": "100",
+    "MONGO_MIN_POOL_SIZE": "0",
+    "MONGO_MAX_IDLE_TIME_MS": "",
+    "MONGO_CONNECT_TIMEOUT_MS": "5000",
+    "MONGO_SOCKET_TIMEOUT_MS": "",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "10000",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "",
+    # Предпочтение чтения по умолчанию - для корзин, покупателей и заказов оно должно оставаться primary
+    "MONGO_READ_PREFERENCE": "primary",
+    # Чтения каталога (товары, рубрики, аттрибуты, рейтинг) направляются на реплики
+    "MONGO_CATALOG_READ_PREFERENCE": "secondaryPreferred",
+    "MONGO_CATALOG_MAX_STALENESS_S": "90",
+    "MONGO_W": "1",
+    "MONGO_WTIMEOUT_MS": "",
+    "MONGO_JOURNAL": "",
+    # Оформление заказа в одной транзакции (нужен replica set или sharded cluster)
+    "MONGO_TRANSACTIONS": "0",
+}
+
+ES_SETTINGS = {
+    "ES_HOSTS": "elasticsearch:9200",
+    "ES_MAXSIZE": "10",
+    "ES_TIMEOUT": "10",
+}
+
+
+def _setting(settings: dict, name: str) -> str:
+    """ Возвращает значение настройки из окружения или значение по умолчанию
+    :param settings:
+    :param name:
+    :return:
+    """
+    return os.environ.get(name, settings[name])
+
+
+def mongo_client_options() -> dict:
+    """ Возвращает параметры клиента mongodb (общие для pymongo и motor)
+    :return:
+    """
+    options = {
+        "host": _setting(MONGO_SETTINGS, "MONGO_HOST"),
+        "port": int(_setting(MONGO_SETTINGS, "MONGO_PORT")),
+        "maxPoolSize": int(_setting(MONGO_SETTINGS, "MONGO_MAX_POOL_SIZE")),
+        "minPoolSize": int(_setting(MONGO_SETTINGS, "MONGO_MIN_POOL_SIZE")),
+        "readPreference": _setting(MONGO_SETTINGS, "MONGO_READ_PREFERENCE"),
+    }
+    for name, option in (
+            ("MONGO_MAX_IDLE_TIME_MS", "maxIdleTimeMS"), ("MONGO_CONNECT_TIMEOUT_MS", "connectTimeoutMS"),
+            ("MONGO_SOCKET_TIMEOUT_MS", "socketTimeoutMS"),
+            ("MONGO_SERVER_SELECTION_TIMEOUT_MS", "serverSelectionTimeoutMS"),
+            ("MONGO_WAIT_QUEUE_TIMEOUT_MS", "waitQueueTimeoutMS"), ("MONGO_WTIMEOUT_MS", "wTimeoutMS")
+    ):
+        if _setting(MONGO_SETTINGS, name):
+            options[option] = int(_setting(MONGO_SETTINGS, name))
+    w = _setting(MONGO_SETTINGS, "MONGO_W")
+    options["w"] = int(w) if w.isdigit() else w
+    if _setting(MONGO_SETTINGS, "MONGO_JOURNAL"):
+        options["journal"] = _setting(MONGO_SETTINGS, "MONGO_JOURNAL").lower() in ("1", "true", "yes")
+    return options
+
+
+def es_client_options() -> dict:
+    """ Возвращает параметры клиента elasticsearch
+    :return:
+    """
+    hosts = []
+    for host in _setting(ES_SETTINGS, "ES_HOSTS").split(","):
+        name, _, port = host.strip().partition(":")
+        hosts.append({"host": name, "port": int(port or 9200)})
+    return {
+        "hosts": hosts,
+        "maxsize": int(_setting(ES_SETTINGS, "ES_MAXSIZE")),
+        "timeout": float(_setting(ES_SETTINGS, "ES_TIMEOUT")),
+    }
+
+
+def transactions_enabled() -> bool:
+    """ Возвращает True, если многодокументные транзакции mongodb включены (MONGO_TRANSACTIONS=1)
+    :return:
+    """
+    return _setting(MONGO_SETTINGS, "MONGO_TRANSACTIONS").lower() in ("1", "true", "yes")
+
+
+# Режимы чтения с реплик: название -> класс предпочтения чтения
+READ_PREFERENCES = {
+    "primaryPreferred": PrimaryPreferred, "secondary": Secondary, "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest
+}
+
+# Флаг "читать с primary" текущего запроса (поток или задача asyncio)
+_primary_reads = ContextVar("primary_reads", default=False)
+
+
+def catalog_read_preference():
+    """ Возвращает предпочтение чтения для запросов каталога
+    :return:
+    """
+    mode = _setting(MONGO_SETTINGS, "MONGO_CATALOG_READ_PREFERENCE")
+    if mode not in READ_PREFERENCES:
+        return ReadPreference.PRIMARY
+    # Минимально допустимое mongodb значение max staleness - 90 секунд, -1 - без ограничения
+    return READ_PREFERENCES[mode](max_staleness=int(_setting(MONGO_SETTINGS, "MONGO_CATALOG_MAX_STALENESS_S")))
+
+
+@contextmanager
+def primary_reads():
+    """ Направляет все чтения внутри блока на primary (чтение собственных только что сделанных записей)
+    :return:
+    """
+    token = _primary_reads.set(True)
+    try:
+        yield
+    finally:
+        _primary_reads.reset(token)
+
+
+def routed(collection, read_preference):
+    """ Возвращает коллекцию с указанным предпочтением чтения, если текущий запрос не требует чтения с primary
+    :param collection:
+    :param read_preference:
+    :return:
+    """
+    if _primary_reads.get() or read_preference == ReadPreference.PRIMARY:
+        return collection
+    return collection.with_options(read_preference=read_preference)
+
+
+class PoolMetrics(ConnectionPoolListener):
+    """ Метрики пула соединений mongodb: занятые соединения и время ожидания свободного соединения """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = threading.local()
+        self.reset()
+
+    def reset(self):
+        """ Обнуляет накопленные метрики
+        :return:
+        """
+        with self.lock:
+            self.checked_out = 0
+            self.max_checked_out = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.connections = 0
+            self.wait_time_total = 0.0
+            self.wait_time_max = 0.0
+
+    def stats(self) -> dict:
+        """ Возвращает метрики пула (время ожидания - в миллисекундах)
+        :return:
+        """
+        with self.lock:
+            return {
+                "checked_out": self.checked_out,
+                "max_checked_out": self.max_checked_out,
+                "connections": self.connections,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "wait_time_avg_ms": round(self.wait_time_total * 1000 / self.checkouts, 3) if self.checkouts else 0,
+                "wait_time_max_ms": round(self.wait_time_max * 1000, 3),
+            }
+
+    def _waited(self) -> float:
+        started = getattr(self.started, "value", None)
+        self.started.value = None
+        return time.monotonic() - started if started is not None else 0.0
+
+    def connection_check_out_started(self, event):
+        self.started.value = time.monotonic()
+
+    def connection_checked_out(self, event):
+        waited = self._waited()
+        with self.lock:
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self.checkouts += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+    def connection_check_out_failed(self, event):
+        self._waited()
+        with self.lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checked_out = max(self.checked_out - 1, 0)
+
+    def connection_created(self, event):
+        with self.lock:
+            self.connections += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.connections = max(self.connections - 1, 0)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+pool_metrics = PoolMetrics()
+
+
+def create_mongo_client() -> MongoClient:
+    """ Создает клиент mongodb с настройками из окружения и сбором метрик пула
+    :return:
+    """
+    return MongoClient(connect=False, event_listeners=[pool_metrics], **mongo_client_options())
+
+
+def create_es_client() -> Elasticsearch:
+    """ Создает клиент elasticsearch с настройками из окружения
+    :return:
+    """
+    return Elasticsearch(**es_client_options())
+
+
+class LazyClient(object):
+    """ Клиент, создаваемый фабрикой при первом обращении и заново в каждом процессе после fork """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """ Возвращает клиент текущего процесса, при необходимости создавая его
+        :return:
+        """
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._client, self._pid = self._factory(), os.getpid()
+        return self._client
+
+    def close(self):
+        """ Закрывает клиент текущего процесса (следующее обращение создаст новый)
+        :return:
+        """
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class LazyMongoClient(LazyClient):
+    """ Ленивый клиент mongodb: базу данных сервиса (db или client["name"]) и ее коллекции можно получить заранее,
+    не создавая клиента, остальные атрибуты (start_session, admin, drop_database, ...) - атрибуты клиента
+    текущего процесса
+    """
+
+    def __init__(self, factory=create_mongo_client):
+        super().__init__(factory)
+
+    @property
+    def db(self) -> 'LazyDatabase':
+        """ База данных сервиса
+        :return:
+        """
+        return LazyDatabase(self, "db")
+
+    def __getitem__(self, name):
+        return LazyDatabase(self, name)
+
+
+class LazyDatabase(object):
+    """ База данных ленивого клиента """
+
+    def __init__(self, client: LazyMongoClient, name: str):
+        self.client = client
+        self.name = name
+
+    def get(self):
+        """ Возвращает базу данных клиента текущего процесса
+        :return:
+        """
+        return self.client.get()[self.name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return LazyCollection(self, name)
+
+    def __getitem__(self, name):
+        return LazyCollection(self, name)
+
+
+class LazyCollection(object):
+    """ Коллекция ленивого клиента, все вызовы передаются коллекции клиента текущего процесса """
+
+    def __init__(self, database: LazyDatabase, name: str, options: dict=None):
+        self.database = database
+        self.name = name
+        self.options = options or {}
+
+    def get(self):
+        """ Возвращает коллекцию клиента текущего процесса
+        :return:
+        """
+        collection = self.database.get()[self.name]
+        return collection.with_options(**self.options) if self.options else collection
+
+    def with_options(self, **options) -> 'LazyCollection':
+        """ Возвращает ту же коллекцию с другими настройками (предпочтение чтения, write concern ...)
+        :param options:
+        :return:
+        """
+        return LazyCollection(self.database, self.name, dict(self.options, **options))
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
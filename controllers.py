@@ -1,14 +1,17 @@
 """ Контроллеры сервиса """
 
-import json
 from envi import Controller as EnviController, Request
-from models import Catalog, Item, Customers, Carts, Orders
-from exceptions import BaseServiceException
-
-catalog = Catalog()
-customers = Customers()
-carts = Carts()
-orders = Orders()
+from models import response_cache, catalog, customers, carts, orders, Item, parse_fields
+from exceptions import error_response
+from serializers import dumps
+from streaming import stream_json_array, stream_jsonl
+from exporter import iter_export
+from actions import (
+    CACHED_ACTIONS, optional_id, bestsellers_page_args, items_page_args, open_orders_filter_args,
+    open_orders_page_args, export_args, fill_item, page_response, orders_response
+)
+from search import AUTOCOMPLETE_SIZE
+from clients import pool_metrics, primary_reads
 
 
 def error_format(func):
@@ -21,11 +24,74 @@ def error_format(func):
         :param kwargs:
         """
         try:
-            return func(*args, **kwargs)
-        except BaseServiceException as e:
-            return json.dumps({"error": {"code": e.code, "message": str(e)}})
+            result = func(*args, **kwargs)
+            return result if isinstance(result, str) else dumps(result)
         except Exception as e:
-            return json.dumps({"error": {"code": None, "message": str(e)}})
+            return error_response(e)
+    return wrapper
+
+
+def cached(ttl: float, params: list, tags: list):
+    """ Декоратор кэширования ответа действия: ключ строится из параметров params,
+    ответ становится недействительным через ttl секунд или при инвалидации любого из тегов
+    (в тегах можно подставлять значения параметров: "item:{item_id}"), запросы с read_primary не кэшируются
+    :param ttl:
+    :param params:
+    :param tags:
+    """
+    def decorator(func):
+        """ decorator
+        :param func:
+        """
+        def wrapper(cls, request: Request, *args, **kwargs):
+            """ wrapper
+            :param cls:
+            :param request:
+            :param args:
+            :param kwargs:
+            """
+            if request.get("read_primary", False):
+                return func(cls, request, *args, **kwargs)
+            key = response_cache.request_key(func.__name__, request, params, tags)
+            response = response_cache.get(key)
+            if response is None:
+                response = func(cls, request, *args, **kwargs)
+                response_cache.set(key, response, ttl)
+            return response
+        return wrapper
+    return decorator
+
+
+def read_routing(func):
+    """ Декоратор для чтений каталога: с параметром read_primary запрос читает с primary,
+    чтобы сразу увидеть результат своей записи (иначе каталог читается с реплик)
+    :param func:
+    """
+    def wrapper(cls, request: Request, *args, **kwargs):
+        """ wrapper
+        :param cls:
+        :param request:
+        :param args:
+        :param kwargs:
+        """
+        if request.get("read_primary", False):
+            with primary_reads():
+                return func(cls, request, *args, **kwargs)
+        return func(cls, request, *args, **kwargs)
+    return wrapper
+
+
+def read_primary(func):
+    """ Декоратор для действий, изменяющих каталог: их чтения (включая повторную загрузку кэшей) идут на primary
+    :param func:
+    """
+    def wrapper(*args, **kwargs):
+        """ wrapper
+        :param args:
+        :param kwargs:
+        """
+        with primary_reads():
+            return func(*args, **kwargs)
     return wrapper
 
 
@@ -34,6 +100,8 @@ class Controller(EnviController):
 
     @classmethod
     @error_format
+    @read_routing
+    @cached(*CACHED_ACTIONS["get_bestsellers"])
     def get_bestsellers(cls, request: Request, *args, **kwargs):
         """ Возвращает лучшие товары из каталога с их кратким представлением
         :param request:
@@ -41,46 +109,56 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        return {
-            "items": catalog.get_bestsellers(
-                request.get("category", False),
-                request.get("slug", False),
-                request.get("quantity", False),
-                request.get("except", [])
-            )
-        }
+        items, next_cursor = catalog.get_bestsellers_page(*bestsellers_page_args(request))
+        return page_response("items", items, next_cursor)
 
     @classmethod
     @error_format
+    @read_routing
+    @cached(*CACHED_ACTIONS["get_items"])
     def get_items(cls, request: Request, *args, **kwargs):
-        """ Возвращает товары с их кратким представлением
+        """ Возвращает товары с их кратким представлением (attr[<id>]=значение, attr[<id>][from|to]=число -
+        фильтр по аттрибутам)
         :param request:
         :param args:
         :param kwargs:
         :return:
         """
-        return {
-            "items": catalog.get_items(
-                request.get("category", False),
-                request.get("slug", False),
-                request.get("quantity", False),
-                request.get("except", [])
-            )
-        }
+        items, next_cursor = catalog.get_items_page(*items_page_args(request))
+        return page_response("items", items, next_cursor)
+
+    @classmethod
+    @error_format
+    @read_routing
+    @cached(*CACHED_ACTIONS["get_facets"])
+    def get_facets(cls, request: Request, *args, **kwargs):
+        """ Возвращает значения аттрибутов товаров рубрики с количеством товаров (для панели фильтров)
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return {"facets": catalog.get_facets(request.get("category", None), request.get("slug", None))}
 
     @classmethod
     @error_format
+    @read_routing
     def get_categories(cls, request: Request, *args, **kwargs):
-        """ Возвращает список категорий товаров
+        """ Возвращает список категорий товаров (заранее сериализованный, с etag для условных запросов)
         :param request:
         :param args:
         :param kwargs:
         :return:
         """
-        return {"categories": catalog.get_categories()}
+        categories_tree = catalog.get_categories_tree()
+        if request.get("if_none_match", None) == categories_tree.etag:
+            return categories_tree.not_modified_json
+        return categories_tree.json
 
     @classmethod
     @error_format
+    @read_routing
+    @cached(*CACHED_ACTIONS["get_category"])
     def get_category(cls, request: Request, *args, **kwargs):
         """ Возвращает категорию товаров по ее идентификатору
         :param request:
@@ -92,6 +170,8 @@ class Controller(EnviController):
 
     @classmethod
     @error_format
+    @read_routing
+    @cached(*CACHED_ACTIONS["get_attributes"])
     def get_attributes(cls, request: Request, *args, **kwargs):
         """ Возвращает список аттрибутов товаров
         :param request:
@@ -105,6 +185,8 @@ class Controller(EnviController):
 
     @classmethod
     @error_format
+    @read_routing
+    @cached(*CACHED_ACTIONS["get_item"])
     def get_item(cls, request: Request, *args, **kwargs):
         """ Возвращает полные данные о товаре
         :param request:
@@ -112,10 +194,25 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        return {"item": catalog.get_item(int(request.get("item_id"))).get_data()}
+        fields = parse_fields(request.get("fields", None))
+        return {"item": catalog.get_item(int(request.get("item_id")), fields).get_data(fields)}
 
     @classmethod
     @error_format
+    @read_routing
+    @cached(*CACHED_ACTIONS["get_items_by_ids"])
+    def get_items_by_ids(cls, request: Request, *args, **kwargs):
+        """ Возвращает полные данные о нескольких товарах в порядке запрошенных идентификаторов
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return {"items": catalog.get_items_by_ids(request.get("ids", []), parse_fields(request.get("fields", None)))}
+
+    @classmethod
+    @error_format
+    @read_primary
     def save(cls, request: Request, *args, **kwargs):
         """ Метод для сохранения товара
         :param request:
@@ -126,16 +223,7 @@ class Controller(EnviController):
             item = catalog.get_item(int(request.get("id")))
         else:
             item = Item()
-        item.title = request.get("title")
-        item.article = request.get("article")
-        item.short = request.get("short")
-        item.imgs = request.get("imgs", [])
-        item.body = request.get("body", "")
-        item.tags = request.get("tags", [])
-        item.categories = request.get("categories", [])
-        item.cost = int(request.get("cost", 0)) if str(request.get("cost")).isnumeric() else None
-        item.discount = int(request.get("discount")) if str(request.get("discount")).isnumeric() else None
-        item.quantity = int(request.get("quantity")) if str(request.get("quantity")).isnumeric() else None
+        fill_item(item, request)
         item.set_attributes(request.get("attributes", []))
         return {"item_id": item.save()}
 
@@ -153,6 +241,7 @@ class Controller(EnviController):
 
     @classmethod
     @error_format
+    @read_primary
     def create_category(cls, request: Request, *args, **kwargs):
         """ Метод для создания новых рубрик
         :param request:
@@ -161,7 +250,7 @@ class Controller(EnviController):
         :return:
         """
         catalog.create_category(request.get("category_name"), request.get("slug"))
-        return {"categories": catalog.get_categories()}
+        return catalog.get_categories_tree().json
 
     @classmethod
     @error_format
@@ -209,7 +298,7 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        cart = carts.get_cart(int(request.get("cart_id")) if request.get("cart_id", None) else None)
+        cart = carts.get_cart(optional_id(request, "cart_id"))
         return {"cart": cart.get_data()}
 
     @classmethod
@@ -221,7 +310,7 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        cart = carts.get_cart(int(request.get("cart_id")) if request.get("cart_id", None) else None)
+        cart = carts.get_cart(optional_id(request, "cart_id"))
         cart.add_item(int(request.get("item_id")), int(request.get("quantity")))
         return {"cart": cart.get_data()}
 
@@ -234,7 +323,7 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        cart = carts.get_cart(int(request.get("cart_id")) if request.get("cart_id", None) else None)
+        cart = carts.get_cart(optional_id(request, "cart_id"))
         cart.remove_item(int(request.get("item_id")))
         return {"cart": cart.get_data()}
 
@@ -247,7 +336,7 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        cart = carts.get_cart(int(request.get("cart_id")) if request.get("cart_id", None) else None)
+        cart = carts.get_cart(optional_id(request, "cart_id"))
         cart.set_quantity_for_item(int(request.get("item_id")), int(request.get("quantity")))
         return {"cart": cart.get_data()}
 
@@ -260,7 +349,7 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        cart = carts.get_cart(int(request.get("cart_id")) if request.get("cart_id", None) else None)
+        cart = carts.get_cart(optional_id(request, "cart_id"))
         cart.clear()
         return {"cart": cart.get_data()}
 
@@ -273,7 +362,7 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        return catalog.autocomplete(request.get("term"))
+        return catalog.autocomplete(request.get("term"), request.get("size", AUTOCOMPLETE_SIZE))
 
     @classmethod
     @error_format
@@ -284,7 +373,7 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        wishlist = carts.get_cart(int(request.get("wishlist_id")) if request.get("wishlist_id", None) else None)
+        wishlist = carts.get_cart(optional_id(request, "wishlist_id"))
         return {"wishlist": wishlist.get_data() if wishlist else None}
 
     @classmethod
@@ -296,7 +385,7 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        wishlist = carts.get_cart(int(request.get("wishlist_id")) if request.get("wishlist_id", None) else None)
+        wishlist = carts.get_cart(optional_id(request, "wishlist_id"))
         wishlist.add_item(int(request.get("item_id")), int(request.get("quantity")))
         return {"wishlist": wishlist.get_data()}
 
@@ -309,7 +398,7 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        wishlist = carts.get_cart(int(request.get("wishlist_id")) if request.get("wishlist_id", None) else None)
+        wishlist = carts.get_cart(optional_id(request, "wishlist_id"))
         wishlist.remove_item(int(request.get("item_id")))
         return {"wishlist": wishlist.get_data()}
 
@@ -322,7 +411,7 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        wishlist = carts.get_cart(int(request.get("wishlist_id")) if request.get("wishlist_id", None) else None)
+        wishlist = carts.get_cart(optional_id(request, "wishlist_id"))
         wishlist.set_quantity_for_item(int(request.get("item_id")), int(request.get("quantity")))
         return {"wishlist": wishlist.get_data()}
 
@@ -335,7 +424,7 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        wishlist = carts.get_cart(int(request.get("wishlist_id")) if request.get("wishlist_id", None) else None)
+        wishlist = carts.get_cart(optional_id(request, "wishlist_id"))
         wishlist.clear()
         return {"wishlist": wishlist.get_data()}
 
@@ -348,8 +437,8 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        wishlist = carts.get_cart(int(request.get("wishlist_id")) if request.get("wishlist_id", None) else None)
-        cart = carts.get_cart(int(request.get("cart_id")) if request.get("cart_id", None) else None)
+        wishlist = carts.get_cart(optional_id(request, "wishlist_id"))
+        cart = carts.get_cart(optional_id(request, "cart_id"))
         wishlist.copy_to(cart)
         return {"cart": cart.get_data()}
 
@@ -365,6 +454,17 @@ class Controller(EnviController):
         order_id = orders.create_order(int(request.get("customer_id")))
         return {"order_id": order_id}
 
+    @classmethod
+    @error_format
+    def confirm_order(cls, request: Request, *args, **kwargs):
+        """ Метод для подтверждения заказа (окончательное списание зарезервированного товара)
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return {"order": orders.confirm_order(int(request.get("order_id"))).get_data()}
+
     @classmethod
     @error_format
     def get_order(cls, request: Request, *args, **kwargs):
@@ -385,24 +485,50 @@ class Controller(EnviController):
         :param kwargs:
         :return:
         """
-        return {
-            "orders": [
-                order.get_data()
-                for order in orders.get_orders_by_customer_id(
-                    int(request.get("customer_id")), limit=request.get("limit", 20)
-                )
-            ]
-        }
+        return orders_response(
+            orders.get_orders_by_customer_id(int(request.get("customer_id")), limit=request.get("limit", 20))
+        )
 
     @classmethod
     @error_format
     def get_open_orders(cls, request: Request, *args, **kwargs):
-        """ Метод для получения невыполненных заказов
+        """ Метод для получения невыполненных заказов (краткие описания, постранично)
         :param request:
         :param args:
         :param kwargs:
         :return:
         """
-        return {
-            "orders": [order.get_data() for order in orders.get_open_orders()]
-        }
+        summaries, next_cursor = orders.get_open_orders_page(*open_orders_page_args(request))
+        return page_response("orders", summaries, next_cursor)
+
+    @classmethod
+    def stream_open_orders(cls, request, *args, **kwargs):
+        """ Метод для потоковой отдачи невыполненных заказов (get_open_orders с параметром stream=1, без страниц)
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return stream_json_array("orders", orders.iter_open_orders(*open_orders_filter_args(request)))
+
+    @classmethod
+    def export_items(cls, request, *args, **kwargs):
+        """ Метод для потоковой выгрузки товаров в JSON Lines (по товару на строку, по возрастанию id)
+        Прерванную выгрузку можно продолжить, передав id последнего полученного товара в after_id
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return stream_jsonl(iter_export(catalog.reader(catalog.items), *export_args(request)))
+
+    @classmethod
+    @error_format
+    def get_pool_metrics(cls, request: Request, *args, **kwargs):
+        """ Метод для получения метрик пула соединений с mongodb текущего воркера
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return {"mongo": pool_metrics.stats()}
@@ -1,6 +1,8 @@
 
 """ Исключения """
 
+from serializers import dumps
+
 
 class BaseServiceException(Exception):
     """ Базовый класс исключений """
@@ -61,3 +63,81 @@ class OrderNotFound(BaseServiceException):
     """ Запрошенный заказ не найден """
     code = 8
     msg = "Запрошенный заказ не найден"
+
+
+class IncorrectCursor(BaseServiceException):
+    """ Некорректный курсор пагинации """
+    code = 9
+    msg = "Некорректный курсор пагинации"
+
+
+class TooManyExceptIds(BaseServiceException):
+    """ Слишком большой список исключаемых товаров """
+    code = 10
+    msg = "Слишком большой список исключаемых товаров, используйте курсор пагинации"
+
+
+class TooManyItemIds(BaseServiceException):
+    """ Слишком много товаров в одном запросе """
+    code = 11
+    msg = "Слишком много товаров в одном запросе"
+
+
+class IncorrectOrdersFilter(BaseServiceException):
+    """ Некорректный фильтр заказов """
+    code = 12
+    msg = "Некорректный фильтр заказов"
+
+
+class NotEnoughStock(BaseServiceException):
+    """ Недостаточно товара на складе """
+    code = 13
+    msg = "Недостаточно товара на складе"
+
+
+class ReservationExpired(BaseServiceException):
+    """ Резерв товаров заказа истек """
+    code = 14
+    msg = "Резерв товаров заказа истек"
+
+
+class CartIsEmpty(BaseServiceException):
+    """ Заказ нельзя оформить из пустой корзины """
+    code = 15
+    msg = "Корзина пуста"
+
+
+class NoArticleForItem(BaseServiceException):
+    """ Не указан артикул """
+    code = 16
+    msg = "Не указан артикул товара"
+
+
+class IncorrectAttributeFilter(BaseServiceException):
+    """ Некорректный фильтр по аттрибутам """
+    code = 17
+    msg = "Некорректный фильтр по аттрибутам"
+
+
+class IncorrectParameter(BaseServiceException):
+    """ Некорректное значение параметра запроса """
+    code = 18
+    msg = "Некорректное значение параметра запроса"
+
+
+def error_data(e: Exception) -> dict:
+    """ Возвращает описание исключения в формате ответа сервиса
+    :param e:
+    :return:
+    """
+    if isinstance(e, BaseServiceException):
+        return {"error": {"code": e.code, "message": str(e)}}
+    return {"error": {"code": None, "message": str(e)}}
+
+
+def error_response(e: Exception) -> str:
+    """ Возвращает сериализованное описание исключения в формате ответа сервиса
+    :param e:
+    :return:
+    """
+    return dumps(error_data(e))
@@ -0,0 +1,29 @@
+""" Выгрузка каталога товаров в JSON Lines или Parquet
+
+Запуск: python3 export-items.py items.jsonl [--category shoes] [--batch-size 1000] [--restart]
+        python3 export-items.py items.parquet [--format parquet]
+Прерванная выгрузка по умолчанию продолжается с последнего чекпоинта (<путь выгрузки>.checkpoint).
+Для Parquet путь выгрузки - каталог с файлами part-*.parquet, нужен pyarrow.
+Товары читаются с вторичных узлов (как и остальные запросы каталога), чтобы не нагружать primary.
+"""
+
+import argparse
+from models import catalog
+from exporter import Exporter, get_writer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="файл (jsonl) или каталог (parquet) выгрузки")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], help="по умолчанию - по расширению пути")
+    parser.add_argument("--category", help="выгрузить только товары рубрики")
+    parser.add_argument("--batch-size", type=int, default=1000, help="товаров за одно обращение к бд")
+    parser.add_argument("--restart", action="store_true", help="начать заново, не продолжая прерванную выгрузку")
+    options = parser.parse_args()
+
+    file_format = options.format or ("parquet" if options.path.rstrip("/").endswith(".parquet") else "jsonl")
+    exporter = Exporter(
+        catalog.reader(catalog.items), get_writer(file_format, options.path), options.path + ".checkpoint",
+        batch_size=options.batch_size
+    )
+    exporter.run(category=options.category, resume=not options.restart)
@@ -0,0 +1,355 @@
+""" Выгрузка каталога товаров в JSON Lines или Parquet
+
+Товары читаются одним курсором по возрастанию _id (опционально - только одной рубрики) и записываются пачками,
+поэтому память не зависит от размера каталога. После каждой сохраненной на диск пачки в файл чекпоинта
+записывается последний выгруженный _id: прерванная выгрузка продолжается с того же места, а данные,
+записанные после чекпоинта, отбрасываются. Для Parquet нужен pyarrow (pip install pyarrow).
+"""
+
+import os
+import json
+import time
+from pymongo import ASCENDING
+from exceptions import IncorrectParameter
+from serializers import dumpb
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+
+
+# Поля товара в выгрузке (в отличие от get_items - вместе с телом и аттрибутами)
+EXPORT_FIELDS = [
+    "id", "article", "title", "short", "body", "imgs", "tags", "categories",
+    "cost", "discount", "cost_with_discount", "quantity", "attributes"
+]
+
+
+def export_query(category: str=None, after_id: int=None) -> dict:
+    """ Возвращает фильтр выгружаемых товаров
+    :param category:
+    :param after_id: Последний уже выгруженный _id
+    :return:
+    """
+    query = {}
+    if category:
+        query["categories"] = category
+    if after_id is not None:
+        query["_id"] = {"$gt": int(after_id)}
+    return query
+
+
+def export_batch_size(batch_size) -> int:
+    """ Возвращает размер пачки курсора из параметра выгрузки
+    :param batch_size: Число или строка из запроса
+    :return:
+    """
+    try:
+        batch_size = int(batch_size)
+    except (TypeError, ValueError):
+        raise IncorrectParameter("Размер пачки выгрузки должен быть целым числом: %s" % batch_size)
+    if batch_size < 1:
+        raise IncorrectParameter("Размер пачки выгрузки должен быть положительным: %s" % batch_size)
+    return batch_size
+
+
+def export_projection() -> dict:
+    """ Возвращает проекцию выгружаемых полей
+    :return:
+    """
+    return {field: True for field in EXPORT_FIELDS if field != "id"}
+
+
+def export_record(item_data: dict) -> dict:
+    """ Возвращает запись выгрузки из документа товара (аттрибуты хранятся в товаре вместе с названиями)
+    :param item_data:
+    :return:
+    """
+    record = {field: item_data.get(field) for field in EXPORT_FIELDS}
+    record["id"] = item_data["_id"]
+    return record
+
+
+def iter_export(items, category: str=None, after_id: int=None, batch_size: int=1000):
+    """ Отдает записи выгрузки по мере чтения курсора
+    :param items: Коллекция товаров
+    :param category:
+    :param after_id: Последний уже выгруженный _id
+    :param batch_size: Количество товаров, получаемых из бд за одно обращение (число или строка из запроса,
+    проверяется при чтении первой записи, поэтому в потоковом ответе ошибка отдается последней строкой)
+    :return:
+    """
+    cursor = items.find(export_query(category, after_id), export_projection())
+    for item_data in cursor.sort([("_id", ASCENDING)]).batch_size(export_batch_size(batch_size)):
+        yield export_record(item_data)
+
+
+async def async_iter_export(items, category: str=None, after_id: int=None, batch_size: int=1000):
+    """ Отдает записи выгрузки по мере чтения курсора (асинхронный вариант iter_export для motor)
+    :param items:
+    :param category:
+    :param after_id:
+    :param batch_size:
+    :return:
+    """
+    cursor = items.find(export_query(category, after_id), export_projection())
+    async for item_data in cursor.sort([("_id", ASCENDING)]).batch_size(export_batch_size(batch_size)):
+        yield export_record(item_data)
+
+
+class JsonlExportWriter(object):
+    """ Запись выгрузки в файл JSON Lines (по товару на строку) """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def open(self, state: dict=None):
+        """ Открывает файл: новый или, при продолжении, обрезанный до последнего чекпоинта
+        :param state: Состояние, сохраненное в чекпоинте
+        :return:
+        """
+        if state:
+            self.file = open(self.path, "r+b")
+            self.file.truncate(state["offset"])
+            self.file.seek(state["offset"])
+        else:
+            self.file = open(self.path, "wb")
+
+    def write(self, records: list):
+        """ Записывает пачку записей
+        :param records:
+        :return:
+        """
+        self.file.write(b"".join(dumpb(record) + b"\n" for record in records))
+
+    def commit(self) -> dict:
+        """ Сохраняет записанное на диск и возвращает состояние для чекпоинта
+        :return:
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {"offset": self.file.tell()}
+
+    def close(self) -> dict:
+        """ Закрывает файл и возвращает итоговое состояние
+        :return:
+        """
+        state = self.commit()
+        self.file.close()
+        return state
+
+
+def _int(value):
+    """ Число для колонки int64 (значения других типов - пустые) """
+    return int(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def _str(value):
+    """ Строка для колонки string """
+    return None if value is None else str(value)
+
+
+def _strings(value) -> list:
+    """ Список строк (одиночное значение, например рубрика-строка, - список из одного элемента) """
+    if value is None:
+        return []
+    return [str(v) for v in value] if isinstance(value, list) else [str(value)]
+
+
+def parquet_record(record: dict) -> dict:
+    """ Приводит запись выгрузки к схеме Parquet (рубрики - всегда список, значения аттрибутов - строки)
+    :param record:
+    :return:
+    """
+    return {
+        "id": record["id"], "article": _str(record["article"]), "title": _str(record["title"]),
+        "short": _str(record["short"]), "body": _str(record["body"]),
+        "imgs": _strings(record["imgs"]), "tags": _strings(record["tags"]),
+        "categories": _strings(record["categories"]),
+        "cost": _int(record["cost"]), "discount": _int(record["discount"]),
+        "cost_with_discount": _int(record["cost_with_discount"]), "quantity": _int(record["quantity"]),
+        "attributes": [
+            {"id": _int(a.get("id")), "name": _str(a.get("name")), "value": _str(a.get("value"))}
+            for a in record["attributes"] or [] if isinstance(a, dict)
+        ]
+    }
+
+
+def parquet_schema():
+    """ Возвращает схему Parquet выгрузки
+    :return:
+    """
+    strings = pyarrow.list_(pyarrow.string())
+    return pyarrow.schema([
+        ("id", pyarrow.int64()), ("article", pyarrow.string()), ("title", pyarrow.string()),
+        ("short", pyarrow.string()), ("body", pyarrow.string()),
+        ("imgs", strings), ("tags", strings), ("categories", strings),
+        ("cost", pyarrow.int64()), ("discount", pyarrow.int64()), ("cost_with_discount", pyarrow.int64()),
+        ("quantity", pyarrow.int64()),
+        ("attributes", pyarrow.list_(pyarrow.struct([
+            ("id", pyarrow.int64()), ("name", pyarrow.string()), ("value", pyarrow.string())
+        ]))),
+    ])
+
+
+class ParquetExportWriter(object):
+    """ Запись выгрузки в каталог файлов Parquet (part-00000.parquet, ...)
+
+    Каждая пачка - группа строк, файл закрывается после rows_per_part строк. Незакрытый файл Parquet
+    нечитаем, поэтому чекпоинт сохраняется только после закрытия файла, а при продолжении незакрытые
+    файлы удаляются.
+    """
+
+    def __init__(self, path: str, rows_per_part: int=100000):
+        if pyarrow is None:
+            raise RuntimeError("Для выгрузки в Parquet нужен pyarrow (pip install pyarrow)")
+        self.path = path
+        self.rows_per_part = rows_per_part
+        self.schema = parquet_schema()
+        self.part = 0
+        self.writer = None
+        self.rows = 0
+
+    def part_path(self, part: int) -> str:
+        """ Путь файла выгрузки
+        :param part:
+        :return:
+        """
+        return os.path.join(self.path, "part-%05d.parquet" % part)
+
+    def open(self, state: dict=None):
+        """ Создает каталог выгрузки, при продолжении удаляет файлы после последнего чекпоинта
+        :param state:
+        :return:
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self.part = state["part"] if state else 0
+        for name in os.listdir(self.path):
+            if name.startswith("part-") and name.endswith(".parquet") and int(name[5:10]) >= self.part:
+                os.remove(os.path.join(self.path, name))
+
+    def write(self, records: list):
+        """ Записывает пачку записей группой строк текущего файла
+        :param records:
+        :return:
+        """
+        if self.writer is None:
+            self.writer = parquet.ParquetWriter(self.part_path(self.part), self.schema)
+        self.writer.write_table(
+            pyarrow.Table.from_pylist([parquet_record(record) for record in records], schema=self.schema)
+        )
+        self.rows += len(records)
+
+    def commit(self):
+        """ Закрывает заполненный файл и возвращает состояние для чекпоинта (None - сохранять чекпоинт рано)
+        :return:
+        """
+        if self.rows < self.rows_per_part:
+            return None
+        return self.close()
+
+    def close(self) -> dict:
+        """ Закрывает текущий файл и возвращает состояние для чекпоинта
+        :return:
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer, self.rows, self.part = None, 0, self.part + 1
+        return {"part": self.part}
+
+
+def get_writer(file_format: str, path: str):
+    """ Возвращает запись выгрузки для формата
+    :param file_format: "jsonl" или "parquet"
+    :param path:
+    :return:
+    """
+    if file_format == "parquet":
+        return ParquetExportWriter(path)
+    return JsonlExportWriter(path)
+
+
+class Exporter(object):
+    """ Выгрузка каталога с чекпоинтами в файле <путь выгрузки>.checkpoint """
+
+    def __init__(self, items, writer, checkpoint_path: str, batch_size: int=1000):
+        self.items = items
+        self.writer = writer
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+
+    def run(self, category: str=None, resume: bool=True, report=print) -> int:
+        """ Выгружает товары и возвращает их общее количество
+        :param category: Выгрузить только товары рубрики
+        :param resume: Продолжить незавершенную выгрузку, если она есть
+        :param report: Функция для вывода прогресса
+        :return:
+        """
+        checkpoint = self.load_checkpoint() if resume else None
+        if checkpoint and not checkpoint.get("done"):
+            if checkpoint.get("category") != category:
+                raise ValueError("Незавершенная выгрузка другой рубрики: %s" % checkpoint.get("category"))
+            last_id, exported, state = checkpoint["last_id"], checkpoint["exported"], checkpoint["state"]
+            report("resuming from _id > %s" % last_id)
+        else:
+            last_id, exported, state = None, 0, None
+        self.writer.open(state)
+
+        started, started_exported, batch = time.time(), exported, []
+        for record in iter_export(self.items, category, last_id, self.batch_size):
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                last_id, exported = self.write(batch, category, exported)
+                batch = []
+                report("%s items exported, %.1f items/s" % (
+                    exported, (exported - started_exported) / max(time.time() - started, 0.001)
+                ))
+        if batch:
+            last_id, exported = self.write(batch, category, exported)
+        self.save_checkpoint(category, last_id, exported, self.writer.close(), done=True)
+        report("done: %s items, %.1f items/s" % (
+            exported, (exported - started_exported) / max(time.time() - started, 0.001)
+        ))
+        return exported
+
+    def write(self, batch: list, category: str, exported: int) -> (int, int):
+        """ Записывает пачку и сохраняет чекпоинт, если записанное уже на диске
+        :param batch:
+        :param category:
+        :param exported:
+        :return: Последний записанный _id и общее количество записанных товаров
+        """
+        self.writer.write(batch)
+        last_id, exported = batch[-1]["id"], exported + len(batch)
+        state = self.writer.commit()
+        if state is not None:
+            self.save_checkpoint(category, last_id, exported, state)
+        return last_id, exported
+
+    def load_checkpoint(self):
+        """ Возвращает сохраненный чекпоинт или None
+        :return:
+        """
+        try:
+            with open(self.checkpoint_path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def save_checkpoint(self, category: str, last_id, exported: int, state: dict, done: bool=False):
+        """ Атомарно сохраняет прогресс выгрузки
+        :param category:
+        :param last_id:
+        :param exported:
+        :param state: Состояние записи выгрузки (позиция в файле, номер файла)
+        :param done:
+        :return:
+        """
+        with open(self.checkpoint_path + ".tmp", "w") as file:
+            json.dump({
+                "category": category, "last_id": last_id, "exported": exported, "state": state, "done": done
+            }, file)
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
@@ -0,0 +1,260 @@
+""" Фильтры товаров по аттрибутам и счетчики значений аттрибутов (фасеты) по рубрикам
+
+Фильтр - словарь {id аттрибута: условие}, в запросе - параметры attr[<id>]=значение (повторяющийся параметр -
+любое из значений) и attr[<id>][from]=10&attr[<id>][to]=20 для числовых аттрибутов (или json-объект в attr).
+Каждое условие - $elemMatch по встроенным в товар аттрибутам, поэтому выборка использует мультиключевые индексы
+attributes.id/attributes.value и attributes.id/attributes.number (числовое значение хранится рядом со строковым).
+
+Счетчики хранятся в коллекции facets: {category, attribute_id, value, count}, category None - весь каталог.
+Сохранение и удаление товара изменяют их на разницу между прежним и новым состоянием товара (одним bulk-запросом),
+поэтому боковая панель фильтров читается одним запросом без агрегации. Пересчитать счетчики с нуля (первое
+заполнение, восстановление после сбоя) можно скриптом rebuild-facets.py.
+"""
+
+import json
+from datetime import datetime
+from pymongo import ASCENDING, UpdateOne
+from exceptions import IncorrectAttributeFilter
+
+
+# Границы диапазона в фильтре числового аттрибута
+RANGE_BOUNDS = {"from": "$gte", "to": "$lte"}
+
+# Порядок счетчиков рубрики: по аттрибуту, затем по значению
+FACETS_SORT = [("attribute_id", ASCENDING), ("value", ASCENDING)]
+
+# Поля товара, от которых зависят счетчики (проекция прежнего состояния товара при сохранении и удалении)
+FACET_FIELDS_PROJECTION = {"categories": True, "attributes": True}
+
+
+def attribute_number(value):
+    """ Возвращает числовое значение аттрибута или None, если значение не число
+    :param value:
+    :return:
+    """
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    if number != number or number in (float("inf"), float("-inf")):
+        return None
+    return int(number) if number.is_integer() else number
+
+
+def parse_attribute_filters(filters) -> dict:
+    """ Возвращает фильтр по аттрибутам из параметра запроса (словарь или json-строка)
+    :param filters:
+    :return:
+    """
+    if not filters:
+        return {}
+    if isinstance(filters, str):
+        try:
+            filters = json.loads(filters)
+        except ValueError:
+            raise IncorrectAttributeFilter()
+    if not isinstance(filters, dict):
+        raise IncorrectAttributeFilter()
+    return filters
+
+
+def attribute_condition(attribute_id, condition) -> dict:
+    """ Возвращает условие $elemMatch для одного аттрибута
+    :param attribute_id:
+    :param condition: Значение, список значений или диапазон {"from", "to"}
+    :return:
+    """
+    try:
+        match = {"id": int(attribute_id)}
+    except (TypeError, ValueError):
+        raise IncorrectAttributeFilter("Некорректный идентификатор аттрибута в фильтре: %s" % attribute_id)
+    if isinstance(condition, dict):
+        bounds = {}
+        for bound, operator in RANGE_BOUNDS.items():
+            if condition.get(bound) in (None, ""):
+                continue
+            number = attribute_number(condition[bound])
+            if number is None:
+                raise IncorrectAttributeFilter("Граница диапазона должна быть числом: %s" % condition[bound])
+            bounds[operator] = number
+        if not bounds:
+            raise IncorrectAttributeFilter("Не указаны границы диапазона для аттрибута %s" % attribute_id)
+        match["number"] = bounds
+    elif isinstance(condition, list):
+        match["value"] = {"$in": [str(value) for value in condition]}
+    else:
+        match["value"] = str(condition)
+    return {"attributes": {"$elemMatch": match}}
+
+
+def attribute_filters_query(filters: dict) -> dict:
+    """ Возвращает условие выборки товаров, у которых выполнены все условия фильтра
+    :param filters: {id аттрибута: условие}
+    :return:
+    """
+    conditions = [
+        attribute_condition(attribute_id, condition) for attribute_id, condition in sorted(filters.items())
+    ]
+    return {"$and": conditions} if conditions else {}
+
+
+def facet_keys(item_data: dict) -> set:
+    """ Возвращает счетчики, в которых учитывается товар: (рубрика, id аттрибута, значение)
+    :param item_data: Данные товара (None - товара нет)
+    :return:
+    """
+    if not item_data:
+        return set()
+    categories = item_data.get("categories")
+    categories = categories if isinstance(categories, list) else [categories] if categories else []
+    return {
+        (category, attribute.get("id"), attribute.get("value"))
+        for attribute in item_data.get("attributes") or []
+        if isinstance(attribute.get("value"), (str, int, float))
+        for category in categories + [None]
+    }
+
+
+def facet_changes(old_data: dict=None, new_data: dict=None) -> dict:
+    """ Возвращает изменения счетчиков при переходе товара из прежнего состояния в новое
+    :param old_data: Прежние данные товара (None - товар создается)
+    :param new_data: Новые данные товара (None - товар удаляется)
+    :return: {(рубрика, id аттрибута, значение): изменение}
+    """
+    old_keys, new_keys = facet_keys(old_data), facet_keys(new_data)
+    changes = {key: -1 for key in old_keys - new_keys}
+    changes.update({key: 1 for key in new_keys - old_keys})
+    return changes
+
+
+def merge_changes(target: dict, changes: dict) -> dict:
+    """ Добавляет изменения счетчиков к накопленным (для пачки товаров)
+    :param target:
+    :param changes:
+    :return:
+    """
+    for key, delta in changes.items():
+        target[key] = target.get(key, 0) + delta
+    return target
+
+
+def facet_requests(changes: dict) -> [UpdateOne]:
+    """ Возвращает запросы изменения счетчиков
+    :param changes:
+    :return:
+    """
+    return [
+        UpdateOne(
+            {"category": category, "attribute_id": attribute_id, "value": value}, {"$inc": {"count": delta}},
+            upsert=True
+        )
+        for (category, attribute_id, value), delta in sorted(changes.items(), key=str) if delta
+    ]
+
+
+def facets_query(category: str=None) -> dict:
+    """ Возвращает фильтр счетчиков рубрики
+    :param category: Рубрика (None - весь каталог)
+    :return:
+    """
+    return {"category": category or None, "count": {"$gt": 0}}
+
+
+def group_facets(facets_data: list, attribute_schemes: dict) -> [dict]:
+    """ Группирует счетчики по аттрибутам: [{id, name, values: [{value, count}], min, max}],
+    для числовых аттрибутов значения упорядочены по числу и добавлены границы для фильтра диапазоном
+    :param facets_data: Документы счетчиков, упорядоченные по аттрибуту
+    :param attribute_schemes: Схемы аттрибутов {id: AttributeScheme} (аттрибуты без схемы не показываются)
+    :return:
+    """
+    values = {}
+    for facet_data in facets_data:
+        values.setdefault(facet_data["attribute_id"], []).append(
+            {"value": facet_data["value"], "count": facet_data["count"]}
+        )
+    result = []
+    for attribute_id, attribute_values in values.items():
+        if attribute_id not in attribute_schemes:
+            continue
+        facet = {"id": attribute_id, "name": attribute_schemes[attribute_id].name, "values": attribute_values}
+        numbers = [attribute_number(value["value"]) for value in facet["values"]]
+        if None in numbers:
+            facet["values"].sort(key=lambda value: str(value["value"]))
+        else:
+            facet["values"].sort(key=lambda value: attribute_number(value["value"]))
+            facet["min"], facet["max"] = min(numbers), max(numbers)
+        result.append(facet)
+    return result
+
+
+def rebuild_pipeline(by_category: bool) -> [dict]:
+    """ Возвращает агрегацию, считающую счетчики по всем товарам каталога
+    :param by_category: Счетчики рубрик (рубрика-строка разворачивается как список из одной рубрики)
+    или всего каталога
+    :return:
+    """
+    pipeline = [
+        {"$match": {"attributes.0": {"$exists": True}}},
+        {"$unwind": "$attributes"},
+        {"$match": {"$or": [{"attributes.value": {"$type": "string"}}, {"attributes.value": {"$type": "number"}}]}},
+    ]
+    if by_category:
+        pipeline.append({"$unwind": "$categories"})
+    pipeline.append({"$group": {
+        "_id": {
+            "category": "$categories" if by_category else None,
+            "attribute_id": "$attributes.id", "value": "$attributes.value"
+        },
+        "count": {"$sum": 1}
+    }})
+    return pipeline
+
+
+class FacetCounts(object):
+    """ Изменение счетчиков значений аттрибутов по рубрикам (коллекция facets), читает их Catalog.get_facets """
+
+    def __init__(self, facets):
+        self.facets = facets
+
+    def apply(self, changes: dict):
+        """ Изменяет счетчики одним bulk-запросом
+        :param changes: {(рубрика, id аттрибута, значение): изменение}
+        :return:
+        """
+        requests = facet_requests(changes)
+        if requests:
+            self.facets.bulk_write(requests, ordered=False)
+
+    def rebuild(self, items, chunk_size: int=1000) -> int:
+        """ Пересчитывает все счетчики по коллекции товаров и возвращает количество счетчиков. Счетчики
+        перезаписываются на месте, поэтому чтения не видят пустой коллекции, а исчезнувшие значения удаляются в конце
+        :param items: Коллекция товаров
+        :param chunk_size: Количество счетчиков в одном bulk-запросе
+        :return:
+        """
+        rebuilt, requests, total = datetime.now(), [], 0
+        for by_category in (True, False):
+            for facet_data in items.aggregate(rebuild_pipeline(by_category), allowDiskUse=True):
+                requests.append(UpdateOne(
+                    facet_data["_id"], {"$set": {"count": facet_data["count"], "rebuilt_datetime": rebuilt}},
+                    upsert=True
+                ))
+                if len(requests) >= chunk_size:
+                    self.facets.bulk_write(requests, ordered=False)
+                    total, requests = total + len(requests), []
+        if requests:
+            self.facets.bulk_write(requests, ordered=False)
+            total += len(requests)
+        self.facets.delete_many({"rebuilt_datetime": {"$ne": rebuilt}})
+        return total
+
+
+class AsyncFacetCounts(FacetCounts):
+    """ Счетчики значений аттрибутов по рубрикам (асинхронный вариант FacetCounts для motor) """
+
+    async def apply(self, changes: dict):
+        requests = facet_requests(changes)
+        if requests:
+            await self.facets.bulk_write(requests, ordered=False)
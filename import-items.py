@@ -0,0 +1,27 @@
+""" Импорт товаров из фида поставщика
+
+Запуск: python3 import-items.py feed.jsonl [--format csv] [--processes 4] [--batch-size 1000] [--errors errors.jsonl]
+[--dry-run]
+Товары ищутся по артикулу: существующие обновляются, новые создаются (формат фида - см. importer.py).
+Строки с ошибками пропускаются и записываются в отчет об ошибках, остальные импортируются.
+"""
+
+import argparse
+from importer import ItemsImporter, read_rows
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("path", help="файл фида")
+parser.add_argument("--format", choices=["jsonl", "csv"], help="формат фида (по умолчанию - по расширению файла)")
+parser.add_argument("--processes", type=int, default=4, help="процессов, обрабатывающих пачки")
+parser.add_argument("--batch-size", type=int, default=1000, help="строк в одном bulk-запросе")
+parser.add_argument("--errors", default="import-errors.jsonl", help="файл отчета об ошибочных строках")
+parser.add_argument("--dry-run", action="store_true", help="только проверить строки, не сохраняя товары")
+options = parser.parse_args()
+
+file_format = options.format or ("csv" if options.path.lower().endswith(".csv") else "jsonl")
+with open(options.path, encoding="utf-8", newline="") as feed, open(options.errors, "w", encoding="utf-8") as errors:
+    summary = ItemsImporter(options.processes, options.batch_size, options.dry_run).run(
+        read_rows(feed, file_format), errors
+    )
+print("done: %(rows)s rows, %(created)s created, %(updated)s updated, %(errors)s errors" % summary)
@@ -0,0 +1,233 @@
+""" Пакетный импорт товаров из фида поставщика (JSONL или CSV)
+
+Строки фида читаются потоком и группируются в пачки, пачки обрабатываются пулом процессов: каждая строка
+превращается в товар (аттрибуты проверяются по кэшированным схемам), пачка сохраняется одним bulk-запросом
+с поиском товаров по артикулу. Ошибочные строки не прерывают импорт и попадают в отчет с номером строки.
+Очередь синхронизации поиска и кэш ответов обновляются один раз после всех пачек.
+
+Формат строки JSONL совпадает с параметрами Controller.save:
+{"article": "A-1", "title": "...", "cost": 100, "categories": "shoes", "attributes": [{"id": 1, "value": "red"}]}
+В CSV списки (imgs, tags) разделяются символом "|", значения аттрибутов - в колонках "attr:<id аттрибута>".
+"""
+
+import csv
+import json
+import time
+from collections import deque
+from multiprocessing import Pool
+from exceptions import NoArticleForItem, error_data
+from models import catalog, response_cache, Item
+
+
+# Поля товара, которые в CSV содержат списки
+CSV_LIST_FIELDS = ["imgs", "tags"]
+CSV_LIST_SEPARATOR = "|"
+CSV_ATTRIBUTE_PREFIX = "attr:"
+
+
+def parse_number(value):
+    """ Возвращает целое число из значения поля (как в Controller.save: нечисловое значение - None)
+    :param value:
+    :return:
+    """
+    return int(value) if str(value).isnumeric() else None
+
+
+def csv_row(row: dict) -> dict:
+    """ Приводит строку CSV к формату строки JSONL
+    :param row:
+    :return:
+    """
+    result, attributes = {}, []
+    for key, value in row.items():
+        if key is None or value is None or value == "":
+            continue
+        if key.startswith(CSV_ATTRIBUTE_PREFIX):
+            attribute_id = key[len(CSV_ATTRIBUTE_PREFIX):]
+            attributes.append({"id": parse_number(attribute_id) or attribute_id, "value": value})
+        elif key in CSV_LIST_FIELDS:
+            result[key] = [part for part in value.split(CSV_LIST_SEPARATOR) if part]
+        else:
+            result[key] = value
+    result["attributes"] = attributes
+    return result
+
+
+def read_rows(file, file_format: str):
+    """ Отдает строки фида (номер строки, данные строки, ошибка разбора)
+    :param file: Открытый текстовый файл
+    :param file_format: "jsonl" или "csv"
+    :return:
+    """
+    if file_format == "csv":
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, csv_row(row), None
+        return
+    for line, text in enumerate(file, 1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError as e:
+            yield line, None, "Некорректный json: %s" % e
+            continue
+        if not isinstance(row, dict):
+            yield line, None, "Строка должна быть объектом"
+            continue
+        yield line, row, None
+
+
+def build_item(row: dict, attribute_schemes: dict) -> Item:
+    """ Создает товар из строки фида и проверяет его (поля заполняются так же, как в Controller.save)
+    :param row:
+    :param attribute_schemes: Схемы аттрибутов {id: AttributeScheme}
+    :return:
+    """
+    item = Item()
+    item.article = row.get("article")
+    if not item.article:
+        raise NoArticleForItem()
+    item.article = str(item.article)
+    item.title = row.get("title")
+    item.short = row.get("short")
+    item.imgs = row.get("imgs", [])
+    item.body = row.get("body", "")
+    item.tags = row.get("tags", [])
+    item.categories = row.get("categories", [])
+    item.cost = parse_number(row.get("cost", 0))
+    item.discount = parse_number(row.get("discount"))
+    item.quantity = parse_number(row.get("quantity"))
+    item.validate()
+    item.set_attributes(row.get("attributes", []), attribute_schemes)
+    item.get_data()
+    return item
+
+
+def row_error(line: int, row: dict, error) -> dict:
+    """ Возвращает запись отчета об ошибке строки
+    :param line:
+    :param row:
+    :param error: Исключение или сообщение
+    :return:
+    """
+    if isinstance(error, Exception):
+        error = error_data(error)["error"]
+    else:
+        error = {"code": None, "message": error}
+    return {"line": line, "article": (row or {}).get("article"), "error": error}
+
+
+def import_batch(batch: list, dry_run: bool=False) -> dict:
+    """ Импортирует пачку строк фида (выполняется в процессе пула)
+    :param batch: Строки (номер строки, данные строки, ошибка разбора)
+    :param dry_run: Только проверить строки, не сохраняя товары
+    :return: {"created": [id], "updated": [id], "errors": [запись отчета]}
+    """
+    result = {"created": [], "updated": [], "errors": []}
+    attribute_schemes = catalog.get_attribute_schemes([
+        attribute.get("id") for _, row, _ in batch if row
+        for attribute in row.get("attributes") or [] if isinstance(attribute, dict)
+    ])
+    # Повторный артикул внутри пачки: как при построчном сохранении, побеждает последняя строка
+    items, rows = {}, {}
+    for line, row, error in batch:
+        if error:
+            result["errors"].append(row_error(line, row, error))
+            continue
+        try:
+            item = build_item(row, attribute_schemes)
+        except Exception as e:
+            result["errors"].append(row_error(line, row, e))
+            continue
+        items.pop(item.article, None)
+        items[item.article], rows[item.article] = item, (line, row)
+    if not items or dry_run:
+        return result
+    items = list(items.values())
+    created, updated, errors = catalog.upsert_items(items)
+    result["created"], result["updated"] = created, updated
+    for index, message in sorted(errors.items()):
+        line, row = rows[items[index].article]
+        result["errors"].append(row_error(line, row, message))
+    return result
+
+
+def batches(rows, batch_size: int):
+    """ Группирует строки в пачки
+    :param rows:
+    :param batch_size:
+    :return:
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ItemsImporter(object):
+    """ Импорт фида пачками в пуле процессов
+
+    В очереди пула держится не больше двух пачек на процесс, поэтому память не зависит от размера фида.
+    """
+
+    def __init__(self, processes: int=4, batch_size: int=1000, dry_run: bool=False):
+        self.processes = processes
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+
+    def run(self, rows, errors_file=None, report=print) -> dict:
+        """ Импортирует строки фида и возвращает итоги
+        :param rows: Строки фида из read_rows
+        :param errors_file: Файл для отчета об ошибках (JSONL, по записи на ошибочную строку)
+        :param report:
+        :return: {"rows", "created", "updated", "errors"}
+        """
+        summary = {"rows": 0, "created": 0, "updated": 0, "errors": 0}
+        changed, updated, started = [], [], time.time()
+
+        def collect(result: dict, rows_count: int):
+            summary["rows"] += rows_count
+            summary["created"] += len(result["created"])
+            summary["updated"] += len(result["updated"])
+            summary["errors"] += len(result["errors"])
+            changed.extend(result["created"] + result["updated"])
+            updated.extend(result["updated"])
+            for error in result["errors"]:
+                if errors_file:
+                    errors_file.write(json.dumps(error, ensure_ascii=False) + "\n")
+            report("%(rows)s rows: %(created)s created, %(updated)s updated, %(errors)s errors" % summary +
+                   ", %.1f rows/s" % (summary["rows"] / max(time.time() - started, 0.001)))
+
+        if self.processes > 1:
+            with Pool(self.processes) as pool:
+                pending = deque()
+                for batch in batches(rows, self.batch_size):
+                    pending.append((pool.apply_async(import_batch, (batch, self.dry_run)), len(batch)))
+                    if len(pending) >= self.processes * 2:
+                        result, rows_count = pending.popleft()
+                        collect(result.get(), rows_count)
+                while pending:
+                    result, rows_count = pending.popleft()
+                    collect(result.get(), rows_count)
+        else:
+            for batch in batches(rows, self.batch_size):
+                collect(import_batch(batch, self.dry_run), len(batch))
+        self.finish(changed, updated)
+        return summary
+
+    def finish(self, changed: list, updated: list):
+        """ Ставит измененные товары в очередь синхронизации поиска и делает недействительными кэшированные ответы
+        (один раз на весь импорт)
+        :param changed: Идентификаторы созданных и обновленных товаров
+        :param updated: Идентификаторы обновленных товаров
+        :return:
+        """
+        if not changed:
+            return
+        catalog.search_queue.push_many(changed, "index")
+        response_cache.invalidate(["items"] + ["item:%s" % item_id for item_id in updated])
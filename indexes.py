@@ -0,0 +1,147 @@
+""" Индексы коллекций сервиса и проверка планов выполнения запросов
+
+Запуск: python3 indexes.py [--report]
+Создает недостающие индексы (повторный запуск ничего не меняет), с --report дополнительно выполняет explain()
+для всех форм запросов моделей и завершается с ошибкой, если какой-либо из них выполняется полным сканированием.
+"""
+
+import sys
+import argparse
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from models import mongo_client, COMMON_ATTRIBUTES_QUERY, OPEN_ORDER_STATES, ORDERS_SORT, orders_query, items_query
+from facets import FACETS_SORT, facets_query
+from bestsellers import BESTSELLERS_SORT, expired_orders_query
+from inventory import ACTIVE_RESERVATION_STATES
+
+
+# Декларативное описание индексов: коллекция -> список индексов
+INDEXES = {
+    "items": [
+        IndexModel([("categories", ASCENDING), ("_id", DESCENDING)], name="categories_id"),
+        IndexModel([("article", ASCENDING)], name="article"),
+        # Мультиключевые индексы фильтров по аттрибутам (условие $elemMatch по id и значению)
+        IndexModel([("attributes.id", ASCENDING), ("attributes.value", ASCENDING)], name="attributes_id_value"),
+        IndexModel([("attributes.id", ASCENDING), ("attributes.number", ASCENDING)], name="attributes_id_number"),
+    ],
+    "facets": [
+        IndexModel(
+            [("category", ASCENDING), ("attribute_id", ASCENDING), ("value", ASCENDING)],
+            name="category_attribute_id_value", unique=True
+        ),
+    ],
+    "categories": [
+        IndexModel([("slug", ASCENDING)], name="slug"),
+    ],
+    "attributes": [
+        IndexModel([("categories", ASCENDING)], name="categories"),
+    ],
+    "orders": [
+        IndexModel([("customer_id", ASCENDING), ("created_datetime", DESCENDING)], name="customer_id_created_datetime"),
+        IndexModel(
+            [("state", ASCENDING), ("created_datetime", ASCENDING), ("_id", ASCENDING)], name="state_created_datetime_id"
+        ),
+    ],
+    "bestsellers": [
+        IndexModel(
+            [("window", ASCENDING), ("categories", ASCENDING), ("quantity", DESCENDING), ("item_id", DESCENDING)],
+            name="window_categories_rank"
+        ),
+        IndexModel([("window", ASCENDING), ("quantity", DESCENDING), ("item_id", DESCENDING)], name="window_rank"),
+    ],
+    "bestsellers_daily": [
+        IndexModel([("day", ASCENDING)], name="day"),
+    ],
+    "search_queue": [
+        IndexModel([("next_attempt_datetime", ASCENDING)], name="next_attempt_datetime"),
+    ],
+    "reservations": [
+        IndexModel([("state", ASCENDING), ("expires_datetime", ASCENDING)], name="state_expires_datetime"),
+    ],
+    "response_cache": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at", expireAfterSeconds=0),
+    ],
+}
+
+
+# Формы запросов моделей: (название, коллекция, фильтр, сортировка)
+QUERY_SHAPES = [
+    ("Catalog.get_item", "items", {"_id": 1}, None),
+    ("Catalog.get_items", "items", {}, [("_id", DESCENDING)]),
+    ("Catalog.get_items(category)", "items", {"categories": "category"}, [("_id", DESCENDING)]),
+    ("Catalog.get_items(cursor)", "items", {"categories": "category", "_id": {"$lt": 100}}, [("_id", DESCENDING)]),
+    ("Catalog.get_items_map", "items", {"_id": {"$in": [1, 2]}}, None),
+    ("Catalog.get_items(attributes)", "items", items_query(attributes={"1": "red"}), [("_id", DESCENDING)]),
+    ("Catalog.get_items(range)", "items", items_query(attributes={"2": {"from": 40}}), [("_id", DESCENDING)]),
+    ("Catalog.get_facets", "facets", facets_query("category"), FACETS_SORT),
+    ("Catalog.upsert_items", "items", {"article": {"$in": ["A-1", "A-2"]}}, None),
+    ("Catalog.get_bestsellers", "bestsellers", {"window": "month"}, BESTSELLERS_SORT),
+    ("Catalog.get_bestsellers(category)", "bestsellers", {"window": "month", "categories": "category"}, BESTSELLERS_SORT),
+    ("Catalog.get_category", "categories", {"slug": "slug"}, None),
+    ("Catalog.get_attributes", "attributes", COMMON_ATTRIBUTES_QUERY, None),
+    ("Catalog.get_attributes(categories)", "attributes", {"categories": ["category"]}, None),
+    ("Catalog.get_attribute_schemes", "attributes", {"_id": {"$in": [1, 2]}}, None),
+    ("Carts.get_cart", "carts", {"_id": 1}, None),
+    ("Orders.get_order", "orders", {"_id": 1}, None),
+    ("Orders.get_orders_by_customer_id", "orders", {"customer_id": 1}, [("created_datetime", DESCENDING)]),
+    ("SearchSyncWorker.drain_once", "search_queue", {"next_attempt_datetime": {"$lte": datetime.now()}}, [("_id", ASCENDING)]),
+    ("Orders.get_open_orders_page", "orders", orders_query(OPEN_ORDER_STATES), ORDERS_SORT),
+    ("BestsellersAggregator.update_daily", "orders", expired_orders_query(datetime.now()),
+     [("created_datetime", ASCENDING)]),
+    ("Inventory.release_expired", "reservations",
+     {"state": {"$in": ACTIVE_RESERVATION_STATES}, "expires_datetime": {"$lte": datetime.now()}},
+     [("expires_datetime", ASCENDING)]),
+    ("Orders.get_open_orders_page(period)", "orders",
+     orders_query(OPEN_ORDER_STATES, datetime(2020, 1, 1), datetime(2020, 2, 1)), ORDERS_SORT),
+]
+
+
+def ensure_indexes(db):
+    """ Создает недостающие индексы, описанные в INDEXES (create_indexes идемпотентен)
+    :param db:
+    :return:
+    """
+    for collection_name, indexes in INDEXES.items():
+        db[collection_name].create_indexes(indexes)
+
+
+def get_plan_stages(plan: dict) -> [str]:
+    """ Возвращает все стадии плана выполнения запроса
+    :param plan:
+    :return:
+    """
+    stages = [plan.get("stage")] if plan.get("stage") else []
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []) + [plan.get("queryPlan")]:
+        if child:
+            stages += get_plan_stages(child)
+    return stages
+
+
+def explain_report(db) -> [(str, [str])]:
+    """ Выполняет explain() для каждой формы запроса и возвращает стадии выигравших планов
+    :param db:
+    :return:
+    """
+    report = []
+    for name, collection_name, query, sort in QUERY_SHAPES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        report.append((name, get_plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--report", action="store_true", help="проверить планы запросов через explain()")
+    options = parser.parse_args()
+
+    ensure_indexes(mongo_client.db)
+    print("indexes ensured")
+    if options.report:
+        failed = False
+        for query_name, stages in explain_report(mongo_client.db):
+            collscan = "COLLSCAN" in stages
+            failed = failed or collscan
+            print("%-4s %-40s %s" % ("FAIL" if collscan else "OK", query_name, " <- ".join(stages)))
+        sys.exit(1 if failed else 0)
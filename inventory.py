@@ -0,0 +1,275 @@
+""" Резервирование остатков товаров при оформлении заказа
+
+Остаток товара - поле quantity документа товара. Резерв списывает его условным атомарным обновлением
+{"quantity": {"$gte": n}} -> {"$inc": {"quantity": -n}}, поэтому два одновременных заказа не могут продать
+один и тот же товар дважды. Резерв заказа записывается в коллекцию reservations до списания остатков, а каждая
+списанная позиция сразу добавляется в его поле taken: если какой-либо позиции не хватает, возвращаются только
+списанные позиции, а если процесс упал посреди резервирования, их же вернет фоновая очистка
+(release-expired-reservations.py) по истечении срока резерва. Падение между списанием и записью в taken оставляет
+товар списанным (недопродажа вместо продажи несуществующего остатка).
+
+Товар без остатка (quantity отсутствует или null) на складе не учитывается: его позиции в резерв не попадают
+и заказываются в любом количестве, как и до появления резервов. Неподтвержденный заказ держит товар RESERVATION_TTL
+(30 минут): затем release-expired-reservations.py возвращает остатки, а заказ получает статус "Истек" и уже не
+подтверждается (confirm_order), поэтому клиенты должны подтверждать заказы в течение этого срока.
+"""
+
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, UpdateOne
+from exceptions import NotEnoughStock
+
+
+# Время, в течение которого резерв невыполненного заказа держит товар
+RESERVATION_TTL = timedelta(minutes=30)
+
+
+class ReservationStates(object):
+    """ Статусы резервов """
+    Pending = "pending"
+    Reserved = "reserved"
+    Committed = "committed"
+    Released = "released"
+
+ACTIVE_RESERVATION_STATES = [ReservationStates.Pending, ReservationStates.Reserved]
+
+
+def reservation_lines(items: list) -> list:
+    """ Возвращает позиции резерва [{"id", "quantity"}] из позиций заказа: количество одного товара суммируется,
+    товары упорядочены по id, чтобы одновременные резервы обновляли документы в одном порядке
+    :param items: Позиции заказа или корзины ({"id", "quantity"})
+    :return:
+    """
+    quantities = {}
+    for line in items:
+        quantities[int(line["id"])] = quantities.get(int(line["id"]), 0) + int(line["quantity"])
+    return [{"id": item_id, "quantity": quantity} for item_id, quantity in sorted(quantities.items()) if quantity > 0]
+
+
+def untracked_query(lines: list) -> dict:
+    """ Условие выборки товаров позиций, остаток которых не учитывается (quantity отсутствует или null)
+    :param lines:
+    :return:
+    """
+    return {"_id": {"$in": [line["id"] for line in lines]}, "quantity": None}
+
+
+def tracked_lines(lines: list, untracked: list) -> list:
+    """ Возвращает позиции, остаток которых учитывается
+    :param lines:
+    :param untracked: Документы товаров без учета остатка (выборка по untracked_query)
+    :return:
+    """
+    untracked_ids = {item_data["_id"] for item_data in untracked}
+    return [line for line in lines if line["id"] not in untracked_ids]
+
+
+def take_query(line: dict) -> dict:
+    """ Условие списания остатка позиции
+    :param line:
+    :return:
+    """
+    return {"_id": line["id"], "quantity": {"$gte": line["quantity"]}}
+
+
+def take_update(line: dict) -> dict:
+    """ Списание остатка позиции
+    :param line:
+    :return:
+    """
+    return {"$inc": {"quantity": -line["quantity"]}}
+
+
+def return_update(line: dict) -> dict:
+    """ Возврат остатка позиции
+    :param line:
+    :return:
+    """
+    return {"$inc": {"quantity": line["quantity"]}}
+
+
+def taken_update(order_id: int, line: dict) -> (dict, dict):
+    """ Запись списанной позиции в незавершенный резерв
+    :param order_id:
+    :param line:
+    :return: Фильтр и обновление резерва
+    """
+    return {"_id": order_id, "state": ReservationStates.Pending}, {"$push": {"taken": line}}
+
+
+def released_lines(reservation: dict) -> list:
+    """ Возвращает позиции, остатки которых нужно вернуть при снятии резерва: у незавершенного резерва -
+    только списанные (остальные позиции списать не успели), у завершенного - все
+    :param reservation:
+    :return:
+    """
+    if reservation["state"] == ReservationStates.Pending:
+        return reservation.get("taken") or []
+    return reservation["lines"]
+
+
+class Inventory(object):
+    """ Резервы остатков товаров под заказы """
+
+    def __init__(self, items, reservations, ttl: timedelta=RESERVATION_TTL):
+        self.items = items
+        self.reservations = reservations
+        self.ttl = ttl
+
+    def reserve(self, order_id: int, items: list, now: datetime=None) -> datetime:
+        """ Резервирует остатки всех позиций заказа или не резервирует ничего (товары без учета остатка пропускаются)
+        :param order_id:
+        :param items: Позиции заказа ({"id", "quantity"})
+        :param now:
+        :return: Срок действия резерва
+        :raise NotEnoughStock: Если какой-либо позиции не хватает на складе
+        """
+        now = now or datetime.now()
+        lines = reservation_lines(items)
+        if lines:
+            lines = tracked_lines(lines, self.items.find(untracked_query(lines), {"_id": True}))
+        expires = now + self.ttl
+        self.reservations.insert_one({
+            "_id": order_id, "lines": lines, "taken": [], "state": ReservationStates.Pending,
+            "created_datetime": now, "expires_datetime": expires
+        })
+        for line in lines:
+            if self.items.update_one(take_query(line), take_update(line)).modified_count != 1:
+                self.release(order_id)
+                raise NotEnoughStock("Недостаточно товара на складе (товар %s)" % line["id"])
+            self.reservations.update_one(*taken_update(order_id, line))
+        self.reservations.update_one(
+            {"_id": order_id, "state": ReservationStates.Pending}, {"$set": {"state": ReservationStates.Reserved}}
+        )
+        return expires
+
+    def reserve_in_transaction(self, order_id: int, items: list, session, now: datetime=None) -> datetime:
+        """ Резервирует остатки всех позиций заказа в транзакции: все списания отправляются одним bulk-запросом,
+        а при нехватке товара откат выполняет отмена транзакции
+        :param order_id:
+        :param items: Позиции заказа ({"id", "quantity"})
+        :param session: Сессия mongodb с начатой транзакцией
+        :param now:
+        :return: Срок действия резерва
+        :raise NotEnoughStock: Если какой-либо позиции не хватает на складе
+        """
+        now = now or datetime.now()
+        lines = reservation_lines(items)
+        if lines:
+            lines = tracked_lines(lines, self.items.find(untracked_query(lines), {"_id": True}, session=session))
+        expires = now + self.ttl
+        self.reservations.insert_one({
+            "_id": order_id, "lines": lines, "state": ReservationStates.Reserved,
+            "created_datetime": now, "expires_datetime": expires
+        }, session=session)
+        if lines:
+            result = self.items.bulk_write(
+                [UpdateOne(take_query(line), take_update(line)) for line in lines], ordered=False, session=session
+            )
+            if result.modified_count != len(lines):
+                raise NotEnoughStock()
+        return expires
+
+    def commit(self, order_id: int) -> bool:
+        """ Подтверждает резерв (товар остается списанным окончательно)
+        :param order_id:
+        :return: False, если активного резерва уже нет (например, он истек)
+        """
+        result = self.reservations.update_one(
+            {"_id": order_id, "state": ReservationStates.Reserved}, {"$set": {"state": ReservationStates.Committed}}
+        )
+        return result.modified_count == 1
+
+    def release(self, order_id: int) -> bool:
+        """ Снимает активный резерв и возвращает остатки (повторное снятие ничего не делает),
+        у незавершенного резерва возвращаются только уже списанные позиции
+        :param order_id:
+        :return: False, если активного резерва нет
+        """
+        reservation = self.reservations.find_one_and_update(
+            {"_id": order_id, "state": {"$in": ACTIVE_RESERVATION_STATES}},
+            {"$set": {"state": ReservationStates.Released}}
+        )
+        if not reservation:
+            return False
+        for line in released_lines(reservation):
+            self.items.update_one({"_id": line["id"]}, return_update(line))
+        return True
+
+    def release_expired(self, now: datetime=None, limit: int=1000) -> [int]:
+        """ Снимает истекшие резервы и возвращает идентификаторы их заказов
+        :param now:
+        :param limit: Максимальное количество резервов за один вызов
+        :return:
+        """
+        expired = self.reservations.find(
+            {"state": {"$in": ACTIVE_RESERVATION_STATES}, "expires_datetime": {"$lte": now or datetime.now()}},
+            {"_id": True}
+        ).sort([("expires_datetime", ASCENDING)]).limit(limit)
+        return [reservation["_id"] for reservation in expired if self.release(reservation["_id"])]
+
+
+class AsyncInventory(Inventory):
+    """ Резервы остатков товаров под заказы (асинхронный вариант Inventory для motor) """
+
+    async def reserve(self, order_id: int, items: list, now: datetime=None) -> datetime:
+        now = now or datetime.now()
+        lines = reservation_lines(items)
+        if lines:
+            lines = tracked_lines(lines, await self.items.find(untracked_query(lines), {"_id": True}).to_list(None))
+        expires = now + self.ttl
+        await self.reservations.insert_one({
+            "_id": order_id, "lines": lines, "taken": [], "state": ReservationStates.Pending,
+            "created_datetime": now, "expires_datetime": expires
+        })
+        for line in lines:
+            if (await self.items.update_one(take_query(line), take_update(line))).modified_count != 1:
+                await self.release(order_id)
+                raise NotEnoughStock("Недостаточно товара на складе (товар %s)" % line["id"])
+            await self.reservations.update_one(*taken_update(order_id, line))
+        await self.reservations.update_one(
+            {"_id": order_id, "state": ReservationStates.Pending}, {"$set": {"state": ReservationStates.Reserved}}
+        )
+        return expires
+
+    async def reserve_in_transaction(self, order_id: int, items: list, session, now: datetime=None) -> datetime:
+        now = now or datetime.now()
+        lines = reservation_lines(items)
+        if lines:
+            untracked = await self.items.find(untracked_query(lines), {"_id": True}, session=session).to_list(None)
+            lines = tracked_lines(lines, untracked)
+        expires = now + self.ttl
+        await self.reservations.insert_one({
+            "_id": order_id, "lines": lines, "state": ReservationStates.Reserved,
+            "created_datetime": now, "expires_datetime": expires
+        }, session=session)
+        if lines:
+            result = await self.items.bulk_write(
+                [UpdateOne(take_query(line), take_update(line)) for line in lines], ordered=False, session=session
+            )
+            if result.modified_count != len(lines):
+                raise NotEnoughStock()
+        return expires
+
+    async def commit(self, order_id: int) -> bool:
+        result = await self.reservations.update_one(
+            {"_id": order_id, "state": ReservationStates.Reserved}, {"$set": {"state": ReservationStates.Committed}}
+        )
+        return result.modified_count == 1
+
+    async def release(self, order_id: int) -> bool:
+        reservation = await self.reservations.find_one_and_update(
+            {"_id": order_id, "state": {"$in": ACTIVE_RESERVATION_STATES}},
+            {"$set": {"state": ReservationStates.Released}}
+        )
+        if not reservation:
+            return False
+        for line in released_lines(reservation):
+            await self.items.update_one({"_id": line["id"]}, return_update(line))
+        return True
+
+    async def release_expired(self, now: datetime=None, limit: int=1000) -> [int]:
+        expired = await self.reservations.find(
+            {"state": {"$in": ACTIVE_RESERVATION_STATES}, "expires_datetime": {"$lte": now or datetime.now()}},
+            {"_id": True}
+        ).sort([("expires_datetime", ASCENDING)]).to_list(limit)
+        return [reservation["_id"] for reservation in expired if await self.release(reservation["_id"])]
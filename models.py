@@ -1,39 +1,146 @@
 """ Модели """
 
 import re
+import json
+import base64
+import calendar
+import hashlib
 from exceptions import *
-from elasticsearch import Elasticsearch
 from datetime import datetime
-from pymongo import MongoClient, DESCENDING, ASCENDING
-from pymongo.errors import DuplicateKeyError
+from pymongo import DESCENDING, ASCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from typing import Optional
+from allocators import BlockIdAllocator
+from clients import (
+    LazyClient, LazyMongoClient, create_es_client, catalog_read_preference, routed, transactions_enabled
+)
+from cache import LRUCache, ResponseCache, create_cache_backend
+from inventory import Inventory
+from order_states import OrderStates, OrderStatesNames, OPEN_ORDER_STATES
+from bestsellers import BESTSELLERS_WINDOWS, BESTSELLERS_DEFAULT_WINDOW, BESTSELLERS_SORT, bestsellers_query
+from search import ITEMS_ALIAS, AUTOCOMPLETE_SIZE, SearchQueue, autocomplete_query
+from facets import (
+    FACET_FIELDS_PROJECTION, FACETS_SORT, FacetCounts, facet_changes, merge_changes, parse_attribute_filters,
+    attribute_filters_query, attribute_number, facets_query, group_facets
+)
 
 
-mongo_client = MongoClient('mongo', 27017)
-es_client = Elasticsearch([{'host': 'elasticsearch', 'port': 9200}])
+# Клиенты создаются при первом запросе в каждом процессе, настройки - из окружения (см. clients.py)
+mongo_client = LazyMongoClient()
+es_client = LazyClient(create_es_client)
+id_allocator = BlockIdAllocator(mongo_client.db.counters, block_size=100)
+
+# Кэш ответов контроллеров: ответы в памяти процесса, версии тегов - в mongodb, поэтому инвалидация видна
+# всем воркерам (RESPONSE_CACHE_BACKEND, см. cache.create_cache_backend)
+response_cache = ResponseCache(create_cache_backend(mongo_client.db.response_cache))
+
+# Резервы остатков товаров под заказы (см. inventory.py)
+inventory = Inventory(mongo_client.db.items, mongo_client.db.reservations)
+
+
+# Список исключаемых товаров в get_items - только для небольших наборов, листать каталог нужно курсором
+MAX_EXCEPT_IDS = 100
+
+# Поля товара, необходимые для вычисления запрошенного поля в Item.get_data
+ITEM_FIELDS_DEPENDENCIES = {
+    "img": ["imgs"], "cost_with_discount": ["cost", "discount"], "attributes": ["categories"]
+}
+
+# Аттрибуты, доступные товарам всех рубрик: поле categories отсутствует или null - то же правило, что и
+# в AttributeScheme.is_available_for. Пустой список AttributeScheme.get_data сохраняет как null, поэтому условие
+# выполняется по индексу categories (старые схемы с пустым списком исправляет normalize-attribute-categories.py)
+COMMON_ATTRIBUTES_QUERY = {"categories": None}
+
+# Максимальное количество товаров в одном запросе get_items_by_ids
+MAX_ITEMS_BY_IDS = 200
 
 
 def _insert_inc(doc: dict, collection) -> int:
-    """ Вставляет новый документ в коллекцию , генерируя инкрементный ключ - привет mongodb...
+    """ Вставляет новый документ в коллекцию, получая инкрементный ключ у генератора идентификаторов
     :param doc: Документ для вставки в коллекцию (без указания _id)
     :param collection: Коллекция для вставки
     :return:
     """
-    while True:
-        cursor = collection.find({}, {"_id": 1}).sort([("_id", DESCENDING)]).limit(1)
-        try:
-            doc["_id"] = next(cursor)["_id"] + 1
-        except StopIteration:
-            doc["_id"] = 1
-        try:
-            doc["id"] = doc["_id"]
-            collection.insert_one(doc)
-            break
-        except DuplicateKeyError:
-            pass
+    doc["_id"] = doc["id"] = id_allocator.next_id(collection)
+    collection.insert_one(doc)
     return doc["_id"]
 
 
+def item_projection(fields: list=None) -> Optional[dict]:
+    """ Возвращает проекцию mongodb для запрошенных полей товара (вместе с полями, из которых они вычисляются)
+    :param fields:
+    :return:
+    """
+    if not fields:
+        return None
+    projection = {"_id": True}
+    for field in fields:
+        projection[field] = True
+        for dependency in ITEM_FIELDS_DEPENDENCIES.get(field, []):
+            projection[dependency] = True
+    return projection
+
+
+def items_query(category: str=None, except_ids: list=None, cursor: str=None, attributes=None) -> dict:
+    """ Возвращает фильтр выборки страницы товаров каталога
+    :param category:
+    :param except_ids:
+    :param cursor:
+    :param attributes: Фильтр по аттрибутам {id аттрибута: условие} (см. facets.py)
+    :return:
+    """
+    params = attribute_filters_query(parse_attribute_filters(attributes))
+    if category:
+        params["categories"] = category
+    if cursor:
+        params["_id"] = {"$lt": decode_cursor(cursor).get("id")}
+    if except_ids:
+        if len(except_ids) > MAX_EXCEPT_IDS:
+            raise TooManyExceptIds()
+        params.setdefault("_id", {})["$nin"] = except_ids
+    return params
+
+
+def bestsellers_projection(fields: list=None) -> dict:
+    """ Возвращает проекцию выборки рейтинга продаж для запрошенных полей товара
+    :param fields:
+    :return:
+    """
+    projection = {"_id": False, "item_id": True, "quantity": True}
+    projection.update({"item.%s" % field: True for field in fields} if fields else {"item": True})
+    return projection
+
+
+def parse_fields(fields) -> Optional[list]:
+    """ Возвращает список запрошенных полей товара из параметра запроса (список или строка через запятую)
+    :param fields:
+    :return:
+    """
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+    return fields or None
+
+
+def encode_cursor(position: dict) -> str:
+    """ Кодирует позицию последнего показанного товара в непрозрачный курсор пагинации
+    :param position:
+    :return:
+    """
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> dict:
+    """ Возвращает позицию последнего показанного товара из курсора пагинации
+    :param cursor:
+    :return:
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return {key: int(value) for key, value in position.items()}
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise IncorrectCursor()
+
+
 ################################################# Catalog ###########################################################
 
 class Catalog(object):
@@ -43,89 +150,327 @@ class Catalog(object):
         self.items = self.client.db.items
         self.categories = self.client.db.categories
         self.attributes = self.client.db.attributes
+        self.bestsellers = self.client.db.bestsellers
+        self.attribute_schemes = LRUCache(maxsize=1024, ttl=300)
+        self.search_queue = SearchQueue(self.client.db.search_queue)
+        self.facets = FacetCounts(self.client.db.facets)
+        # Изменения рубрик из других процессов становятся видны не позже чем через ttl
+        self.categories_cache = LRUCache(maxsize=1, ttl=60)
+        self.read_preference = catalog_read_preference()
+
+    def reader(self, collection):
+        """ Возвращает коллекцию для чтения каталога: с реплик, если запрос не требует чтения с primary
+        :param collection:
+        :return:
+        """
+        return routed(collection, self.read_preference)
 
-    def get_item(self, item_id: int) -> 'Item':
+    def get_item(self, item_id: int, fields: list=None) -> 'Item':
         """ Возвращает товар из коллекции по его идентификатору
         :param item_id:
+        :param fields: Поля товара, которые нужно загрузить (по умолчанию - все)
         :return:
         """
-        item_data = self.items.find_one({"_id": int(item_id)})
+        item_data = self.reader(self.items).find_one({"_id": int(item_id)}, item_projection(fields))
         if not item_data:
             raise ItemNotFound()
+        if fields and "attributes" not in fields:
+            return self.build_item(item_data, {})
+        return self.build_item(item_data)
+
+    def get_items_map(self, item_ids: list, fields: list=None) -> dict:
+        """ Возвращает словарь {id: товар} для списка идентификаторов одним запросом к коллекции товаров,
+        схемы аттрибутов всех товаров также загружаются одним запросом
+        :param item_ids:
+        :param fields: Поля товара, которые нужно загрузить (по умолчанию - все)
+        :return:
+        """
+        items_data = list(self.reader(self.items).find(
+            {"_id": {"$in": list({int(item_id) for item_id in item_ids})}}, item_projection(fields)
+        ))
+        attribute_schemes = self.get_attribute_schemes([
+            attribute.get("id") for item_data in items_data for attribute in item_data.get("attributes") or []
+        ])
+        return {item_data.get("_id"): self.build_item(item_data, attribute_schemes) for item_data in items_data}
+
+    def get_items_by_ids(self, item_ids: list, fields: list=None) -> [dict]:
+        """ Возвращает данные товаров в порядке запрошенных идентификаторов,
+        вместо отсутствующих товаров - маркер с ошибкой ItemNotFound
+        :param item_ids:
+        :param fields: Поля товара, которые нужно вернуть (по умолчанию - все)
+        :return:
+        """
+        if len(item_ids) > MAX_ITEMS_BY_IDS:
+            raise TooManyItemIds()
+        item_ids = [int(item_id) for item_id in item_ids]
+        items = self.get_items_map(item_ids, fields)
+        return [
+            items[item_id].get_data(fields) if item_id in items else
+            {"id": item_id, "error": {"code": ItemNotFound.code, "message": ItemNotFound.msg}}
+            for item_id in item_ids
+        ]
+
+    @staticmethod
+    def build_item(item_data: dict, attribute_schemes: dict=None) -> 'Item':
+        """ Собирает объект товара из словаря с данными
+        :param item_data:
+        :param attribute_schemes: Заранее загруженные схемы аттрибутов {id: AttributeScheme}
+        :return:
+        """
         item = Item()
         item.id = item_data.get("_id")
         item.article = item_data.get("article")
         item.title = item_data.get("title")
         item.short = item_data.get("short")
         item.body = item_data.get("body")
-        item.imgs = item_data.get("imgs")
+        item.imgs = item_data.get("imgs") or []
         item.tags = item_data.get("tags")
         item.categories = item_data.get("categories")
         item.cost = item_data.get("cost")
         item.discount = item_data.get("discount")
         item.quantity = item_data.get("quantity")
-        item.set_attributes(item_data.get("attributes"))
+        item.set_attributes(item_data.get("attributes"), attribute_schemes)
         return item
 
     def save_item(self, item: 'Item') -> int:
-        """ Сохраняет товар в коллекции и возвращает его _id
+        """ Сохраняет товар в коллекции и возвращает его _id, счетчики фасетов изменяются на разницу
+        между прежним (его возвращает само обновление) и новым состоянием товара
         :param item:
         :return:
         """
+        data = item.get_data()
         if item.id:
-            self.items.update_one({"_id": item.id}, {"$set": item.get_data()})
-            return item.id
+            old_data = self.items.find_one_and_update({"_id": item.id}, {"$set": data}, FACET_FIELDS_PROJECTION)
+            if old_data:
+                self.facets.apply(facet_changes(old_data, data))
         else:
-            return _insert_inc(item.get_data(), self.items)
+            item.id = _insert_inc(data, self.items)
+            self.facets.apply(facet_changes(None, data))
+        self.search_queue.push(item.id, "index")
+        response_cache.invalidate(["items", "item:%s" % item.id])
+        return item.id
 
     def delete_item(self, post_id: int) -> bool:
         """ Удаляет товар из коллекции
         :param post_id:
         :return:
         """
-        result = self.items.delete_one({"_id": int(post_id)})
-        return result.deleted_count == 1
-
-    def get_items(self, category: str=None, slug: str=None, quantity: int=None, except_ids: list=None):
+        old_data = self.items.find_one_and_delete({"_id": int(post_id)}, FACET_FIELDS_PROJECTION)
+        if old_data:
+            self.facets.apply(facet_changes(old_data, None))
+            self.search_queue.push(post_id, "delete")
+            response_cache.invalidate(["items", "item:%s" % post_id])
+        return old_data is not None
+
+    def upsert_items(self, items: ['Item']) -> (list, list, dict):
+        """ Сохраняет пачку товаров по артикулу одним bulk-запросом: товары с существующим артикулом обновляются,
+        остальные создаются. Очередь поиска и кэш ответов не обновляются - при импорте это делается один раз
+        для всех пачек
+        :param items: Товары с заполненными неповторяющимися артикулами
+        :return: Идентификаторы созданных и обновленных товаров, ошибки записи {индекс товара: сообщение}
+        """
+        existing = {
+            item_data["article"]: item_data
+            for item_data in self.items.find(
+                {"article": {"$in": [item.article for item in items]}}, dict(FACET_FIELDS_PROJECTION, article=True)
+            )
+        }
+        requests, datas = [], []
+        for item in items:
+            data = item.get_data()
+            del data["_id"], data["id"]
+            datas.append(data)
+            if item.article in existing:
+                item.id = existing[item.article]["_id"]
+                requests.append(UpdateOne({"_id": item.id}, {"$set": data}))
+            else:
+                item.id = id_allocator.next_id(self.items)
+                requests.append(UpdateOne(
+                    {"article": item.article}, {"$set": data, "$setOnInsert": {"_id": item.id, "id": item.id}},
+                    upsert=True
+                ))
+        try:
+            result = self.items.bulk_write(requests, ordered=False)
+            upserted, errors = result.upserted_ids, {}
+        except BulkWriteError as e:
+            upserted = {upsert["index"]: upsert["_id"] for upsert in e.details.get("upserted", [])}
+            errors = {error["index"]: error.get("errmsg") for error in e.details.get("writeErrors", [])}
+        # Товары, созданные другим процессом между поиском и записью, обновлены по артикулу с другим _id
+        raced = [
+            index for index, item in enumerate(items)
+            if item.article not in existing and index not in upserted and index not in errors
+        ]
+        if raced:
+            ids = {
+                item_data["article"]: item_data["_id"]
+                for item_data in self.items.find(
+                    {"article": {"$in": [items[index].article for index in raced]}}, {"article": True}
+                )
+            }
+            for index in raced:
+                items[index].id = ids.get(items[index].article)
+        created = [item.id for index, item in enumerate(items) if index in upserted]
+        updated = [item.id for index, item in enumerate(items) if index not in upserted and index not in errors]
+        # Прежнее состояние товаров, созданных другим процессом, неизвестно - их счетчики исправит rebuild-facets.py
+        changes = {}
+        for index, item in enumerate(items):
+            if index in upserted:
+                merge_changes(changes, facet_changes(None, datas[index]))
+            elif index not in errors and item.article in existing:
+                merge_changes(changes, facet_changes(existing[item.article], datas[index]))
+        self.facets.apply(changes)
+        return created, updated, errors
+
+    def get_items(
+            self, category: str=None, slug: str=None, quantity: int=None, except_ids: list=None, fields: list=None,
+            attributes=None
+    ):
         """ Возвращает товары из указанных категорий в указанном количестве
         :param category:
         :param slug:
         :param quantity:
         :param except_ids:
+        :param fields:
+        :param attributes:
         :return:
         """
-        if not category and slug:
-            category = self.categories.find_one({"slug": slug})
-            category = category.get("name") if category else None
-        params = {}
-        if category:
-            params["categories"] = category
-        if except_ids:
-            params["_id"] = {"$nin": except_ids}
-        return list(self.items.find(params, {"body": False}).sort([("_id", DESCENDING)]).limit(quantity or 10))
-
-    def get_bestsellers(self, category: str=None, slug: str=None, quantity: int=None, except_ids: list=None):
+        return self.get_items_page(category, slug, quantity, except_ids, fields=fields, attributes=attributes)[0]
+
+    def get_items_page(
+            self, category: str=None, slug: str=None, quantity: int=None, except_ids: list=None, cursor: str=None,
+            fields: list=None, attributes=None
+    ) -> (list, Optional[str]):
+        """ Возвращает страницу товаров из указанных категорий и курсор для получения следующей страницы.
+        Товары упорядочены по убыванию _id: новые раньше старых, но товары, одновременно созданные разными воркерами,
+        могут чередоваться (идентификаторы выдаются блоками, см. allocators.BlockIdAllocator)
+        :param category:
+        :param slug:
+        :param quantity:
+        :param except_ids: Небольшой список исключаемых товаров (не более MAX_EXCEPT_IDS)
+        :param cursor: Курсор, полученный вместе с предыдущей страницей
+        :param fields: Поля товаров, которые нужно вернуть (по умолчанию - все, кроме body)
+        :param attributes: Фильтр по аттрибутам {id аттрибута: значение, список значений или {"from", "to"}}
+        :return:
+        """
+        category = self.resolve_category(category, slug)
+        quantity = int(quantity or 10)
+        params = items_query(category, except_ids, cursor, attributes)
+        projection = item_projection(fields) or {"body": False}
+        items = list(
+            self.reader(self.items).find(params, projection).sort([("_id", DESCENDING)]).limit(quantity + 1)
+        )
+        next_cursor = encode_cursor({"id": items[quantity - 1]["_id"]}) if len(items) > quantity else None
+        return self.select_fields(items[:quantity], fields), next_cursor
+
+    def select_fields(self, items_data: list, fields: list=None) -> [dict]:
+        """ Оставляет в данных товаров страницы только запрошенные поля (как get_item): вычисляемые поля
+        считаются, а _id и поля, загруженные только для вычисления, убираются
+        :param items_data:
+        :param fields: Поля товаров (по умолчанию данные возвращаются как есть)
+        :return:
+        """
+        if not fields:
+            return items_data
+        attribute_schemes = self.get_attribute_schemes([
+            attribute.get("id") for item_data in items_data for attribute in item_data.get("attributes") or []
+        ]) if "attributes" in fields else {}
+        return [self.build_item(item_data, attribute_schemes).get_data(fields) for item_data in items_data]
+
+    def get_bestsellers(
+            self, category: str=None, slug: str=None, quantity: int=None, except_ids: list=None, fields: list=None,
+            window: str=None
+    ):
         """ Возвращает лучшие товары из каталога
         :param category:
         :param slug:
         :param quantity:
         :param except_ids:
+        :param fields:
+        :param window:
         :return:
         """
-        return self.get_items(category, slug, quantity, except_ids)
+        return self.get_bestsellers_page(category, slug, quantity, except_ids, fields=fields, window=window)[0]
+
+    def get_bestsellers_page(
+            self, category: str=None, slug: str=None, quantity: int=None, except_ids: list=None, cursor: str=None,
+            fields: list=None, window: str=None
+    ) -> (list, Optional[str]):
+        """ Возвращает страницу лучших товаров из предрассчитанного рейтинга продаж и курсор для следующей страницы,
+        пока рейтинг пуст (не было продаж или пересчета) - возвращает новинки каталога
+        :param category:
+        :param slug:
+        :param quantity:
+        :param except_ids:
+        :param cursor:
+        :param fields:
+        :param window: Окно рейтинга из BESTSELLERS_WINDOWS
+        :return:
+        """
+        position = decode_cursor(cursor) if cursor else None
+        if position and "quantity" not in position:
+            return self.get_items_page(category, slug, quantity, except_ids, cursor, fields)
+        category = self.resolve_category(category, slug)
+        quantity = int(quantity or 10)
+        if except_ids and len(except_ids) > MAX_EXCEPT_IDS:
+            raise TooManyExceptIds()
+        window = window if window in BESTSELLERS_WINDOWS else BESTSELLERS_DEFAULT_WINDOW
+        bestsellers = list(self.reader(self.bestsellers).find(
+            bestsellers_query(window, category, position, except_ids), bestsellers_projection(fields)
+        ).sort(BESTSELLERS_SORT).limit(quantity + 1))
+        if not bestsellers and not position:
+            return self.get_items_page(category, None, quantity, except_ids, None, fields)
+        next_cursor = None
+        if len(bestsellers) > quantity:
+            last = bestsellers[quantity - 1]
+            next_cursor = encode_cursor({"id": last["item_id"], "quantity": last["quantity"]})
+        return [bestseller.get("item", {}) for bestseller in bestsellers[:quantity]], next_cursor
+
+    def get_facets(self, category: str=None, slug: str=None) -> [dict]:
+        """ Возвращает значения аттрибутов товаров рубрики с количеством товаров для каждого значения
+        :param category: Рубрика (по умолчанию - весь каталог)
+        :param slug:
+        :return:
+        """
+        facets_data = list(self.reader(self.facets.facets).find(
+            facets_query(self.resolve_category(category, slug)), {"_id": False}
+        ).sort(FACETS_SORT))
+        attribute_schemes = self.get_attribute_schemes([facet_data["attribute_id"] for facet_data in facets_data])
+        return group_facets(facets_data, attribute_schemes)
+
+    def resolve_category(self, category: str=None, slug: str=None) -> Optional[str]:
+        """ Возвращает название категории, при необходимости находя его по slug
+        :param category:
+        :param slug:
+        :return:
+        """
+        if not category and slug:
+            category = self.reader(self.categories).find_one({"slug": slug})
+            category = category.get("name") if category else None
+        return category
 
     def get_categories(self):
         """ Возвращает список рубрик блога
         :return:
         """
-        return [Category(c).get_data() for c in self.categories.find({})]
+        return self.get_categories_tree().categories
+
+    def get_categories_tree(self) -> 'CategoriesTree':
+        """ Возвращает дерево рубрик из процессного кэша, при его отсутствии загружает и сериализует дерево
+        :return:
+        """
+        categories_tree = self.categories_cache.get("tree")
+        if categories_tree is None:
+            categories = self.reader(self.categories).find({})
+            categories_tree = CategoriesTree([Category(c).get_data() for c in categories])
+            self.categories_cache.set("tree", categories_tree)
+        return categories_tree
 
     def get_category(self, category_slug: str) -> 'Category':
         """ Возвращает рубрику из коллекции по ее идентификатору
         :param category_slug:
         :return:
         """
-        category_data = self.categories.find_one({"slug": category_slug})
+        category_data = self.reader(self.categories).find_one({"slug": category_slug})
         if not category_data:
             raise CategoryNotFound()
         return Category(category_data)
@@ -140,25 +485,59 @@ class Catalog(object):
             raise NoNameForNewCategory()
         try:
             self.categories.insert_one({"_id": slug, "slug": slug, "name": category_name})
-            return True
         except DuplicateKeyError:
             raise CategoryAlreadyExists()
+        self.categories_cache.clear()
+        response_cache.invalidate(["categories"])
+        return True
 
     def get_attributes(self, categories: list=None) -> ['AttributeScheme']:
         """ Возвращает список аттрибутов, специфичных для блога
         :param categories:
         :return:
         """
-        return \
-            [AttributeScheme(a) for a in self.attributes.find({"categories": {"$exists": False}})] + \
-            ([AttributeScheme(a) for a in self.attributes.find({"categories": categories})] if categories else [])
+        key = ("categories", repr(categories) if categories else None)
+        attribute_schemes = self.attribute_schemes.get(key)
+        if attribute_schemes is None:
+            attributes = self.reader(self.attributes)
+            attribute_schemes = \
+                [AttributeScheme(a) for a in attributes.find(COMMON_ATTRIBUTES_QUERY)] + \
+                ([AttributeScheme(a) for a in attributes.find({"categories": categories})] if categories else [])
+            self.attribute_schemes.set(key, attribute_schemes)
+            for attribute_scheme in attribute_schemes:
+                self.attribute_schemes.set(attribute_scheme.id, attribute_scheme)
+        return attribute_schemes
 
     def get_attribute_scheme(self, attribute_scheme_id) -> 'AttributeScheme':
         """ Возвращает аттрибут по его идентификатору
         :param attribute_scheme_id:
         :return:
         """
-        return AttributeScheme(self.attributes.find_one({"_id": attribute_scheme_id}))
+        attribute_scheme = self.attribute_schemes.get(attribute_scheme_id)
+        if attribute_scheme is None:
+            attribute_scheme = AttributeScheme(self.reader(self.attributes).find_one({"_id": attribute_scheme_id}))
+            self.attribute_schemes.set(attribute_scheme.id, attribute_scheme)
+        return attribute_scheme
+
+    def get_attribute_schemes(self, attribute_scheme_ids: list) -> dict:
+        """ Возвращает словарь {id: схема аттрибута} для списка идентификаторов,
+        недостающие в кэше схемы загружаются одним запросом
+        :param attribute_scheme_ids:
+        :return:
+        """
+        result, missing = {}, []
+        for attribute_scheme_id in set(attribute_scheme_ids):
+            attribute_scheme = self.attribute_schemes.get(attribute_scheme_id)
+            if attribute_scheme is None:
+                missing.append(attribute_scheme_id)
+            else:
+                result[attribute_scheme_id] = attribute_scheme
+        if missing:
+            for a in self.reader(self.attributes).find({"_id": {"$in": missing}}):
+                attribute_scheme = AttributeScheme(a)
+                self.attribute_schemes.set(attribute_scheme.id, attribute_scheme)
+                result[attribute_scheme.id] = attribute_scheme
+        return result
 
     def save_attribute_scheme(self, attribute_scheme: 'AttributeScheme'):
         """ Сохраняет новый тип аттрибута
@@ -168,31 +547,20 @@ class Catalog(object):
         if attribute_scheme.id:
             self.attributes.update_one({"_id": attribute_scheme.id}, {"$set": attribute_scheme.get_data()})
         else:
-            _insert_inc(attribute_scheme.get_data(), self.attributes)
+            attribute_scheme.id = _insert_inc(attribute_scheme.get_data(), self.attributes)
+        # Меняется и сама схема, и выборки по категориям, в которые она входит
+        self.attribute_schemes.clear()
+        response_cache.invalidate(["attributes"])
 
-    def autocomplete(self, term: str):
+    def autocomplete(self, term: str, size: int=AUTOCOMPLETE_SIZE):
         """ Подсказки для поиска товаров по каталогу
         :param term:
+        :param size:
         :return:
         """
-        q = {
-            "size": 2000,
-            "query": {
-                "bool": {
-                    "should": [
-                        {
-                            "wildcard": {
-                                "title": {
-                                    "value": "*%s*" % single_term
-                                }
-                            }
-                        }
-                        for single_term in term.strip().split(" ") if len(single_term.strip())
-                    ]
-                }
-            }
-        }
-        result = es_client.search(index="items", body=q)
+        if not term or not term.strip():
+            return []
+        result = es_client.search(index=ITEMS_ALIAS, body=autocomplete_query(term.strip(), size))
         result = [
             {"id": int(m.get("_id")), "title": m.get("_source").get("title")}
             for m in result.get("hits").get("hits")
@@ -208,6 +576,7 @@ class AttributeScheme(object):
         self.id = int(data.get("_id"))
         self.name = data.get("name")
         self.regex = data.get("regex")
+        self.pattern = re.compile(self.regex) if self.regex else None
         self.mask = data.get("mask")
         self.options = data.get("options")
         self.categories = data.get("categories")
@@ -217,7 +586,7 @@ class AttributeScheme(object):
         """ Возвращает данные аттрибута в виде словаря """
         return {
             "_id": self.id, "id": self.id, "name": self.name,
-            "options": self.options, "categories": self.categories,
+            "options": self.options, "categories": self.categories or None,
             "regex": self.regex, "mask": self.mask
         }
 
@@ -227,20 +596,31 @@ class AttributeScheme(object):
         """
         self.catalog.save_attribute_scheme(self)
 
+    def is_available_for(self, categories) -> bool:
+        """ Проверяет, доступен ли аттрибут товарам из указанных категорий (как и выборка в Catalog.get_attributes)
+        :param categories:
+        :return:
+        """
+        if not self.categories:
+            return True
+        if not categories:
+            return False
+        return self.categories == categories or (isinstance(self.categories, list) and categories in self.categories)
+
 
 class Attribute(object):
     """ Класс для работы с аттрибутами товаров """
-    def __init__(self, data):
+    def __init__(self, data, attribute_scheme: AttributeScheme=None):
         self.catalog = catalog
         self.id = data.get("id")
 
-        self.attribute_scheme = self.catalog.get_attribute_scheme(self.id)
+        self.attribute_scheme = attribute_scheme or self.catalog.get_attribute_scheme(self.id)
         self.name = self.attribute_scheme.name
         if self.attribute_scheme.options and data.get("value") not in self.attribute_scheme.options:
             raise IncorrectValueForAttribute(
                 "'%s' - некорректное значение для свойства '%s'" % (data.get("value"), self.name)
             )
-        elif self.attribute_scheme.regex and not re.match(self.attribute_scheme.regex, data.get("value")):
+        elif self.attribute_scheme.pattern and not self.attribute_scheme.pattern.match(data.get("value")):
             raise IncorrectValueForAttribute(
                 "'%s' - некорректное значение для свойства '%s'" % (data.get("value"), self.name)
             )
@@ -252,7 +632,12 @@ class Attribute(object):
         Возвращает данные для сохранения в бд
         :return:
         """
-        return {"id": self.id, "name": self.name, "value": self.value}
+        data = {"id": self.id, "name": self.name, "value": self.value}
+        # Числовое значение - для фильтров по диапазону (см. facets.py)
+        number = attribute_number(self.value)
+        if number is not None:
+            data["number"] = number
+        return data
 
 
 class Category(object):
@@ -276,6 +661,16 @@ class Category(object):
         }
 
 
+class CategoriesTree(object):
+    """ Сериализованное дерево рубрик для отдачи из кэша без повторного кодирования """
+    def __init__(self, categories: list):
+        self.categories = categories
+        payload = json.dumps(categories)
+        self.etag = hashlib.sha1(payload.encode()).hexdigest()
+        self.json = '{"categories": %s, "etag": "%s"}' % (payload, self.etag)
+        self.not_modified_json = json.dumps({"not_modified": True, "etag": self.etag})
+
+
 class Item(object):
     """ Модель для работы с товаром """
     def __init__(self):
@@ -308,15 +703,21 @@ class Item(object):
         """
         return (self.cost - int(self.cost * (self.discount/100))) if self.discount else self.cost
 
-    def set_attributes(self, income_attributes: list):
+    def set_attributes(self, income_attributes: list, attribute_schemes: dict=None):
         """ Сохраняет аттрибуты товара согласно существующей схеме
         :param income_attributes:
+        :param attribute_schemes: Заранее загруженные схемы аттрибутов {id: AttributeScheme}, чтобы не обращаться к бд
         :return:
         """
-        available_attributes = [a.id for a in self.catalog.get_attributes(self.categories)]
+        if attribute_schemes is None:
+            available_attributes = {a.id: a for a in self.catalog.get_attributes(self.categories)}
+        else:
+            available_attributes = {
+                a.id: a for a in attribute_schemes.values() if a.is_available_for(self.categories)
+            }
         self.attributes = [
-            Attribute(income_attribute_data)
-            for income_attribute_data in income_attributes
+            Attribute(income_attribute_data, available_attributes[income_attribute_data.get("id")])
+            for income_attribute_data in income_attributes or []
             if income_attribute_data.get("id") in available_attributes
         ]
 
@@ -334,11 +735,12 @@ class Item(object):
         self.validate()
         return self.catalog.save_item(self)
 
-    def get_data(self):
+    def get_data(self, fields: list=None):
         """ Возвращает словарь с данными из модели поста для записи в БД
+        :param fields: Поля, которые нужно вернуть (по умолчанию - все)
         :return:
         """
-        return {
+        data = {
             "_id": self.id, "id": self.id, "article": self.article,
             "title": self.title, "short": self.short, "body": self.body,
             "imgs": self.imgs, "img": self.img,
@@ -346,6 +748,7 @@ class Item(object):
             "cost": self.cost, "discount": self.discount, "quantity": self.quantity,
             "attributes": [a.get_data() for a in self.attributes], "cost_with_discount": self.cost_with_discount
         }
+        return {k: v for k, v in data.items() if k in fields} if fields else data
 
 
 ################################################ Customers #########################################################
@@ -365,8 +768,8 @@ class Customers(object):
         try:
             self.get_customer(customer_id)
         except CustomerNotFound:
-            cart = Carts().get_cart()
-            wishlist = Carts().get_cart()
+            cart = carts.get_cart()
+            wishlist = carts.get_cart()
             customer = Customer()
             customer.name = None
             customer.cart_id = cart.id
@@ -381,6 +784,14 @@ class Customers(object):
         customer_data = self.customers.find_one({"_id": int(customer_id)})
         if not customer_data:
             raise CustomerNotFound()
+        return self.build_customer(customer_data)
+
+    @staticmethod
+    def build_customer(customer_data: dict) -> 'Customer':
+        """ Собирает объект покупателя из словаря с данными
+        :param customer_data:
+        :return:
+        """
         customer = Customer()
         customer.id = customer_data.get("_id")
         customer.name = customer_data.get("name")
@@ -445,6 +856,46 @@ class Customer(object):
 ################################################## Carts ############################################################
 
 
+# Стадия конвейерного обновления, пересчитывающая итоги корзины по ее позициям
+CART_TOTALS_STAGE = {"$set": {"quantity": {"$sum": "$items.quantity"}, "total_cost": {"$sum": "$items.cost"}}}
+CART_CLEAR_UPDATE = {"$set": {"items": [], "quantity": 0, "total_cost": 0}}
+
+
+def cart_push_update(item_in_cart: 'ItemInCart') -> dict:
+    """ Обновление, добавляющее позицию в корзину с увеличением итогов
+    :param item_in_cart:
+    :return:
+    """
+    return {
+        "$push": {"items": item_in_cart.get_data()},
+        "$inc": {"quantity": item_in_cart.quantity, "total_cost": item_in_cart.cost}
+    }
+
+
+def cart_pull_update(item_id: int) -> list:
+    """ Конвейерное обновление, удаляющее товар из корзины с пересчетом итогов
+    :param item_id:
+    :return:
+    """
+    return [
+        {"$set": {"items": {"$filter": {"input": "$items", "cond": {"$ne": ["$$this.id", item_id]}}}}},
+        CART_TOTALS_STAGE
+    ]
+
+
+def cart_set_quantity_update(item_in_cart: 'ItemInCart') -> list:
+    """ Конвейерное обновление, заменяющее позицию товара в корзине с пересчетом итогов
+    :param item_in_cart:
+    :return:
+    """
+    return [
+        {"$set": {"items": {"$map": {"input": "$items", "in": {"$cond": [
+            {"$eq": ["$$this.id", item_in_cart.item.id]}, {"$literal": item_in_cart.get_data()}, "$$this"
+        ]}}}}},
+        CART_TOTALS_STAGE
+    ]
+
+
 class Carts(object):
     """ Модель для работы с корзиной покупателя """
     def __init__(self):
@@ -465,11 +916,20 @@ class Carts(object):
             cart_data = {}
         cart = Cart()
         cart.id = cart_data.get("_id")
-        cart.items = [ItemInCart(iicdata) for iicdata in cart_data.get("items")] if cart_data.get("items", []) else []
+        cart.items = self.build_items(cart_data.get("items") or [])
         if new_cart:
             cart.id = self.save_cart(cart)
         return cart
 
+    @staticmethod
+    def build_items(items_data: list) -> ['ItemInCart']:
+        """ Собирает позиции корзины, загружая все товары одним запросом
+        :param items_data:
+        :return:
+        """
+        items = catalog.get_items_map([iicdata.get("id") for iicdata in items_data])
+        return [ItemInCart(iicdata, items.get(int(iicdata.get("id")))) for iicdata in items_data]
+
     def save_cart(self, cart: 'Cart') -> int:
         """ Сохраняет корзину покупателя в коллекции и возвращает ее _id
         :param cart:
@@ -481,6 +941,41 @@ class Carts(object):
         else:
             return _insert_inc(cart.get_data(), self.carts)
 
+    def push_item(self, cart_id: int, item_in_cart: 'ItemInCart'):
+        """ Атомарно добавляет позицию в корзину, увеличивая итоги корзины
+        :param cart_id:
+        :param item_in_cart:
+        :return:
+        """
+        self.carts.update_one({"_id": cart_id}, cart_push_update(item_in_cart))
+
+    def pull_item(self, cart_id: int, item_id: int):
+        """ Атомарно удаляет товар из корзины с пересчетом итогов на стороне сервера
+        :param cart_id:
+        :param item_id:
+        :return:
+        """
+        self.carts.update_one({"_id": cart_id}, cart_pull_update(item_id))
+
+    def set_item_quantity(self, cart_id: int, item_in_cart: 'ItemInCart') -> bool:
+        """ Атомарно меняет количество и стоимость товара в корзине с пересчетом итогов на стороне сервера
+        :param cart_id:
+        :param item_in_cart:
+        :return: False, если такого товара в корзине нет
+        """
+        result = self.carts.update_one(
+            {"_id": cart_id, "items.id": item_in_cart.item.id}, cart_set_quantity_update(item_in_cart)
+        )
+        return result.matched_count == 1
+
+    def clear_cart(self, cart_id: int, session=None):
+        """ Очищает корзину
+        :param cart_id:
+        :param session: Сессия mongodb, если корзина очищается в транзакции
+        :return:
+        """
+        self.carts.update_one({"_id": cart_id}, CART_CLEAR_UPDATE, session=session)
+
 
 carts = Carts()
 
@@ -490,13 +985,14 @@ class Cart(object):
     def __init__(self):
         self.id = None
         self.items = []
+        self.carts = carts
 
     @property
     def total_cost(self):
         """ Общая стоимость корзины
         :return:
         """
-        return int(sum([i.item.cost_with_discount * i.quantity for i in self.items]))
+        return int(sum([i.cost for i in self.items]))
 
     @property
     def quantity(self):
@@ -511,8 +1007,9 @@ class Cart(object):
         :param quantity:
         :return:
         """
-        self.items.append(ItemInCart({"id": item_id, "quantity": quantity}))
-        self.save()
+        item_in_cart = ItemInCart({"id": item_id, "quantity": quantity})
+        self.items.append(item_in_cart)
+        self.carts.push_item(self.id, item_in_cart)
 
     def remove_item(self, item_id: int):
         """ Удаляет товар из корзины
@@ -520,7 +1017,7 @@ class Cart(object):
         :return:
         """
         self.items = [i for i in self.items if i.item.id != item_id]
-        self.save()
+        self.carts.pull_item(self.id, item_id)
 
     def set_quantity_for_item(self, item_id: int, quantity: int):
         """ Меняет количество товара в корзине
@@ -528,21 +1025,26 @@ class Cart(object):
         :param quantity:
         :return:
         """
-        self.remove_item(item_id)
-        self.add_item(item_id, quantity)
+        item = next((i.item for i in self.items if i.item.id == item_id), None)
+        item_in_cart = ItemInCart({"id": item_id, "quantity": quantity}, item)
+        if self.carts.set_item_quantity(self.id, item_in_cart):
+            self.items = [item_in_cart if i.item.id == item_id else i for i in self.items]
+        else:
+            self.items.append(item_in_cart)
+            self.carts.push_item(self.id, item_in_cart)
 
     def clear(self):
         """ Очищает корзину
         :return:
         """
         self.items = []
-        self.save()
+        self.carts.clear_cart(self.id)
 
     def save(self):
-        """ Сохранение покупателя
+        """ Сохранение корзины
         :return:
         """
-        return Carts().save_cart(self)
+        return self.carts.save_cart(self)
 
     def get_data(self):
         """ Возвращает словарь с данными из модели корзины покупателя для записи в БД
@@ -565,10 +1067,10 @@ class Cart(object):
 
 class ItemInCart(object):
     """ Класс для представления позиции в корзине """
-    def __init__(self, data: dict=None):
+    def __init__(self, data: dict=None, item: Item=None):
         if not data:
             data = {}
-        self.item = catalog.get_item(data.get("id"))
+        self.item = item or catalog.get_item(data.get("id"))
         self.quantity = data.get("quantity")
         self.title = self.item.title
         self.cost = self.item.cost_with_discount * self.quantity
@@ -583,13 +1085,91 @@ class ItemInCart(object):
 
 ################################################## Orders ############################################################
 
-class OrderStates(object):
-    """ Статусы заказов """
-    Created = 1
-    InProgress = 2
-    Done = 3
+# Поля заказа в списках невыполненных заказов (без позиций)
+ORDER_SUMMARY_FIELDS = [
+    "customer_id", "created_datetime", "done_datetime", "state", "cost", "quantity", "money_received"
+]
+ORDERS_SORT = [("created_datetime", ASCENDING), ("_id", ASCENDING)]
+
 
-OrderStatesNames = {OrderStates.Created: "Создан", OrderStates.InProgress: "Выполняется", OrderStates.Done: "Выполнен"}
+def datetime_to_ms(value: datetime) -> int:
+    """ Переводит дату в миллисекунды (точность дат mongodb) для курсора пагинации
+    :param value:
+    :return:
+    """
+    return calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+
+
+def parse_order_states(states) -> list:
+    """ Возвращает список статусов заказов из параметра запроса (список или строка через запятую),
+    по умолчанию - статусы невыполненных заказов
+    :param states:
+    :return:
+    """
+    if isinstance(states, str):
+        states = [state for state in states.split(",") if state.strip()]
+    if not states:
+        return OPEN_ORDER_STATES
+    if not isinstance(states, list):
+        states = [states]
+    try:
+        states = [int(state) for state in states]
+    except (TypeError, ValueError):
+        raise IncorrectOrdersFilter()
+    if any(state not in OrderStatesNames for state in states):
+        raise IncorrectOrdersFilter()
+    return states
+
+
+def parse_datetime(value) -> Optional[datetime]:
+    """ Возвращает дату из параметра запроса в формате ISO 8601
+    :param value:
+    :return:
+    """
+    if not value or isinstance(value, datetime):
+        return value or None
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        raise IncorrectOrdersFilter()
+
+
+def orders_query(states: list, created_from: datetime=None, created_to: datetime=None, cursor: str=None) -> dict:
+    """ Возвращает фильтр выборки заказов по статусам и периоду создания
+    (форма запроса обслуживается индексом state_created_datetime_id)
+    :param states:
+    :param created_from:
+    :param created_to:
+    :param cursor: Курсор, полученный вместе с предыдущей страницей
+    :return:
+    """
+    query = {"state": {"$in": states}}
+    if created_from or created_to:
+        query["created_datetime"] = {}
+        if created_from:
+            query["created_datetime"]["$gte"] = created_from
+        if created_to:
+            query["created_datetime"]["$lt"] = created_to
+    if cursor:
+        position = decode_cursor(cursor)
+        if "created" not in position or "id" not in position:
+            raise IncorrectCursor()
+        created = datetime.utcfromtimestamp(position["created"] / 1000)
+        query["$or"] = [
+            {"created_datetime": {"$gt": created}}, {"created_datetime": created, "_id": {"$gt": position["id"]}}
+        ]
+    return query
+
+
+def order_summary(order_data: dict) -> dict:
+    """ Возвращает краткое описание заказа (без позиций) из документа заказа
+    :param order_data:
+    :return:
+    """
+    summary = {"id": order_data.get("_id")}
+    summary.update({field: order_data.get(field) for field in ORDER_SUMMARY_FIELDS})
+    summary["state_name"] = OrderStatesNames.get(summary["state"])
+    return summary
 
 
 class Orders(object):
@@ -597,22 +1177,106 @@ class Orders(object):
     def __init__(self):
         self.client = mongo_client
         self.orders = self.client.db.orders
+        self.transactions = transactions_enabled()
 
     def create_order(self, customer_id: int) -> int:
-        """ Создает новый заказ
+        """ Создает новый заказ из корзины покупателя: заказ собирается в памяти из загруженной корзины
+        и записывается одной вставкой, остатки позиций резервируются, корзина очищается.
+        С MONGO_TRANSACTIONS=1 все записи выполняются в одной транзакции
         :param customer_id:
         :return:
+        :raise CartIsEmpty:
+        :raise NotEnoughStock: Если какой-либо позиции не хватает на складе (заказ не создается)
         """
-        customer = Customers().get_customer(customer_id)
-        cart = Carts().get_cart(customer.cart_id)
+        customer = customers.get_customer(customer_id)
+        cart = carts.get_cart(customer.cart_id)
+        order = self.build_new_order(id_allocator.next_id(self.orders), customer_id, cart)
+        if self.transactions:
+            with self.client.start_session() as session:
+                session.with_transaction(lambda s: self.insert_order(order, cart.id, s))
+        else:
+            self.insert_order(order, cart.id)
+        return order.id
+
+    @staticmethod
+    def build_new_order(order_id: int, customer_id: int, cart: 'Cart') -> 'Order':
+        """ Собирает новый заказ из позиций корзины, не обращаясь к бд
+        :param order_id:
+        :param customer_id:
+        :param cart: Корзина с загруженными товарами
+        :return:
+        :raise CartIsEmpty:
+        """
+        if not cart.items:
+            raise CartIsEmpty()
         order = Order()
-        cart.copy_to(order)
+        order.id = order_id
+        order.items = [ItemInOrder.from_item(iic.item, iic.quantity) for iic in cart.items]
         order.cost = cart.total_cost
         order.quantity = cart.quantity
         order.customer_id = customer_id
         order.created_datetime = datetime.now()
         order.state = OrderStates.Created
-        return self.save_order(order)
+        return order
+
+    def insert_order(self, order: 'Order', cart_id: int, session=None):
+        """ Резервирует товары нового заказа, сохраняет заказ и очищает корзину. Корзина очищается намеренно:
+        заказ уже содержит ее позиции, и повторное оформление той же корзины зарезервировало бы товар еще раз.
+        Если товара не хватает или заказ не записан, корзина остается как была
+        :param order:
+        :param cart_id:
+        :param session: Сессия mongodb с начатой транзакцией (без нее резерв при ошибке снимается вручную)
+        :return:
+        """
+        lines = [iic.get_data() for iic in order.items]
+        if session is not None:
+            inventory.reserve_in_transaction(order.id, lines, session, order.created_datetime)
+            self.orders.insert_one(order.get_data(), session=session)
+        else:
+            inventory.reserve(order.id, lines, order.created_datetime)
+            try:
+                self.orders.insert_one(order.get_data())
+            except Exception:
+                inventory.release(order.id)
+                raise
+        carts.clear_cart(cart_id, session)
+
+    def confirm_order(self, order_id: int) -> 'Order':
+        """ Подтверждает заказ: товар, зарезервированный под заказ, списывается окончательно
+        :param order_id:
+        :return:
+        :raise ReservationExpired: Если резерв заказа снят по истечении срока
+        """
+        order = self.get_order(order_id)
+        if order.state == OrderStates.Expired:
+            raise ReservationExpired()
+        if order.state != OrderStates.Created:
+            return order
+        if not inventory.commit(order.id):
+            raise ReservationExpired()
+        order.state = OrderStates.InProgress
+        self.orders.update_one(
+            {"_id": order.id, "state": OrderStates.Created},
+            {"$set": {"state": order.state, "state_name": order.state_name}}
+        )
+        return order
+
+    def expire_orders(self, now: datetime=None) -> [int]:
+        """ Снимает истекшие резервы и переводит их неподтвержденные заказы в статус "Истек"
+        :param now:
+        :return: Идентификаторы заказов, резервы которых сняты
+        """
+        order_ids = inventory.release_expired(now)
+        if order_ids:
+            # Время истечения нужно пересчету рейтинга продаж: дни истекших заказов пересчитываются заново
+            self.orders.update_many(
+                {"_id": {"$in": order_ids}, "state": OrderStates.Created},
+                {"$set": {
+                    "state": OrderStates.Expired, "state_name": OrderStatesNames[OrderStates.Expired],
+                    "expired_datetime": now or datetime.now()
+                }}
+            )
+        return order_ids
 
     def save_order(self, order: 'Order') -> int:
         """ Сохраняет заказ покупателя в коллекции и возвращает его _id
@@ -637,15 +1301,15 @@ class Orders(object):
 
     @staticmethod
     def build_order(order_data: dict) -> 'Order':
-        """ Собирает объект заказа из словаря с даннами
+        """ Собирает объект заказа из словаря с даннами (позиции хранят снимки товаров, каталог не нужен)
         :param order_data:
         :return:
         """
         order = Order()
         order.id = order_data.get("_id")
-        order.items = [
-            ItemInOrder(iicdata) for iicdata in order_data.get("items")
-        ] if order_data.get("items", []) else []
+        order.items = [ItemInOrder(iicdata) for iicdata in order_data.get("items") or []]
+        order.cost = order_data.get("cost")
+        order.quantity = order_data.get("quantity")
         order.customer_id = order_data.get("customer_id")
         order.created_datetime = order_data.get("created_datetime")
         order.done_datetime = order_data.get("done_datetime")
@@ -654,7 +1318,7 @@ class Orders(object):
         return order
 
     def get_orders_by_customer_id(self, customer_id: int, limit=20) -> ['Order']:
-        """ Возвращает список заказов пользователя
+        """ Возвращает список заказов пользователя одним запросом по индексу customer_id_created_datetime
         :param customer_id:
         :param limit:
         :return:
@@ -662,20 +1326,49 @@ class Orders(object):
         return [
             self.build_order(order_data)
             for order_data in self.orders.find(
-                {"customer_id": int(customer_id)}).limit(limit).sort([("created_dateime", DESCENDING)]
+                {"customer_id": int(customer_id)}).sort([("created_datetime", DESCENDING)]).limit(int(limit)
             )
         ]
 
-    def get_open_orders(self) -> ['Order']:
-        """ Возвращает список невыполненных заказов
+    def get_open_orders_page(
+            self, states=None, created_from=None, created_to=None, quantity: int=None, cursor: str=None
+    ) -> (list, Optional[str]):
+        """ Возвращает страницу кратких описаний заказов (по умолчанию - невыполненных) в порядке создания
+        и курсор для следующей страницы
+        :param states: Статусы заказов
+        :param created_from: Начало периода создания (включительно)
+        :param created_to: Конец периода создания (не включительно)
+        :param quantity:
+        :param cursor:
         :return:
         """
-        return [
-            self.build_order(order_data)
-            for order_data in self.orders.find(
-                {"state": {"$ne": OrderStates.Done}}).sort([("created_dateime", ASCENDING)]
-            )
-        ]
+        quantity = int(quantity or 50)
+        query = orders_query(
+            parse_order_states(states), parse_datetime(created_from), parse_datetime(created_to), cursor
+        )
+        projection = {field: True for field in ORDER_SUMMARY_FIELDS}
+        orders_data = list(self.orders.find(query, projection).sort(ORDERS_SORT).limit(quantity + 1))
+        next_cursor = None
+        if len(orders_data) > quantity:
+            last = orders_data[quantity - 1]
+            next_cursor = encode_cursor({"id": last["_id"], "created": datetime_to_ms(last["created_datetime"])})
+        return [order_summary(order_data) for order_data in orders_data[:quantity]], next_cursor
+
+    def iter_open_orders(self, states=None, created_from=None, created_to=None, batch_size: int=500):
+        """ Отдает краткие описания заказов по мере чтения курсора, не загружая весь список в память
+        :param states:
+        :param created_from:
+        :param created_to:
+        :param batch_size: Количество заказов, получаемых из бд за одно обращение
+        :return:
+        """
+        query = orders_query(parse_order_states(states), parse_datetime(created_from), parse_datetime(created_to))
+        projection = {field: True for field in ORDER_SUMMARY_FIELDS}
+        for order_data in self.orders.find(query, projection).sort(ORDERS_SORT).batch_size(batch_size):
+            yield order_summary(order_data)
+
+
+orders = Orders()
 
 
 class Order(object):
@@ -705,7 +1398,7 @@ class Order(object):
         :param quantity:
         :return:
         """
-        self.items.append(ItemInOrder({"id": item_id, "quantity": quantity}))
+        self.items.append(ItemInOrder.from_item(catalog.get_item(item_id), quantity))
         self.save()
 
     def remove_item(self, item_id: int):
@@ -713,7 +1406,7 @@ class Order(object):
         :param item_id:
         :return:
         """
-        self.items = [i for i in self.items if i.item.id != item_id]
+        self.items = [i for i in self.items if i.id != item_id]
         self.save()
 
     def set_quantity_for_item(self, item_id: int, quantity: int):
@@ -736,7 +1429,7 @@ class Order(object):
         """ Сохранение заказа
         :return:
         """
-        return Orders().save_order(self)
+        return orders.save_order(self)
 
     def get_data(self) -> dict:
         """ Возвращает словарь с данными из модели корзины покупателя для записи в БД
@@ -752,22 +1445,38 @@ class Order(object):
 
 
 class ItemInOrder(object):
-    """ Класс для представления позиции в заказе """
+    """ Класс для представления позиции в заказе: снимок товара на момент оформления (артикул, название,
+    цена со скидкой, аттрибуты), который не меняется вместе с каталогом и читается без обращения к нему
+    """
     def __init__(self, data: dict=None):
         if not data:
             data = {}
         self.id = data.get("id")
+        self.article = data.get("article")
+        self.title = data.get("title")
+        self.price = data.get("price")
         self.quantity = data.get("quantity")
-        if not data.get("cost") and not data.get("title"):
-            item = catalog.get_item(data.get("id"))
-            self.title = item.title
-            self.cost = item.cost_with_discount * self.quantity
-        else:
-            self.title = data.get("title")
-            self.cost = data.get("cost")
+        self.cost = data.get("cost")
+        self.attributes = data.get("attributes") or []
+
+    @classmethod
+    def from_item(cls, item: Item, quantity: int) -> 'ItemInOrder':
+        """ Создает позицию заказа со снимком товара
+        :param item:
+        :param quantity:
+        :return:
+        """
+        return cls({
+            "id": item.id, "article": item.article, "title": item.title, "price": item.cost_with_discount,
+            "quantity": quantity, "cost": item.cost_with_discount * quantity,
+            "attributes": [attribute.get_data() for attribute in item.attributes]
+        })
 
     def get_data(self) -> dict:
         """ Возвращает данные для сохранения в БД
         :return:
         """
-        return {"id": self.id, "title": self.title, "cost": self.cost, "quantity": self.quantity}
+        return {
+            "id": self.id, "article": self.article, "title": self.title, "price": self.price,
+            "quantity": self.quantity, "cost": self.cost, "attributes": self.attributes
+        }
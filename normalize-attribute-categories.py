@@ -0,0 +1,36 @@
+""" Разовая миграция: пустой список рубрик у схем аттрибутов заменяется на null
+
+Запуск: python3 normalize-attribute-categories.py [--dry-run]
+Общие аттрибуты (доступные товарам всех рубрик) выбираются условием COMMON_ATTRIBUTES_QUERY по индексу categories,
+которому соответствуют только отсутствующее поле и null. Схемы, сохраненные до того, как AttributeScheme.get_data
+стал записывать пустой список как null, без миграции перестанут считаться общими. Повторный запуск ничего не меняет.
+"""
+
+import argparse
+from models import mongo_client, response_cache
+
+
+# Схемы аттрибутов с пустым списком рубрик
+EMPTY_CATEGORIES_QUERY = {"categories": {"$size": 0}}
+
+
+def normalize(attributes, dry_run: bool=False) -> int:
+    """ Заменяет пустой список рубрик на null и возвращает количество исправленных схем
+    :param attributes:
+    :param dry_run: Только посчитать схемы, не изменяя их
+    :return:
+    """
+    if dry_run:
+        return attributes.count_documents(EMPTY_CATEGORIES_QUERY)
+    updated = attributes.update_many(EMPTY_CATEGORIES_QUERY, {"$set": {"categories": None}}).modified_count
+    if updated:
+        response_cache.invalidate(["attributes"])
+    return updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать схемы")
+    options = parser.parse_args()
+
+    print("done: %s attribute schemes" % normalize(mongo_client.db.attributes, options.dry_run))
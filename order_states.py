@@ -0,0 +1,15 @@
+""" Статусы заказов (отдельно от models, чтобы их могли использовать модули, которые импортирует сам models) """
+
+
+class OrderStates(object):
+    """ Статусы заказов """
+    Created = 1
+    InProgress = 2
+    Done = 3
+    Expired = 4
+
+OrderStatesNames = {
+    OrderStates.Created: "Создан", OrderStates.InProgress: "Выполняется", OrderStates.Done: "Выполнен",
+    OrderStates.Expired: "Истек"
+}
+OPEN_ORDER_STATES = [OrderStates.Created, OrderStates.InProgress]
@@ -0,0 +1,75 @@
+""" Пересчет счетчиков фасетов (значений аттрибутов по рубрикам) с нуля
+
+Запуск: python3 rebuild-facets.py [--numbers] [--batch-size 500]
+Обычно счетчики изменяются при сохранении и удалении товаров, пересчет нужен для первого заполнения
+и для исправления счетчиков после сбоя (или после импорта, параллельного другим изменениям тех же товаров).
+Изменения товаров во время пересчета могут быть не учтены - их исправит следующий запуск.
+С --numbers сначала дописывает числовые значения аттрибутов (attributes.number) товарам, сохраненным до появления
+фильтров по диапазону.
+"""
+
+import time
+import argparse
+from pymongo import ASCENDING, UpdateOne
+from models import mongo_client
+from facets import FacetCounts, attribute_number
+
+
+def attributes_with_numbers(attributes: list) -> list:
+    """ Возвращает аттрибуты товара с числовыми значениями
+    :param attributes:
+    :return:
+    """
+    result = []
+    for attribute in attributes:
+        attribute = dict(attribute)
+        attribute.pop("number", None)
+        number = attribute_number(attribute.get("value"))
+        if number is not None:
+            attribute["number"] = number
+        result.append(attribute)
+    return result
+
+
+def backfill_numbers(items, batch_size: int, report=print) -> int:
+    """ Дописывает числовые значения аттрибутов пачками и возвращает количество обновленных товаров
+    :param items:
+    :param batch_size:
+    :param report:
+    :return:
+    """
+    updated, last_id, started = 0, None, time.time()
+    while True:
+        query = {"attributes.0": {"$exists": True}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(items.find(query, {"attributes": True}).sort([("_id", ASCENDING)]).limit(batch_size))
+        if not batch:
+            break
+        last_id = batch[-1]["_id"]
+        requests = []
+        for item_data in batch:
+            attributes = attributes_with_numbers(item_data["attributes"])
+            if attributes != item_data["attributes"]:
+                # Условие на прежние аттрибуты не дает перезаписать товар, измененный после чтения пачки
+                requests.append(UpdateOne(
+                    {"_id": item_data["_id"], "attributes": item_data["attributes"]},
+                    {"$set": {"attributes": attributes}}
+                ))
+        if requests:
+            updated += items.bulk_write(requests, ordered=False).modified_count
+        report("numbers: %s items updated, %.1f items/s" % (updated, updated / max(time.time() - started, 0.001)))
+    return updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--numbers", action="store_true", help="дописать числовые значения аттрибутов товаров")
+    parser.add_argument("--batch-size", type=int, default=500)
+    options = parser.parse_args()
+
+    if options.numbers:
+        backfill_numbers(mongo_client.db.items, options.batch_size)
+    started = time.time()
+    total = FacetCounts(mongo_client.db.facets).rebuild(mongo_client.db.items)
+    print("done: %s facet values in %.1f s" % (total, time.time() - started))
@@ -1,11 +1,23 @@
+""" Полная перестройка поискового индекса товаров
 
+Запуск: python3 reindex-elastic-search.py [--batch-size 5000] [--chunk-size 500] [--threads 4] [--restart] [--keep-old]
+Прерванная перестройка по умолчанию продолжается с последнего сохраненного _id.
+"""
 
-
+import argparse
 from models import mongo_client, es_client
+from search import Reindexer
+
 
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--batch-size", type=int, default=5000, help="товаров в одной пачке (и между чекпоинтами)")
+parser.add_argument("--chunk-size", type=int, default=500, help="документов в одном bulk-запросе")
+parser.add_argument("--threads", type=int, default=4, help="параллельных bulk-запросов")
+parser.add_argument("--restart", action="store_true", help="начать заново, не продолжая прерванную перестройку")
+parser.add_argument("--keep-old", action="store_true", help="не удалять предыдущие версии индекса")
+options = parser.parse_args()
 
-catalog_items = mongo_client.db.items
-for item in catalog_items.find({}, {"_id": True, "title": True}):
-    print(item.get("_id"), item.get("title"))
-    es_client.index(index="items", doc_type="item", id=item.get("_id"), body={"title": item.get("title")})
-print("done!")
\ No newline at end of file
+Reindexer(
+    es_client, mongo_client.db.items, mongo_client.db.reindex_checkpoints,
+    batch_size=options.batch_size, chunk_size=options.chunk_size, threads=options.threads
+).run(resume=not options.restart, keep_old=options.keep_old)
@@ -0,0 +1,25 @@
+""" Фоновое снятие истекших резервов товаров
+
+Запуск: python3 release-expired-reservations.py [--interval 60] [--once]
+Резервы неподтвержденных заказов (и резервы, прерванные падением воркера) по истечении срока возвращают товар
+на склад, а сами заказы переводятся в статус "Истек". Повторное снятие резерва ничего не делает, поэтому
+одновременно можно запускать несколько экземпляров.
+"""
+
+import time
+import argparse
+from models import orders
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--interval", type=float, default=60, help="пауза в секундах между проверками")
+parser.add_argument("--once", action="store_true", help="выполнить одну проверку и завершиться")
+options = parser.parse_args()
+
+while True:
+    order_ids = orders.expire_orders()
+    if order_ids:
+        print("released %s reservations: %s" % (len(order_ids), order_ids))
+    if options.once:
+        break
+    time.sleep(options.interval)
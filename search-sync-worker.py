@@ -0,0 +1,21 @@
+""" Фоновая синхронизация поискового индекса с изменениями товаров
+
+Запуск: python3 search-sync-worker.py [--batch-size 500] [--poll-interval 1]
+Сохранение и удаление товаров ставят события в коллекцию search_queue, воркер отправляет их в elasticsearch пачками.
+"""
+
+import argparse
+from models import mongo_client, es_client
+from search import SearchSyncWorker
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--batch-size", type=int, default=500, help="событий в одном bulk-запросе")
+parser.add_argument("--poll-interval", type=float, default=1, help="пауза в секундах, если очередь пуста")
+parser.add_argument("--max-backoff", type=float, default=300, help="максимальная задержка повтора в секундах")
+options = parser.parse_args()
+
+SearchSyncWorker(
+    es_client, mongo_client.db.items, mongo_client.db.search_queue, mongo_client.db.reindex_checkpoints,
+    batch_size=options.batch_size, max_backoff=options.max_backoff
+).run_forever(poll_interval=options.poll_interval)
@@ -0,0 +1,351 @@
+""" Поисковый индекс товаров в elasticsearch """
+
+import time
+from datetime import datetime, timedelta
+from elasticsearch.helpers import parallel_bulk, streaming_bulk
+from pymongo import ASCENDING
+from exceptions import IncorrectParameter
+
+
+# Алиас, через который идет поиск; сами данные лежат в версионных индексах items_<timestamp>
+ITEMS_ALIAS = "items"
+
+# Количество подсказок по умолчанию и максимально допустимое
+AUTOCOMPLETE_SIZE = 10
+AUTOCOMPLETE_MAX_SIZE = 50
+
+# Настройки индекса товаров: title.autocomplete индексирует префиксы слов (edge n-gram),
+# поэтому подсказки ищутся обычным match без wildcard-запросов по всему словарю термов
+ITEMS_INDEX_BODY = {
+    "settings": {
+        "analysis": {
+            "filter": {
+                "autocomplete_filter": {"type": "edge_ngram", "min_gram": 1, "max_gram": 20}
+            },
+            "analyzer": {
+                "autocomplete": {
+                    "type": "custom", "tokenizer": "standard", "filter": ["lowercase", "autocomplete_filter"]
+                },
+                "autocomplete_search": {
+                    "type": "custom", "tokenizer": "standard", "filter": ["lowercase"]
+                }
+            }
+        }
+    },
+    "mappings": {
+        "properties": {
+            "title": {
+                "type": "text",
+                "fields": {
+                    "autocomplete": {
+                        "type": "text", "analyzer": "autocomplete", "search_analyzer": "autocomplete_search"
+                    }
+                }
+            }
+        }
+    }
+}
+
+
+def item_document(item_data: dict) -> dict:
+    """ Возвращает документ поискового индекса для товара
+    :param item_data: Данные товара из бд
+    :return:
+    """
+    return {"title": item_data.get("title")}
+
+
+def create_items_index(es, refresh_interval: str=None) -> str:
+    """ Создает новый версионный индекс товаров с настройками ITEMS_INDEX_BODY и возвращает его имя
+    :param es:
+    :param refresh_interval: Интервал обновления поиска ("-1" - без обновления на время загрузки)
+    :return:
+    """
+    index = "%s_%s" % (ITEMS_ALIAS, datetime.now().strftime("%Y%m%d%H%M%S%f"))
+    body = ITEMS_INDEX_BODY
+    if refresh_interval:
+        body = dict(body, settings=dict(body["settings"], index={"refresh_interval": refresh_interval}))
+    es.indices.create(index=index, body=body)
+    return index
+
+
+def ensure_items_index(es) -> bool:
+    """ Создает индекс товаров и алиас поиска, если их еще нет (иначе первая запись воркера создала бы индекс
+    items с динамическим маппингом), и возвращает, есть ли в индексе поле подсказок title.autocomplete
+    (индекс старого формата без него перестраивается скриптом reindex-elastic-search.py)
+    :param es:
+    :return:
+    """
+    if not es.indices.exists_alias(name=ITEMS_ALIAS) and not es.indices.exists(index=ITEMS_ALIAS):
+        index = create_items_index(es)
+        es.indices.update_aliases(body={"actions": [{"add": {"index": index, "alias": ITEMS_ALIAS}}]})
+    return all(
+        "autocomplete" in mapping["mappings"].get("properties", {}).get("title", {}).get("fields", {})
+        for mapping in es.indices.get_mapping(index=ITEMS_ALIAS).values()
+    )
+
+
+def autocomplete_query(term: str, size: int=AUTOCOMPLETE_SIZE) -> dict:
+    """ Возвращает запрос подсказок: все слова запроса должны совпасть с префиксами слов названия,
+    выше ранжируются названия, начинающиеся с запроса, и точные совпадения слов
+    :param term:
+    :param size: Количество подсказок (ограничивается от 1 до AUTOCOMPLETE_MAX_SIZE)
+    :return:
+    """
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise IncorrectParameter("Некорректное количество подсказок: %s" % size)
+    return {
+        "size": max(1, min(size, AUTOCOMPLETE_MAX_SIZE)),
+        "_source": ["title"],
+        "query": {
+            "bool": {
+                "must": {"match": {"title.autocomplete": {"query": term, "operator": "and"}}},
+                "should": [
+                    {"match_phrase_prefix": {"title": {"query": term, "boost": 3}}},
+                    {"match": {"title": {"query": term, "boost": 2}}}
+                ]
+            }
+        }
+    }
+
+
+class Reindexer(object):
+    """ Полная перестройка поискового индекса товаров
+
+    Товары читаются из бд пачками по возрастанию _id и отправляются в новый версионный индекс через bulk api.
+    После каждой пачки в коллекцию чекпоинтов записывается последний обработанный _id, поэтому прерванную
+    перестройку можно продолжить с того же места. По окончании алиас атомарно переключается на новый индекс.
+
+    Пока перестройка не закончена, SearchSyncWorker пишет изменения и в новый индекс (он указан в чекпоинте).
+    Поэтому копирование только создает документы (create) и не затирает записанное воркером, а товары пачки,
+    удаленные из бд во время копирования, удаляются из нового индекса после пачки.
+    """
+
+    def __init__(self, es, items, checkpoints, batch_size: int=5000, chunk_size: int=500, threads: int=4):
+        self.es = es
+        self.items = items
+        self.checkpoints = checkpoints
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.threads = threads
+
+    def run(self, resume: bool=True, keep_old: bool=False, report=print) -> str:
+        """ Перестраивает индекс и возвращает имя нового индекса
+        :param resume: Продолжить незавершенную перестройку, если она есть
+        :param keep_old: Не удалять предыдущие версии индекса после переключения алиаса
+        :param report: Функция для вывода прогресса
+        :return:
+        """
+        # Алиас нужен воркеру, пока идет перестройка: без него запись через алиас создала бы индекс items
+        ensure_items_index(self.es)
+        checkpoint = self.checkpoints.find_one({"_id": ITEMS_ALIAS}) if resume else None
+        if checkpoint and not checkpoint.get("done"):
+            index, last_id, indexed = checkpoint["index"], checkpoint["last_id"], checkpoint["indexed"]
+            report("resuming %s from _id > %s" % (index, last_id))
+        else:
+            index, last_id, indexed = create_items_index(self.es, refresh_interval="-1"), None, 0
+            self.save_checkpoint(index, last_id, indexed)
+
+        started, started_indexed = time.time(), indexed
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+            batch = list(self.items.find(query, {"title": True}).sort([("_id", ASCENDING)]).limit(self.batch_size))
+            if not batch:
+                break
+            actions = (
+                {"_op_type": "create", "_index": index, "_id": item_data["_id"], "_source": item_document(item_data)}
+                for item_data in batch
+            )
+            # 409 - документ уже записан воркером или до прерывания перестройки
+            for _ in parallel_bulk(
+                self.es, actions, thread_count=self.threads, chunk_size=self.chunk_size, ignore_status=(409,)
+            ):
+                pass
+            self.delete_missing(index, [item_data["_id"] for item_data in batch])
+            last_id, indexed = batch[-1]["_id"], indexed + len(batch)
+            self.save_checkpoint(index, last_id, indexed)
+            elapsed = max(time.time() - started, 0.001)
+            report("%s docs indexed, %.1f docs/s" % (indexed, (indexed - started_indexed) / elapsed))
+
+        self.es.indices.put_settings(index=index, body={"index": {"refresh_interval": "1s"}})
+        self.es.indices.refresh(index=index)
+        old_indexes = self.swap_alias(index)
+        if not keep_old:
+            for old_index in old_indexes:
+                self.es.indices.delete(index=old_index)
+        self.checkpoints.update_one({"_id": ITEMS_ALIAS}, {"$set": {"done": True}})
+        report("done: %s docs in %s" % (indexed, index))
+        return index
+
+    def swap_alias(self, index: str) -> [str]:
+        """ Атомарно переключает алиас поиска на новый индекс и возвращает индексы, с которых он был снят
+        :param index:
+        :return:
+        """
+        actions, old_indexes = [{"add": {"index": index, "alias": ITEMS_ALIAS}}], []
+        if self.es.indices.exists_alias(name=ITEMS_ALIAS):
+            old_indexes = [i for i in self.es.indices.get_alias(name=ITEMS_ALIAS) if i != index]
+            actions += [{"remove": {"index": old_index, "alias": ITEMS_ALIAS}} for old_index in old_indexes]
+        elif self.es.indices.exists(index=ITEMS_ALIAS):
+            # Индекс старого формата с именем алиаса удаляется в том же атомарном действии
+            actions.append({"remove_index": {"index": ITEMS_ALIAS}})
+        self.es.indices.update_aliases(body={"actions": actions})
+        return old_indexes
+
+    def delete_missing(self, index: str, item_ids: list):
+        """ Удаляет из нового индекса скопированные товары, которых уже нет в бд (удалены во время копирования,
+        а воркер мог обработать удаление раньше, чем товар попал в индекс)
+        :param index:
+        :param item_ids:
+        :return:
+        """
+        existing = {item_data["_id"] for item_data in self.items.find({"_id": {"$in": item_ids}}, {"_id": True})}
+        actions = [
+            {"_op_type": "delete", "_index": index, "_id": item_id} for item_id in item_ids if item_id not in existing
+        ]
+        if actions:
+            for _ in streaming_bulk(self.es, actions, chunk_size=self.chunk_size, ignore_status=(404,)):
+                pass
+
+    def save_checkpoint(self, index: str, last_id, indexed: int):
+        """ Сохраняет прогресс перестройки
+        :param index:
+        :param last_id:
+        :param indexed:
+        :return:
+        """
+        self.checkpoints.replace_one(
+            {"_id": ITEMS_ALIAS},
+            {"_id": ITEMS_ALIAS, "index": index, "last_id": last_id, "indexed": indexed, "done": False},
+            upsert=True
+        )
+
+
+def queue_event(item_id: int, op: str) -> dict:
+    """ Возвращает событие очереди изменений товара
+    :param item_id:
+    :param op: "index" или "delete"
+    :return:
+    """
+    now = datetime.now()
+    return {"item_id": int(item_id), "op": op, "created_datetime": now, "next_attempt_datetime": now, "attempts": 0}
+
+
+class SearchQueue(object):
+    """ Персистентная очередь изменений товаров для синхронизации поискового индекса (коллекция mongodb) """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def push(self, item_id: int, op: str):
+        """ Ставит в очередь изменение товара
+        :param item_id:
+        :param op: "index" или "delete"
+        :return:
+        """
+        self.queue.insert_one(queue_event(item_id, op))
+
+    def push_many(self, item_ids: list, op: str, chunk_size: int=1000):
+        """ Ставит в очередь изменения многих товаров (пачками по chunk_size событий на запрос)
+        :param item_ids:
+        :param op: "index" или "delete"
+        :param chunk_size:
+        :return:
+        """
+        for start in range(0, len(item_ids), chunk_size):
+            self.queue.insert_many([queue_event(item_id, op) for item_id in item_ids[start:start + chunk_size]])
+
+
+class SearchSyncWorker(object):
+    """ Фоновый обработчик очереди изменений товаров
+
+    Забирает из очереди пачку готовых к обработке событий, для каждого товара берет его актуальное состояние
+    из бд (товар есть - индексируется, товара нет - удаляется из индекса) и отправляет все изменения одним
+    bulk-запросом. Успешно обработанные события удаляются, неудачные откладываются с экспоненциальной задержкой.
+    Пока идет перестройка индекса (Reindexer), изменения пишутся и в строящийся индекс, иначе изменения уже
+    скопированных товаров потерялись бы при переключении алиаса.
+    """
+
+    def __init__(
+            self, es, items, queue, checkpoints, batch_size: int=500, backoff: float=1, max_backoff: float=300
+    ):
+        self.es = es
+        self.items = items
+        self.queue = queue
+        self.checkpoints = checkpoints
+        self.batch_size = batch_size
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def run_forever(self, poll_interval: float=1, report=print):
+        """ Обрабатывает очередь, пока процесс не будет остановлен
+        :param poll_interval: Пауза, если очередь пуста
+        :param report: Функция для вывода предупреждений
+        :return:
+        """
+        if not ensure_items_index(self.es):
+            report("index %s has no title.autocomplete field, run reindex-elastic-search.py" % ITEMS_ALIAS)
+        while True:
+            if not self.drain_once():
+                time.sleep(poll_interval)
+
+    def drain_once(self) -> int:
+        """ Обрабатывает одну пачку событий и возвращает их количество
+        :return:
+        """
+        events = list(
+            self.queue.find({"next_attempt_datetime": {"$lte": datetime.now()}})
+            .sort([("_id", ASCENDING)]).limit(self.batch_size)
+        )
+        if not events:
+            return 0
+        events_by_item = {}
+        for event in events:
+            events_by_item.setdefault(event["item_id"], []).append(event)
+        items_data = {
+            item_data["_id"]: item_data
+            for item_data in self.items.find({"_id": {"$in": list(events_by_item)}}, {"title": True})
+        }
+        # Чекпоинт читается после товаров: если перестройка началась позже, она сама скопирует их новое состояние
+        actions = (
+            {"_index": index, "_id": item_id, "_source": item_document(items_data[item_id])}
+            if item_id in items_data else
+            {"_op_type": "delete", "_index": index, "_id": item_id}
+            for index in self.get_indexes()
+            for item_id in events_by_item
+        )
+        failed_ids = set()
+        for ok, info in streaming_bulk(self.es, actions, raise_on_error=False, raise_on_exception=False):
+            result = list(info.values())[0]
+            # Удаление отсутствующего в индексе товара - тоже успех
+            if not ok and result.get("status") != 404:
+                failed_ids.add(int(result["_id"]))
+        done = [event for item_id in events_by_item if item_id not in failed_ids for event in events_by_item[item_id]]
+        failed = [events_by_item[item_id] for item_id in events_by_item if item_id in failed_ids]
+        if done:
+            self.queue.delete_many({"_id": {"$in": [event["_id"] for event in done]}})
+        for item_events in failed:
+            delay = self.get_delay(max(event.get("attempts", 0) for event in item_events))
+            self.queue.update_many({"_id": {"$in": [event["_id"] for event in item_events]}}, {
+                "$inc": {"attempts": 1},
+                "$set": {"next_attempt_datetime": datetime.now() + timedelta(seconds=delay)}
+            })
+        return len(events)
+
+    def get_indexes(self) -> [str]:
+        """ Индексы, в которые пишутся изменения: алиас поиска и строящийся индекс, если идет перестройка
+        :return:
+        """
+        checkpoint = self.checkpoints.find_one({"_id": ITEMS_ALIAS})
+        if checkpoint and not checkpoint.get("done"):
+            return [ITEMS_ALIAS, checkpoint["index"]]
+        return [ITEMS_ALIAS]
+
+    def get_delay(self, attempts: int) -> float:
+        """ Задержка перед следующей попыткой обработки события
+        :param attempts: Количество уже сделанных попыток
+        :return:
+        """
+        return min(self.backoff * 2 ** attempts, self.max_backoff)
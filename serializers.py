@@ -0,0 +1,77 @@
+""" Сериализация ответов сервиса в json
+
+По умолчанию используется orjson (если установлен), JSON_SERIALIZER=json включает стандартный модуль json.
+Даты (created_datetime заказов и т.п.) в обоих случаях сериализуются в формате ISO 8601.
+"""
+
+import os
+import json
+from datetime import date, datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    """ Сериализация типов, которые не поддерживаются json напрямую
+    :param value:
+    :return:
+    """
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
+
+
+class JsonSerializer(object):
+    """ Сериализатор на стандартном модуле json """
+    name = "json"
+
+    def dumps(self, value) -> bytes:
+        """ Сериализует значение в json (utf-8)
+        :param value:
+        :return:
+        """
+        return json.dumps(value, default=_default, ensure_ascii=False).encode()
+
+
+class OrjsonSerializer(object):
+    """ Сериализатор на orjson: в несколько раз быстрее json и сам сериализует datetime """
+    name = "orjson"
+
+    def dumps(self, value) -> bytes:
+        """ Сериализует значение в json (utf-8)
+        :param value:
+        :return:
+        """
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def get_serializer(name: str=None):
+    """ Возвращает сериализатор по имени, по умолчанию - самый быстрый из доступных
+    :param name: "orjson" или "json"
+    :return:
+    """
+    if name == "json" or orjson is None:
+        return JsonSerializer()
+    return OrjsonSerializer()
+
+
+serializer = get_serializer(os.environ.get("JSON_SERIALIZER"))
+
+
+def dumps(value) -> str:
+    """ Сериализует значение в json-строку
+    :param value:
+    :return:
+    """
+    return serializer.dumps(value).decode()
+
+
+def dumpb(value) -> bytes:
+    """ Сериализует значение в json (байты utf-8, для отправки без перекодирования)
+    :param value:
+    :return:
+    """
+    return serializer.dumps(value)
@@ -0,0 +1,190 @@
+""" Потоковая отдача списков: json-массив формируется по мере чтения курсора mongodb
+
+Потоковый режим включается параметром stream=1 у действий из STREAMING_ACTIONS. Ответ имеет тот же вид,
+что и обычный ({"orders": [...]}), но отправляется частями, поэтому память воркера не зависит от размера списка,
+а первые байты уходят клиенту сразу. Ошибка посреди потока закрывает массив и добавляет поле "error".
+Действия из JSONL_ACTIONS (выгрузки) всегда отдаются потоком JSON Lines, ошибка - последней строкой {"error": ...}.
+"""
+
+import re
+from urllib.parse import parse_qs
+from exceptions import error_data
+from serializers import dumps
+
+
+# Действие -> метод контроллера, отдающий тот же список потоком
+STREAMING_ACTIONS = {"get_open_orders": "stream_open_orders"}
+
+# Действия, которые всегда отдаются потоком JSON Lines (по объекту на строку)
+JSONL_ACTIONS = ["export_items"]
+JSONL_CONTENT_TYPE = "application/x-ndjson; charset=utf-8"
+
+# Параметры запроса с вложенными ключами: name[key][key]...
+NESTED_PARAM = re.compile(r"^([^\[\]]+)((?:\[[^\[\]]+\])+)$")
+NESTED_PARAM_KEY = re.compile(r"\[([^\[\]]+)\]")
+
+# Количество элементов, сериализуемых в одну отправляемую часть ответа
+STREAM_CHUNK_SIZE = 100
+
+
+class ParamsRequest(object):
+    """ Запрос из словаря параметров с интерфейсом envi.Request (для потоковых ответов и ASGI),
+    действие может указать в etag версию ответа - ASGI отдаст ее заголовком ETag и ответит 304 на If-None-Match
+    """
+    def __init__(self, params: dict=None):
+        self.params = params or {}
+        self.etag = None
+
+    def get(self, key: str, default=None):
+        """ Возвращает значение параметра запроса
+        :param key:
+        :param default:
+        :return:
+        """
+        return self.params.get(key, default)
+
+
+def parse_params(query: str) -> dict:
+    """ Разбирает строку запроса или тело формы (повторяющиеся параметры - списком,
+    параметры вида attr[5][from]=10 - вложенными словарями: {"attr": {"5": {"from": "10"}}})
+    :param query:
+    :return:
+    """
+    params = {}
+    for key, values in parse_qs(query).items():
+        value = values[0] if len(values) == 1 else values
+        match = NESTED_PARAM.match(key)
+        if not match:
+            params.setdefault(key, value)
+            continue
+        target, keys = params, [match.group(1)] + NESTED_PARAM_KEY.findall(match.group(2))
+        for nested_key in keys[:-1]:
+            target = target.setdefault(nested_key, {})
+            if not isinstance(target, dict):
+                break
+        else:
+            target[keys[-1]] = value
+    return params
+
+
+def get_action_name(path: str):
+    """ Возвращает название действия для пути /<action>/ или /v1/<action>/
+    :param path:
+    :return:
+    """
+    parts = [part for part in path.split("/") if part]
+    if parts and parts[0] == "v1":
+        parts = parts[1:]
+    if len(parts) != 1 or parts[0].startswith("_"):
+        return None
+    return parts[0]
+
+
+def stream_json_array(key: str, values, chunk_size: int=STREAM_CHUNK_SIZE):
+    """ Отдает {key: [...]} частями по мере получения элементов
+    :param key:
+    :param values: Итератор элементов массива
+    :param chunk_size:
+    :return:
+    """
+    yield '{"%s": [' % key
+    separator, chunk = "", []
+    try:
+        for value in values:
+            chunk.append(dumps(value))
+            if len(chunk) >= chunk_size:
+                yield separator + ",".join(chunk)
+                separator, chunk = ",", []
+        if chunk:
+            yield separator + ",".join(chunk)
+        yield "]}"
+    except Exception as e:
+        if chunk:
+            yield separator + ",".join(chunk)
+        yield '], "error": %s}' % dumps(error_data(e)["error"])
+
+
+async def async_stream_json_array(key: str, values, chunk_size: int=STREAM_CHUNK_SIZE):
+    """ Отдает {key: [...]} частями по мере получения элементов (асинхронный вариант stream_json_array)
+    :param key:
+    :param values: Асинхронный итератор элементов массива
+    :param chunk_size:
+    :return:
+    """
+    yield '{"%s": [' % key
+    separator, chunk = "", []
+    try:
+        async for value in values:
+            chunk.append(dumps(value))
+            if len(chunk) >= chunk_size:
+                yield separator + ",".join(chunk)
+                separator, chunk = ",", []
+        if chunk:
+            yield separator + ",".join(chunk)
+        yield "]}"
+    except Exception as e:
+        if chunk:
+            yield separator + ",".join(chunk)
+        yield '], "error": %s}' % dumps(error_data(e)["error"])
+
+
+def stream_jsonl(values, chunk_size: int=STREAM_CHUNK_SIZE):
+    """ Отдает элементы строками JSON Lines частями по мере получения элементов
+    :param values: Итератор элементов
+    :param chunk_size:
+    :return:
+    """
+    chunk = []
+    try:
+        for value in values:
+            chunk.append(dumps(value) + "\n")
+            if len(chunk) >= chunk_size:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+    except Exception as e:
+        yield "".join(chunk) + dumps(error_data(e)) + "\n"
+
+
+async def async_stream_jsonl(values, chunk_size: int=STREAM_CHUNK_SIZE):
+    """ Отдает элементы строками JSON Lines частями (асинхронный вариант stream_jsonl)
+    :param values: Асинхронный итератор элементов
+    :param chunk_size:
+    :return:
+    """
+    chunk = []
+    try:
+        async for value in values:
+            chunk.append(dumps(value) + "\n")
+            if len(chunk) >= chunk_size:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+    except Exception as e:
+        yield "".join(chunk) + dumps(error_data(e)) + "\n"
+
+
+class StreamingApplication(object):
+    """ WSGI-обертка над приложением: запросы действий из STREAMING_ACTIONS с параметром stream=1
+    и действий из JSONL_ACTIONS отдаются потоком (параметры - из строки запроса), остальные передаются приложению
+    """
+
+    def __init__(self, application, controller):
+        self.application = application
+        self.controller = controller
+
+    def __call__(self, environ, start_response):
+        action = get_action_name(environ.get("PATH_INFO", ""))
+        if action in JSONL_ACTIONS:
+            chunks = getattr(self.controller, action)(ParamsRequest(parse_params(environ.get("QUERY_STRING", ""))))
+            start_response("200 OK", [("Content-Type", JSONL_CONTENT_TYPE)])
+            return (chunk.encode() for chunk in chunks)
+        if action in STREAMING_ACTIONS:
+            params = parse_params(environ.get("QUERY_STRING", ""))
+            if params.get("stream"):
+                chunks = getattr(self.controller, STREAMING_ACTIONS[action])(ParamsRequest(params))
+                start_response("200 OK", [("Content-Type", "application/json; charset=utf-8")])
+                return (chunk.encode() for chunk in chunks)
+        return self.application(environ, start_response)
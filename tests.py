@@ -1,4 +1,1474 @@
-
 """ Тесты """
 
+import io
+import os
+import json
+import asyncio
 import unittest
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+import mongomock
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import models
+import async_models
+import async_controllers
+with patch("indexes.ensure_indexes"):
+    # Точка входа ASGI создает индексы при импорте, в тестах бд - mongomock
+    import asgi
+from allocators import IdAllocator, BlockIdAllocator, AsyncBlockIdAllocator
+from inventory import Inventory, ReservationStates, RESERVATION_TTL
+from importer import ItemsImporter, import_batch, read_rows
+from exporter import Exporter, JsonlExportWriter, ParquetExportWriter, pyarrow
+from bestsellers import (
+    BestsellersAggregator, daily_cleanup_query, daily_sales_pipeline, rerun_since, stale_generation_query,
+    window_pipeline
+)
+from facets import FacetCounts, AsyncFacetCounts, facet_keys
+from elasticsearch.serializer import JSONSerializer
+from search import (
+    ITEMS_ALIAS, AUTOCOMPLETE_MAX_SIZE, Reindexer, SearchQueue, SearchSyncWorker, autocomplete_query, ensure_items_index
+)
+from exceptions import IncorrectParameter
+from cache import ResponseCache, SharedTagsCacheBackend, AsyncSharedTagsCacheBackend, create_cache_backend
+from streaming import ParamsRequest, parse_params, stream_json_array
+from serializers import dumps
+from clients import LazyClient, LazyMongoClient, PoolMetrics, mongo_client_options, primary_reads
+
+
+class CountingCollection(object):
+    """ Обертка над коллекцией, считающая обращения к бд """
+    def __init__(self, collection, counter: list):
+        self.collection = collection
+        self.counter = counter
+
+    def with_options(self, **kwargs):
+        return CountingCollection(self.collection.with_options(**kwargs), self.counter)
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            self.counter.append((self.collection.name, name))
+            return attr(*args, **kwargs)
+        return wrapper
+
+
+class CountingDatabase(object):
+    """ Обертка над базой данных, возвращающая коллекции с подсчетом обращений """
+    def __init__(self, db, counter: list):
+        self.db = db
+        self.counter = counter
+
+    def __getattr__(self, name):
+        return CountingCollection(self.db[name], self.counter)
+
+
+class AsyncCursor(object):
+    """ Курсор mongomock с асинхронным to_list, как у motor """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        return AsyncCursor(self.cursor.sort(*args, **kwargs))
+
+    def limit(self, *args, **kwargs):
+        return AsyncCursor(self.cursor.limit(*args, **kwargs))
+
+    def batch_size(self, *args, **kwargs):
+        return AsyncCursor(self.cursor.batch_size(*args, **kwargs))
+
+    async def __aiter__(self):
+        for document in self.cursor:
+            yield document
+
+    async def to_list(self, length):
+        return list(self.cursor)
+
+
+class AsyncCollection(object):
+    """ Коллекция mongomock с асинхронными методами, как у motor """
+    def __init__(self, collection):
+        self.collection = collection
+        self.name = collection.name
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self.collection.find(*args, **kwargs))
+
+    def with_options(self, **kwargs):
+        return AsyncCollection(self.collection.with_options(**kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+
+        async def wrapper(*args, **kwargs):
+            return attr(*args, **kwargs)
+        return wrapper
+
+
+class BulkUpdatesCollection(object):
+    """ Коллекция mongomock, выполняющая bulk_write из UpdateOne по одному запросу
+    (bulk_write самого mongomock несовместим с текущим pymongo)
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    def with_options(self, **kwargs):
+        return BulkUpdatesCollection(self.collection.with_options(**kwargs))
+
+    def bulk_write(self, requests: list, ordered: bool=True):
+        for request in requests:
+            self.collection.update_one(request._filter, request._doc, upsert=request._upsert)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+class AtomicCollection(object):
+    """ Коллекция mongomock, выполняющая каждую операцию атомарно, как mongodb для одного документа
+    (сам mongomock при обращении из нескольких потоков может потерять обновление)
+    """
+    def __init__(self, collection, lock: threading.Lock):
+        self.collection = collection
+        self.lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+
+        def wrapper(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+        return wrapper
+
+
+class MergeCollection(object):
+    """ Коллекция mongomock, выполняющая агрегацию с последней стадией $merge (сам mongomock ее не поддерживает):
+    результат записывается в целевую коллекцию с заменой документов с тем же _id
+    """
+    def __init__(self, collection, db):
+        self.collection = collection
+        self.db = db
+
+    def aggregate(self, pipeline: list, **kwargs):
+        if "$merge" not in pipeline[-1]:
+            return self.collection.aggregate(pipeline, **kwargs)
+        target = self.db[pipeline[-1]["$merge"]["into"]]
+        for document in self.collection.aggregate(pipeline[:-1], **kwargs):
+            if "_id" in document:
+                target.replace_one({"_id": document["_id"]}, document, upsert=True)
+            else:
+                target.insert_one(document)
+        return iter([])
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+class MergeDatabase(object):
+    """ База данных mongomock, коллекции которой поддерживают $merge """
+    def __init__(self, db):
+        self.db = db
+
+    def __getattr__(self, name):
+        return MergeCollection(self.db[name], self.db)
+
+
+class SessionCollection(object):
+    """ Коллекция mongomock, принимающая сессию, как pymongo (сам mongomock сессий не поддерживает): обращения
+    записываются в operations вместе с сессией, bulk_write из UpdateOne выполняется по одному запросу
+    """
+    def __init__(self, collection, operations: list):
+        self.collection = collection
+        self.operations = operations
+
+    def bulk_write(self, requests: list, ordered: bool=True, session=None):
+        self.operations.append((self.collection.name, "bulk_write", session))
+        return SimpleNamespace(modified_count=sum(
+            self.collection.update_one(request._filter, request._doc, upsert=request._upsert).modified_count
+            for request in requests
+        ))
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, session=None, **kwargs):
+            self.operations.append((self.collection.name, name, session))
+            return attr(*args, **kwargs)
+        return wrapper
+
+
+class FakeSession(object):
+    """ Сессия mongodb, выполняющая транзакцию сразу (без отката) """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def with_transaction(self, callback):
+        return callback(self)
+
+
+class UpsertsCollection(object):
+    """ Коллекция mongomock, выполняющая неупорядоченный bulk_write из UpdateOne по одному запросу, как mongodb:
+    возвращает upserted_ids, а ошибки записи собирает в BulkWriteError с созданными до ошибки документами
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    def bulk_write(self, requests: list, ordered: bool=True):
+        upserted, errors = {}, []
+        for index, request in enumerate(requests):
+            try:
+                result = self.collection.update_one(request._filter, request._doc, upsert=request._upsert)
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": e.code, "errmsg": str(e)})
+                continue
+            if result.upserted_id is not None:
+                upserted[index] = result.upserted_id
+        if errors:
+            raise BulkWriteError({
+                "writeErrors": errors,
+                "upserted": [{"index": index, "_id": _id} for index, _id in upserted.items()]
+            })
+        return SimpleNamespace(upserted_ids=upserted)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+class FakeIndices(object):
+    """ indices api фейкового elasticsearch """
+    def __init__(self, es):
+        self.es = es
+
+    def create(self, index: str, body: dict=None, **kwargs):
+        self.es.indexes[index] = {"body": body, "docs": {}}
+
+    def exists(self, index: str, **kwargs) -> bool:
+        return index in self.es.indexes
+
+    def exists_alias(self, name: str, **kwargs) -> bool:
+        return bool(self.es.aliases.get(name))
+
+    def get_alias(self, name: str, **kwargs) -> dict:
+        return {index: {"aliases": {name: {}}} for index in self.es.aliases[name]}
+
+    def update_aliases(self, body: dict, **kwargs):
+        for action in body["actions"]:
+            (op, params), = action.items()
+            if op == "add":
+                self.es.aliases.setdefault(params["alias"], []).append(params["index"])
+            elif op == "remove":
+                self.es.aliases[params["alias"]].remove(params["index"])
+            else:
+                del self.es.indexes[params["index"]]
+
+    def get_mapping(self, index: str, **kwargs) -> dict:
+        return {
+            name: {"mappings": (self.es.indexes[name]["body"] or {}).get("mappings", {})}
+            for name in self.es.resolve(index)
+        }
+
+    def put_settings(self, index: str, body: dict, **kwargs):
+        pass
+
+    def refresh(self, index: str, **kwargs):
+        pass
+
+    def delete(self, index: str, **kwargs):
+        del self.es.indexes[index]
+
+
+class FakeElasticsearch(object):
+    """ Фейковый elasticsearch: индексы и алиасы в памяти, bulk api для helpers elasticsearch-py
+    (запись в несуществующий индекс создает его, как в elasticsearch, ошибки записи задаются в failing_ids)
+    """
+    def __init__(self):
+        self.indexes, self.aliases, self.failing_ids = {}, {}, set()
+        self.indices = FakeIndices(self)
+        self.transport = SimpleNamespace(serializer=JSONSerializer())
+        self.lock = threading.Lock()
+
+    def resolve(self, name: str) -> list:
+        return list(self.aliases.get(name) or [name])
+
+    def docs(self, name: str) -> dict:
+        index, = self.resolve(name)
+        return self.indexes[index]["docs"]
+
+    def bulk(self, body: str, *args, **kwargs) -> dict:
+        lines, items = iter(json.loads(line) for line in body.splitlines() if line), []
+        with self.lock:
+            for action in lines:
+                (op, meta), = action.items()
+                source = next(lines) if op != "delete" else None
+                index, = self.resolve(meta["_index"])
+                docs, status = self.indexes.setdefault(index, {"body": None, "docs": {}})["docs"], 200
+                if meta["_id"] in self.failing_ids:
+                    status = 500
+                elif op == "delete":
+                    status = 200 if docs.pop(meta["_id"], None) else 404
+                elif op == "create" and meta["_id"] in docs:
+                    status = 409
+                else:
+                    docs[meta["_id"]] = source
+                items.append({op: {"_index": index, "_id": meta["_id"], "status": status}})
+        return {"errors": any(list(item.values())[0]["status"] >= 300 for item in items), "items": items}
+
+
+class MongoTestCase(unittest.TestCase):
+    """ Базовый класс тестов, подменяющий mongodb на mongomock с подсчетом запросов """
+
+    def setUp(self):
+        self.queries = []
+        self.db = mongomock.MongoClient().db
+        counting_db = CountingDatabase(self.db, self.queries)
+        self.patches = [
+            patch.object(models, "mongo_client", SimpleNamespace(db=counting_db)),
+            patch.object(models, "id_allocator", BlockIdAllocator(self.db.counters)),
+            patch.multiple(
+                models.catalog,
+                items=counting_db.items, categories=counting_db.categories, attributes=counting_db.attributes,
+                bestsellers=counting_db.bestsellers
+            ),
+            patch.object(models.catalog, "search_queue", SearchQueue(counting_db.search_queue)),
+            patch.object(models.catalog, "facets", FacetCounts(BulkUpdatesCollection(counting_db.facets))),
+            patch.object(models.carts, "carts", counting_db.carts),
+            patch.object(models.customers, "customers", counting_db.customers),
+            patch.object(models.orders, "orders", counting_db.orders),
+            patch.multiple(models.inventory, items=counting_db.items, reservations=counting_db.reservations),
+            # Кэши ответов обоих контроллеров, как и в работе, общие через версии тегов в mongodb
+            patch.object(
+                models.response_cache, "backend", SharedTagsCacheBackend(BulkUpdatesCollection(self.db.response_cache))
+            ),
+        ]
+        async_db = {name: AsyncCollection(counting_db.__getattr__(name)) for name in (
+            "items", "categories", "attributes", "bestsellers", "search_queue", "carts", "customers", "orders",
+            "reservations"
+        )}
+        self.patches += [
+            patch.object(async_models, "id_allocator", AsyncBlockIdAllocator(AsyncCollection(self.db.counters))),
+            patch.multiple(async_models.catalog, **{name: async_db[name] for name in (
+                "items", "categories", "attributes", "bestsellers", "search_queue"
+            )}),
+            patch.object(
+                async_models.catalog, "facets",
+                AsyncFacetCounts(AsyncCollection(BulkUpdatesCollection(counting_db.facets)))
+            ),
+            patch.object(
+                async_models.response_cache, "backend",
+                AsyncSharedTagsCacheBackend(AsyncCollection(BulkUpdatesCollection(self.db.response_cache)))
+            ),
+            patch.object(async_models.carts, "carts", async_db["carts"]),
+            patch.object(async_models.customers, "customers", async_db["customers"]),
+            patch.object(async_models.orders, "orders", async_db["orders"]),
+            patch.multiple(async_models.inventory, items=async_db["items"], reservations=async_db["reservations"]),
+        ]
+        for p in self.patches:
+            p.start()
+        models.catalog.attribute_schemes.clear()
+        models.catalog.categories_cache.clear()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+    def asgi_request(self, scope: dict, body: bytes=b"") -> list:
+        """ Выполняет запрос к ASGI-приложению и возвращает отправленные им сообщения """
+        messages, sent = [{"type": "http.request", "body": body}], []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+        asyncio.run(asgi.application(scope, receive, send))
+        return sent
+
+
+class CartsTestCase(MongoTestCase):
+    """ Тесты корзины """
+
+    def setUp(self):
+        super().setUp()
+        self.db.attributes.insert_many([
+            {"_id": 1, "id": 1, "name": "Цвет", "options": ["red", "green"]},
+            {"_id": 2, "id": 2, "name": "Размер", "regex": r"^\d+$", "categories": "shoes"},
+        ])
+        self.db.items.insert_many([
+            {
+                "_id": i, "id": i, "title": "Товар %s" % i, "categories": "shoes", "cost": 100 * i, "discount": 10,
+                "attributes": [{"id": 1, "value": "red"}, {"id": 2, "value": str(30 + i)}]
+            }
+            for i in range(1, 31)
+        ])
+
+    def make_cart(self, lines: int) -> int:
+        """ Создает корзину с указанным количеством позиций """
+        items = [{"id": i, "title": "Товар %s" % i, "cost": 90 * i, "quantity": 1} for i in range(1, lines + 1)]
+        return self.db.carts.insert_one({"_id": lines, "id": lines, "items": items}).inserted_id
+
+    def test_get_cart_queries_count_does_not_depend_on_lines_count(self):
+        """ Загрузка корзины выполняет постоянное количество запросов к бд независимо от количества позиций """
+        counts = []
+        for lines in (1, 5, 20):
+            cart_id = self.make_cart(lines)
+            models.catalog.attribute_schemes.clear()
+            del self.queries[:]
+            cart = models.carts.get_cart(cart_id)
+            counts.append(len(self.queries))
+            self.assertEqual(lines, len(cart.items))
+        self.assertEqual(1, len(set(counts)))
+        self.assertLessEqual(counts[0], 3)
+
+    def test_get_cart_hydrates_items(self):
+        """ Позиции корзины содержат полностью собранные товары с аттрибутами """
+        cart = models.carts.get_cart(self.make_cart(2))
+        item = cart.items[1].item
+        self.assertEqual(2, item.id)
+        self.assertEqual(180, item.cost_with_discount)
+        self.assertEqual([("Цвет", "red"), ("Размер", "32")], [(a.name, a.value) for a in item.attributes])
+        self.assertEqual(270, cart.total_cost)
+
+    def test_get_cart_raises_for_missing_item(self):
+        """ Отсутствующий в каталоге товар приводит к ItemNotFound, как и раньше """
+        self.db.carts.insert_one({"_id": 100, "id": 100, "items": [{"id": 999, "quantity": 1}]})
+        with self.assertRaises(models.ItemNotFound):
+            models.carts.get_cart(100)
+
+    def test_cart_mutations_keep_totals(self):
+        """ Изменения корзины выполняются атомарными обновлениями и поддерживают итоги в документе """
+        cart = models.carts.get_cart(self.make_cart(1))
+        cart.add_item(2, 3)
+        cart.add_item(3, 1)
+        cart.set_quantity_for_item(2, 1)
+        cart.set_quantity_for_item(4, 2)
+        cart.remove_item(3)
+        stored = self.db.carts.find_one({"_id": cart.id})
+        self.assertEqual([(1, 1), (2, 1), (4, 2)], [(i["id"], i["quantity"]) for i in stored["items"]])
+        self.assertEqual((4, 90 + 180 + 720), (stored["quantity"], stored["total_cost"]))
+        self.assertEqual((stored["quantity"], stored["total_cost"]), (cart.quantity, cart.total_cost))
+        self.assertEqual(stored["items"], cart.get_data()["items"])
+
+        del self.queries[:]
+        cart.clear()
+        self.assertEqual([("carts", "update_one")], self.queries)
+        stored = self.db.carts.find_one({"_id": cart.id})
+        self.assertEqual(([], 0, 0), (stored["items"], stored["quantity"], stored["total_cost"]))
+
+
+class CatalogTestCase(MongoTestCase):
+    """ Тесты каталога """
+
+    def test_get_items_page_by_cursor(self):
+        """ Каталог листается курсором до конца без пропусков и повторов """
+        self.db.items.insert_many([
+            {"_id": i, "id": i, "title": "Товар %s" % i, "categories": "shoes" if i % 2 else "hats"}
+            for i in range(1, 26)
+        ])
+        seen, cursor = [], None
+        while True:
+            items, cursor = models.catalog.get_items_page("shoes", quantity=5, cursor=cursor)
+            seen += [item["_id"] for item in items]
+            if not cursor:
+                break
+        self.assertEqual(list(range(25, 0, -2)), seen)
+        with self.assertRaises(models.IncorrectCursor):
+            models.catalog.get_items_page(cursor="garbage")
+
+    def test_get_items_by_ids(self):
+        """ Товары возвращаются одним запросом в порядке запроса, отсутствующие - с маркером ошибки """
+        self.db.items.insert_many([{"_id": i, "id": i, "title": "Товар %s" % i, "imgs": [], "attributes": []} for i in (1, 2, 3)])
+        items = models.catalog.get_items_by_ids([3, 99, 1], fields=["id", "title"])
+        self.assertEqual(1, len(self.queries))
+        self.assertEqual([
+            {"id": 3, "title": "Товар 3"},
+            {"id": 99, "error": {"code": models.ItemNotFound.code, "message": models.ItemNotFound.msg}},
+            {"id": 1, "title": "Товар 1"},
+        ], items)
+
+    def test_get_item_with_fields_skips_attributes(self):
+        """ Запрос части полей товара загружает только нужные поля и не собирает аттрибуты """
+        self.db.attributes.insert_one({"_id": 1, "id": 1, "name": "Цвет"})
+        self.db.items.insert_one({
+            "_id": 1, "id": 1, "title": "Товар", "body": "Описание", "imgs": ["1.jpg"], "cost": 100, "discount": 10,
+            "attributes": [{"id": 1, "value": "red"}]
+        })
+        fields = ["id", "title", "img", "cost_with_discount"]
+        item_data = models.catalog.get_item(1, fields).get_data(fields)
+        self.assertEqual([("items", "find_one")], self.queries)
+        self.assertEqual({"id": 1, "title": "Товар", "img": "1.jpg", "cost_with_discount": 90}, item_data)
+
+    def test_items_pages_return_only_requested_fields(self):
+        """ Списки товаров с fields содержат ровно запрошенные поля, как get_item: вычисляемые поля посчитаны,
+        _id и поля, нужные только для вычисления, убраны
+        """
+        self.db.attributes.insert_one({"_id": 1, "id": 1, "name": "Цвет"})
+        self.db.items.insert_many([{
+            "_id": i, "id": i, "title": "Товар %s" % i, "body": "Описание", "imgs": ["%s.jpg" % i], "cost": 100,
+            "discount": 10, "categories": "shoes", "attributes": [{"id": 1, "value": "red"}]
+        } for i in (1, 2)])
+        fields = ["id", "title", "img", "cost_with_discount"]
+        expected = [{"id": i, "title": "Товар %s" % i, "img": "%s.jpg" % i, "cost_with_discount": 90} for i in (2, 1)]
+        self.assertEqual(expected, models.catalog.get_items(fields=fields))
+        self.assertEqual(expected, models.catalog.get_bestsellers(fields=fields))
+        self.assertEqual(expected, asyncio.run(async_models.catalog.get_items_page(fields=fields))[0])
+        self.assertEqual(
+            [{"id": 2, "attributes": [{"id": 1, "name": "Цвет", "value": "red"}]}],
+            models.catalog.get_items(quantity=1, fields=["id", "attributes"])
+        )
+
+    def test_categories_tree_is_cached_until_category_created(self):
+        """ Дерево рубрик отдается из кэша без запросов к бд и сбрасывается при создании рубрики """
+        self.db.categories.insert_one({"_id": "shoes", "slug": "shoes", "name": "Обувь"})
+        tree = models.catalog.get_categories_tree()
+        self.assertIs(tree, models.catalog.get_categories_tree())
+        self.assertEqual(1, len(self.queries))
+        self.assertEqual(["shoes"], [c["slug"] for c in json.loads(tree.json)["categories"]])
+
+        models.catalog.create_category("Шапки", "hats")
+        new_tree = models.catalog.get_categories_tree()
+        self.assertNotEqual(tree.etag, new_tree.etag)
+        self.assertEqual(2, len(new_tree.categories))
+
+
+class AttributeSchemesCacheTestCase(MongoTestCase):
+    """ Тесты кэша схем аттрибутов """
+
+    def setUp(self):
+        super().setUp()
+        self.db.attributes.insert_one({"_id": 1, "id": 1, "name": "Размер", "regex": r"^\d+$"})
+
+    def test_schemes_are_cached_until_saved(self):
+        """ Повторные чтения схемы не обращаются к бд, сохранение схемы сбрасывает кэш """
+        models.catalog.get_attribute_scheme(1)
+        models.catalog.get_attributes()
+        models.catalog.get_attributes()
+        self.assertEqual(2, len(self.queries))
+        self.assertEqual("Размер", models.catalog.get_attribute_scheme(1).name)
+        self.assertEqual(2, len(self.queries))
+
+        scheme = models.catalog.get_attribute_scheme(1)
+        scheme.name = "Размер обуви"
+        scheme.save()
+        self.assertEqual("Размер обуви", models.catalog.get_attribute_scheme(1).name)
+        self.assertEqual(1, models.catalog.attribute_schemes.stats()["size"])
+
+    def test_scheme_saved_without_categories_is_common(self):
+        """ Схема, сохраненная без рубрик (пустой список сохраняется как null), доступна товарам всех рубрик -
+        и в выборке из бд, и в проверке is_available_for, и в асинхронных моделях
+        """
+        self.db.attributes.insert_many([
+            {"_id": 2, "id": 2, "name": "Цвет", "categories": "shoes"},
+            {"_id": 3, "id": 3, "name": "Материал", "categories": "shoes"},
+        ])
+        for scheme_id, categories in ((2, None), (3, [])):
+            scheme = models.catalog.get_attribute_scheme(scheme_id)
+            scheme.categories = categories
+            scheme.save()
+            self.assertIsNone(self.db.attributes.find_one({"_id": scheme_id})["categories"])
+        for categories in (None, "shirts"):
+            self.assertEqual([1, 2, 3], sorted(a.id for a in models.catalog.get_attributes(categories)))
+            self.assertEqual(
+                [1, 2, 3], sorted(a.id for a in asyncio.run(async_models.catalog.get_attributes(categories)))
+            )
+            self.assertTrue(all(a.is_available_for(categories) for a in models.catalog.get_attributes(categories)))
+
+    def test_regex_validation(self):
+        """ Значение аттрибута проверяется скомпилированным регулярным выражением схемы """
+        self.assertEqual("42", models.Attribute({"id": 1, "value": "42"}).value)
+        with self.assertRaises(models.IncorrectValueForAttribute):
+            models.Attribute({"id": 1, "value": "XL"})
+
+
+class AsyncModelsTestCase(MongoTestCase):
+    """ Тесты асинхронных моделей и контроллера """
+
+    def setUp(self):
+        super().setUp()
+        self.db.items.insert_many([
+            {
+                "_id": i, "id": i, "title": "Товар %s" % i, "cost": 100 * i, "discount": 10, "quantity": 5,
+                "imgs": [], "attributes": []
+            }
+            for i in (1, 2)
+        ])
+
+    def test_create_order_from_cart(self):
+        """ Заказ создается из корзины покупателя с теми же позициями и итогами, что и в синхронной модели """
+        async def scenario():
+            await async_models.customers.ensure_existance(1)
+            customer = (await async_models.customers.customers.find_one({}))
+            cart = await async_models.carts.get_cart(customer["cart_id"])
+            await cart.add_item(1, 2)
+            await cart.add_item(2, 1)
+            return await async_models.orders.create_order(customer["_id"])
+
+        order = models.orders.get_order(asyncio.run(scenario()))
+        self.assertEqual([(1, 180), (2, 180)], [(i.id, i.cost) for i in order.items])
+        stored = self.db.orders.find_one({"_id": order.id})
+        self.assertEqual((3, 360, models.OrderStates.Created), (stored["quantity"], stored["cost"], stored["state"]))
+
+    def test_controller_error_format(self):
+        """ Ошибки асинхронного контроллера возвращаются в том же формате, что и у синхронного """
+        get_item = async_controllers.AsyncController.get_item
+        result = asyncio.run(get_item(ParamsRequest({"item_id": 5})))
+        self.assertEqual(
+            {"error": {"code": models.ItemNotFound.code, "message": models.ItemNotFound.msg}}, json.loads(result)
+        )
+        result = asyncio.run(get_item(ParamsRequest({"item_id": 1})))
+        self.assertEqual("Товар 1", result["item"]["title"])
+
+    def test_responses_are_cached_until_item_saved(self):
+        """ Ответ действия кэшируется и становится недействительным при сохранении товара """
+        get_item = async_controllers.AsyncController.get_item
+        request = ParamsRequest({"item_id": 1, "fields": "id,title"})
+        self.assertEqual("Товар 1", asyncio.run(get_item(request))["item"]["title"])
+        del self.queries[:]
+        self.assertEqual("Товар 1", asyncio.run(get_item(request))["item"]["title"])
+        self.assertEqual([], self.queries)
+
+        item = models.catalog.get_item(1)
+        item.title = "Новый товар"
+        item.save()
+        self.assertEqual("Новый товар", asyncio.run(get_item(request))["item"]["title"])
+
+
+    def test_asgi_requests(self):
+        """ Действия вызываются по пути с параметрами из тела, некорректное тело - ошибка в формате сервиса,
+        websocket-соединения отклоняются
+        """
+        json_headers = [(b"content-type", b"application/json")]
+        http = {"type": "http", "path": "/v1/save/", "query_string": b"", "headers": json_headers}
+        sent = self.asgi_request(http, json.dumps({"title": "Товар 3", "cost": "300", "quantity": "2"}).encode())
+        self.assertEqual(200, sent[0]["status"])
+        item_id = json.loads(sent[1]["body"])["item_id"]
+        self.assertEqual(("Товар 3", 300, 2, None), tuple(
+            self.db.items.find_one({"_id": item_id}).get(field) for field in ("title", "cost", "quantity", "discount")
+        ))
+        sent = self.asgi_request(dict(http, path="/get_items/", query_string=b"quantity=1&fields=id"))
+        self.assertEqual([{"id": item_id}], json.loads(sent[1]["body"])["items"])
+
+        for body in (b"{not json", b"[1, 2]", b"\xff"):
+            sent = self.asgi_request(http, body)
+            self.assertEqual(400, sent[0]["status"])
+            self.assertEqual(asgi.IncorrectParameter.code, json.loads(sent[1]["body"])["error"]["code"])
+        self.assertEqual([{"type": "websocket.close"}], self.asgi_request({"type": "websocket", "path": "/"}))
+
+    def test_asgi_categories_etag(self):
+        """ Список рубрик отдается с заголовком ETag, запрос с совпадающим If-None-Match получает 304 без тела """
+        models.catalog.create_category("Обувь", "shoes")
+        http = {"type": "http", "path": "/get_categories/", "query_string": b"", "headers": []}
+        sent = self.asgi_request(http)
+        self.assertEqual(200, sent[0]["status"])
+        etag = json.loads(sent[1]["body"])["etag"]
+        self.assertIn((b"etag", ('"%s"' % etag).encode()), sent[0]["headers"])
+        for value in ('"%s"' % etag, 'W/"%s", "other"' % etag, "*"):
+            sent = self.asgi_request(dict(http, headers=[(b"if-none-match", value.encode())]))
+            self.assertEqual((304, b""), (sent[0]["status"], sent[1]["body"]), value)
+            self.assertIn((b"etag", ('"%s"' % etag).encode()), sent[0]["headers"])
+        sent = self.asgi_request(dict(http, headers=[(b"if-none-match", b'"other"')]))
+        self.assertEqual(200, sent[0]["status"])
+        self.assertEqual(etag, json.loads(sent[1]["body"])["etag"])
+        sent = self.asgi_request(dict(http, query_string=("if_none_match=%s" % etag).encode()))
+        self.assertEqual((200, True), (sent[0]["status"], json.loads(sent[1]["body"])["not_modified"]))
+
+    def test_asgi_routes_only_actions(self):
+        """ Маршрутами служат только действия контроллера: потоковые методы и прочие аттрибуты класса - 404 """
+        http = {"type": "http", "query_string": b"", "headers": []}
+        for path in ("/stream_open_orders/", "/mro/", "/v1/__class__/", "/unknown/"):
+            sent = self.asgi_request(dict(http, path=path))
+            self.assertEqual(404, sent[0]["status"], path)
+        sent = self.asgi_request(dict(http, path="/get_open_orders/", query_string=b"stream=1"))
+        self.assertEqual(200, sent[0]["status"])
+        self.assertEqual([], json.loads(b"".join(message.get("body", b"") for message in sent[1:]))["orders"])
+
+
+class StreamingTestCase(MongoTestCase):
+    """ Тесты потоковой отдачи списков """
+
+    def setUp(self):
+        super().setUp()
+        self.db.orders.insert_many([
+            {
+                "_id": i, "id": i, "customer_id": 1, "state": models.OrderStates.Created,
+                "created_datetime": datetime(2020, 1, i),
+                "items": [{"id": 1, "title": "Товар", "cost": 100, "quantity": 1}]
+            }
+            for i in range(1, 8)
+        ])
+
+    def test_stream_matches_full_response(self):
+        """ Поток открытых заказов - те же краткие описания, что и постранично, даты - в ISO 8601 """
+        expected = json.loads(dumps({"orders": models.orders.get_open_orders_page(quantity=100)[0]}))
+        chunks = list(stream_json_array("orders", models.orders.iter_open_orders(), 3))
+        self.assertEqual(expected, json.loads("".join(chunks)))
+        self.assertEqual("2020-01-01T00:00:00", expected["orders"][0]["created_datetime"])
+        self.assertGreater(len(chunks), 3)
+
+        async def read_async_stream():
+            return [chunk async for chunk in async_controllers.AsyncController.stream_open_orders(ParamsRequest())]
+        self.assertEqual(expected, json.loads("".join(asyncio.run(read_async_stream()))))
+
+    def test_open_orders_pages(self):
+        """ Невыполненные заказы листаются курсором в порядке создания, с фильтрами по статусу и периоду """
+        self.db.orders.update_one({"_id": 2}, {"$set": {"state": models.OrderStates.Done}})
+        self.db.orders.update_one({"_id": 3}, {"$set": {"state": models.OrderStates.InProgress}})
+        self.db.orders.insert_one({
+            "_id": 8, "id": 8, "state": models.OrderStates.Created, "created_datetime": datetime(2020, 1, 4)
+        })
+        seen, cursor = [], None
+        while True:
+            summaries, cursor = models.orders.get_open_orders_page(quantity=2, cursor=cursor)
+            seen += [summary["id"] for summary in summaries]
+            if not cursor:
+                break
+        self.assertEqual([1, 3, 4, 8, 5, 6, 7], seen)
+        self.assertNotIn("items", summaries[0])
+
+        summaries, _ = models.orders.get_open_orders_page("2", "2020-01-02", "2020-01-05")
+        self.assertEqual([3], [summary["id"] for summary in summaries])
+        with self.assertRaises(models.IncorrectOrdersFilter):
+            models.orders.get_open_orders_page(created_from="yesterday")
+
+    def test_error_inside_stream(self):
+        """ Ошибка посреди потока закрывает массив и добавляется в ответ """
+        def values():
+            yield {"id": 1}
+            raise models.OrderNotFound()
+        response = json.loads("".join(stream_json_array("orders", values())))
+        self.assertEqual([{"id": 1}], response["orders"])
+        self.assertEqual(models.OrderNotFound.code, response["error"]["code"])
+
+
+class InventoryTestCase(MongoTestCase):
+    """ Тесты резервирования остатков """
+
+    def setUp(self):
+        super().setUp()
+        self.db.items.insert_many([
+            {"_id": 1, "id": 1, "title": "Товар 1", "cost": 100, "quantity": 10, "imgs": [], "attributes": []},
+            {"_id": 2, "id": 2, "title": "Товар 2", "cost": 200, "quantity": 3, "imgs": [], "attributes": []},
+        ])
+
+    def stock(self) -> list:
+        return [item.get("quantity") for item in self.db.items.find({}, {"quantity": True}).sort([("_id", 1)])]
+
+    def create_customer(self, lines: list) -> int:
+        """ Создает покупателя с позициями lines [(товар, количество)] в корзине """
+        models.customers.ensure_existance(1)
+        customer = models.customers.get_customer(self.db.customers.find_one({})["_id"])
+        cart = models.carts.get_cart(customer.cart_id)
+        for item_id, quantity in lines:
+            cart.add_item(item_id, quantity)
+        return customer.id
+
+    def test_transactional_order_is_written_in_one_session(self):
+        """ С MONGO_TRANSACTIONS=1 резерв, заказ и очистка корзины выполняются в одной сессии,
+        а остатки всех позиций списываются одним bulk-запросом
+        """
+        customer_id = self.create_customer([(1, 2), (2, 1)])
+        operations, session = [], FakeSession()
+        client = SimpleNamespace(start_session=lambda: session)
+        with patch.multiple(models.orders, client=client, transactions=True, orders=SessionCollection(
+                self.db.orders, operations)), \
+                patch.object(models.carts, "carts", SessionCollection(self.db.carts, operations)), \
+                patch.multiple(models.inventory, items=SessionCollection(self.db.items, operations),
+                               reservations=SessionCollection(self.db.reservations, operations)):
+            order_id = models.orders.create_order(customer_id)
+        writes = [operation for operation in operations if not operation[1].startswith("find")]
+        self.assertEqual([
+            ("reservations", "insert_one", session), ("items", "bulk_write", session),
+            ("orders", "insert_one", session), ("carts", "update_one", session)
+        ], writes)
+        self.assertEqual([8, 2], self.stock())
+        self.assertEqual(ReservationStates.Reserved, self.db.reservations.find_one({"_id": order_id})["state"])
+        self.assertEqual([], self.db.carts.find_one({})["items"])
+
+    def test_order_creation_clears_cart(self):
+        """ Оформленный заказ очищает корзину покупателя, а заказ, которому не хватило товара, оставляет ее """
+        customer_id = self.create_customer([(2, 5)])
+        with self.assertRaises(models.NotEnoughStock):
+            models.orders.create_order(customer_id)
+        self.assertEqual((1, 5), (len(self.db.carts.find_one({})["items"]), self.db.carts.find_one({})["quantity"]))
+
+        models.carts.get_cart(self.db.carts.find_one({})["_id"]).set_quantity_for_item(2, 3)
+        models.orders.create_order(customer_id)
+        cart_data = self.db.carts.find_one({})
+        self.assertEqual(([], 0, 0), (cart_data["items"], cart_data["quantity"], cart_data["total_cost"]))
+        with self.assertRaises(models.CartIsEmpty):
+            asyncio.run(async_models.orders.create_order(customer_id))
+        self.assertEqual([10, 0], self.stock())
+
+    def test_concurrent_checkouts_do_not_oversell(self):
+        """ Одновременные заказы резервируют не больше остатка, неудачные заказы возвращают списанные позиции """
+        lock = threading.Lock()
+        inventory = Inventory(AtomicCollection(self.db.items, lock), AtomicCollection(self.db.reservations, lock))
+        barrier, results = threading.Barrier(8), []
+
+        def checkout(order_id):
+            barrier.wait()
+            try:
+                inventory.reserve(order_id, [{"id": 1, "quantity": 1}, {"id": 2, "quantity": 1}])
+                results.append(order_id)
+            except models.NotEnoughStock:
+                pass
+
+        threads = [threading.Thread(target=checkout, args=(order_id,)) for order_id in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(3, len(results))
+        self.assertEqual([7, 0], self.stock())
+        self.assertEqual(3, self.db.reservations.count_documents({"state": "reserved"}))
+        self.assertEqual(5, self.db.reservations.count_documents({"state": "released"}))
+
+    def test_crashed_reservation_returns_only_taken_lines(self):
+        """ Резерв, прерванный падением процесса после первой позиции, очистка возвращает без лишнего остатка """
+        class CrashingItems(object):
+            def __init__(self, collection):
+                self.collection, self.takes = collection, 0
+
+            def update_one(self, query, update):
+                if "quantity" in query:
+                    self.takes += 1
+                    if self.takes == 2:
+                        raise SystemExit("worker killed")
+                return self.collection.update_one(query, update)
+
+            def __getattr__(self, name):
+                return getattr(self.collection, name)
+
+        inventory = Inventory(CrashingItems(self.db.items), self.db.reservations)
+        with self.assertRaises(SystemExit):
+            inventory.reserve(1, [{"id": 1, "quantity": 2}, {"id": 2, "quantity": 1}])
+        self.assertEqual([8, 3], self.stock())
+        self.assertEqual([1], inventory.release_expired(datetime.now() + RESERVATION_TTL))
+        self.assertEqual([10, 3], self.stock())
+
+    def test_create_order_reserves_stock(self):
+        """ Заказ списывает остатки позиций и очищает корзину, заказ сверх остатка не создается и не списывает товар """
+        customer_id = self.create_customer([(1, 2), (2, 3)])
+        order_id = models.orders.create_order(customer_id)
+        self.assertEqual([8, 0], self.stock())
+        self.assertEqual(models.OrderStates.Created, models.orders.get_order(order_id).state)
+        with self.assertRaises(models.CartIsEmpty):
+            models.orders.create_order(customer_id)
+        self.create_customer([(1, 1), (2, 1)])
+        with self.assertRaises(models.NotEnoughStock):
+            models.orders.create_order(customer_id)
+        self.assertEqual([8, 0], self.stock())
+        self.assertEqual(2, len(self.db.carts.find_one({"_id": self.db.customers.find_one({})["cart_id"]})["items"]))
+        self.assertEqual(1, self.db.orders.count_documents({}))
+        self.assertEqual(models.OrderStates.InProgress, models.orders.confirm_order(order_id).state)
+        self.assertEqual([], models.orders.expire_orders(datetime.now() + RESERVATION_TTL))
+        self.assertEqual([8, 0], self.stock())
+
+    def test_create_order_writes_order_once(self):
+        """ Заказ записывается одной вставкой, а чтения не зависят от количества позиций """
+        models.id_allocator.next_id(models.orders.orders)
+        counts = []
+        for lines in ([(1, 1)], [(1, 1), (2, 1)]):
+            customer_id = self.create_customer(lines)
+            models.catalog.attribute_schemes.clear()
+            del self.queries[:]
+            models.orders.create_order(customer_id)
+            counts.append((
+                self.queries.count(("orders", "insert_one")), self.queries.count(("carts", "update_one")),
+                len([query for query in self.queries if query[1].startswith("find")])
+            ))
+        self.assertEqual((1, 1), counts[0][:2])
+        self.assertEqual(counts[0], counts[1])
+
+    def test_untracked_items_are_not_reserved(self):
+        """ Товар без остатка (quantity null или нет поля) заказывается без резерва, истечение заказа его не меняет """
+        self.db.items.insert_many([
+            {"_id": 3, "id": 3, "title": "Товар 3", "cost": 300, "quantity": None, "imgs": [], "attributes": []},
+            {"_id": 4, "id": 4, "title": "Товар 4", "cost": 400, "imgs": [], "attributes": []},
+        ])
+        order_id = models.orders.create_order(self.create_customer([(1, 2), (3, 5), (4, 1)]))
+        self.assertEqual([{"id": 1, "quantity": 2}], self.db.reservations.find_one({"_id": order_id})["lines"])
+        self.assertEqual([8, 3, None, None], self.stock())
+        self.assertNotIn("quantity", self.db.items.find_one({"_id": 4}))
+        order_id = asyncio.run(async_models.orders.create_order(self.create_customer([(3, 1), (4, 2)])))
+        self.assertEqual([], self.db.reservations.find_one({"_id": order_id})["lines"])
+
+        self.assertEqual(2, len(models.orders.expire_orders(datetime.now() + RESERVATION_TTL)))
+        self.assertEqual([10, 3, None, None], self.stock())
+        self.assertNotIn("quantity", self.db.items.find_one({"_id": 4}))
+
+    def test_expired_reservation_returns_stock(self):
+        """ Истекший резерв возвращает товар, заказ получает статус "Истек" и больше не подтверждается """
+        order_id = models.orders.create_order(self.create_customer([(1, 4)]))
+        self.assertEqual([], models.orders.expire_orders())
+        expired = datetime.now() + RESERVATION_TTL
+        self.assertEqual([order_id], models.orders.expire_orders(expired))
+        self.assertEqual([], models.orders.expire_orders(datetime.now() + RESERVATION_TTL))
+        # mongodb хранит время с точностью до миллисекунд
+        self.assertAlmostEqual(
+            expired, self.db.orders.find_one({"_id": order_id})["expired_datetime"], delta=timedelta(milliseconds=1)
+        )
+        self.assertEqual([10, 3], self.stock())
+        self.assertEqual(models.OrderStates.Expired, models.orders.get_order(order_id).state)
+        with self.assertRaises(models.ReservationExpired):
+            models.orders.confirm_order(order_id)
+
+
+class OrderSnapshotTestCase(MongoTestCase):
+    """ Тесты снимков товаров в заказах """
+
+    def setUp(self):
+        super().setUp()
+        self.db.attributes.insert_one({"_id": 1, "id": 1, "name": "Цвет", "options": ["red", "green"]})
+        self.db.items.insert_one({
+            "_id": 1, "id": 1, "article": "A-1", "title": "Товар 1", "cost": 100, "discount": 10, "quantity": 5,
+            "imgs": [], "attributes": [{"id": 1, "value": "red"}]
+        })
+
+    def test_orders_are_read_without_catalog(self):
+        """ Заказы покупателя читаются одним запросом и не меняются вместе с каталогом """
+        models.customers.ensure_existance(1)
+        customer = models.customers.get_customer(self.db.customers.find_one({})["_id"])
+        models.carts.get_cart(customer.cart_id).add_item(1, 2)
+        order_id = models.orders.create_order(customer.id)
+        self.db.items.delete_one({"_id": 1})
+        del self.queries[:]
+        orders = models.orders.get_orders_by_customer_id(customer.id, limit="10")
+        self.assertEqual([("orders", "find")], self.queries)
+        self.assertEqual([order_id], [order.id for order in orders])
+        self.assertEqual((2, 180), (orders[0].quantity, orders[0].cost))
+        self.assertEqual({
+            "id": 1, "article": "A-1", "title": "Товар 1", "price": 90, "quantity": 2, "cost": 180,
+            "attributes": [{"id": 1, "name": "Цвет", "value": "red"}]
+        }, orders[0].items[0].get_data())
+
+
+class BestsellersTestCase(unittest.TestCase):
+    """ Тесты пересчета рейтинга продаж """
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.db.items.insert_many([
+            {"_id": i, "id": i, "title": "Товар %s" % i, "categories": ["shoes"], "cost": 100, "body": "Описание"}
+            for i in (1, 2, 3)
+        ])
+        self.aggregator = BestsellersAggregator(MergeDatabase(self.db))
+
+    def order(self, created: datetime, *lines) -> int:
+        return self.db.orders.insert_one({"created_datetime": created, "items": [
+            {"id": item_id, "quantity": quantity} for item_id, quantity in lines
+        ]}).inserted_id
+
+    def rating(self, window: str) -> list:
+        return [
+            (bestseller["item_id"], bestseller["quantity"])
+            for bestseller in self.db.bestsellers.find({"window": window}).sort([("quantity", -1), ("item_id", -1)])
+        ]
+
+    def test_pipelines(self):
+        """ Пересчет начинается с начала дня предыдущего запуска, окно включает текущий день """
+        since = rerun_since(datetime(2020, 3, 10, 15, 30))
+        self.assertEqual(datetime(2020, 3, 10), since)
+        self.assertEqual({"day": {"$gte": "2020-03-10"}}, daily_cleanup_query(since))
+        self.assertEqual({}, daily_cleanup_query(rerun_since(None)))
+        self.assertEqual(
+            {"$match": {"state": {"$ne": models.OrderStates.Expired}, "created_datetime": {"$gte": since}}},
+            daily_sales_pipeline(since)[0]
+        )
+        self.assertEqual(datetime(2020, 3, 8), rerun_since(datetime(2020, 3, 10, 15, 30), datetime(2020, 3, 8, 23)))
+        self.assertEqual({"$merge": {"into": "bestsellers_daily"}}, daily_sales_pipeline()[-1])
+        pipeline = window_pipeline("week", 7, datetime(2020, 3, 10, 15, 30))
+        self.assertEqual({"$match": {"day": {"$gte": "2020-03-04"}}}, pipeline[0])
+        self.assertEqual({"$match": {}}, window_pipeline("all", None, since)[0])
+        self.assertEqual("bestsellers", pipeline[-1]["$merge"]["into"])
+        self.assertEqual({"window": "week", "generated": {"$ne": since}}, stale_generation_query("week", since))
+
+    def test_rating_is_recomputed_incrementally(self):
+        """ Дневные продажи пересчитываются начиная с дня прошлого запуска, окна собираются из дневных продаж,
+        выпавшие из окна товары удаляются из рейтинга
+        """
+        now = datetime(2020, 3, 10, 12)
+        self.order(datetime(2020, 1, 1), (1, 5))
+        self.order(datetime(2020, 3, 5), (2, 2), (3, 1))
+        self.order(datetime(2020, 3, 10, 9), (2, 1))
+        self.assertEqual({"week": 2, "month": 2, "all": 3}, self.aggregator.run(now))
+        self.assertEqual([(2, 3), (3, 1)], self.rating("week"))
+        self.assertEqual([(1, 5), (2, 3), (3, 1)], self.rating("all"))
+        bestseller = self.db.bestsellers.find_one({"_id": "week:2"})
+        self.assertEqual((["shoes"], "Товар 2", 100), (
+            bestseller["categories"], bestseller["item"]["title"], bestseller["item"]["cost"]
+        ))
+        self.assertNotIn("body", bestseller["item"])
+
+        # Прошлые дни не пересчитываются (удаленный заказ остается в продажах), текущий - пересчитывается без дублей
+        self.db.orders.delete_many({"created_datetime": datetime(2020, 1, 1)})
+        self.order(datetime(2020, 3, 10, 18), (3, 4))
+        self.aggregator.run(datetime(2020, 3, 10, 20))
+        self.assertEqual([(3, 5), (2, 3)], self.rating("week"))
+        self.assertEqual([(3, 5), (1, 5), (2, 3)], self.rating("all"))
+        self.assertEqual(5, self.db.bestsellers_daily.count_documents({}))
+
+        # Через неделю продажи 5 марта выпадают из недельного окна, прежнее поколение рейтинга удаляется
+        self.assertEqual({"week": 2, "month": 2, "all": 3}, self.aggregator.run(datetime(2020, 3, 16)))
+        self.assertEqual([(3, 4), (2, 1)], self.rating("week"))
+        self.assertEqual(0, self.db.bestsellers.count_documents({"generated": {"$ne": datetime(2020, 3, 16)}}))
+
+    def test_expired_orders_are_not_sales(self):
+        """ Истекшие заказы не считаются продажами: заказ прошлого дня, истекший после предыдущего запуска,
+        вычитается из рейтинга при следующем
+        """
+        self.order(datetime(2020, 3, 8, 23, 50), (1, 2))
+        expired_id = self.order(datetime(2020, 3, 9, 23, 50), (2, 5))
+        self.db.orders.insert_one({
+            "created_datetime": datetime(2020, 3, 9, 10), "state": models.OrderStates.Expired,
+            "expired_datetime": datetime(2020, 3, 9, 10, 30), "items": [{"id": 3, "quantity": 7}]
+        })
+        self.aggregator.run(datetime(2020, 3, 10, 0, 5))
+        self.assertEqual([(2, 5), (1, 2)], self.rating("week"))
+
+        self.db.orders.update_one({"_id": expired_id}, {"$set": {
+            "state": models.OrderStates.Expired, "expired_datetime": datetime(2020, 3, 10, 0, 20)
+        }})
+        self.aggregator.run(datetime(2020, 3, 10, 1))
+        self.assertEqual([(1, 2)], self.rating("week"))
+        self.assertEqual([(1, "2020-03-08")], [
+            (daily["item_id"], daily["day"]) for daily in self.db.bestsellers_daily.find()
+        ])
+
+
+class ImporterTestCase(MongoTestCase):
+    """ Тесты импорта фида """
+
+    def setUp(self):
+        super().setUp()
+        self.db.attributes.insert_many([
+            {"_id": 1, "id": 1, "name": "Цвет", "options": ["red", "green"]},
+            {"_id": 2, "id": 2, "name": "Размер", "regex": r"^\d+$", "categories": "shoes"},
+        ])
+
+    def test_rows_are_validated_with_line_numbers(self):
+        """ Строки CSV проверяются по схемам аттрибутов, ошибочные строки попадают в отчет с номером строки """
+        feed = io.StringIO(
+            "article,title,cost,categories,tags,attr:1,attr:2\n"
+            "A-1,Кеды,100,shoes,new|sale,red,42\n"
+            ",Без артикула,100,shoes,,red,42\n"
+            "A-3,Сапоги,100,shoes,,blue,42\n"
+            "A-4,,100,shoes,,red,\n"
+        )
+        rows = list(read_rows(feed, "csv"))
+        self.assertEqual(
+            {"article": "A-1", "title": "Кеды", "cost": "100", "categories": "shoes", "tags": ["new", "sale"],
+             "attributes": [{"id": 1, "value": "red"}, {"id": 2, "value": "42"}]},
+            rows[0][1]
+        )
+        errors = io.StringIO()
+        summary = ItemsImporter(processes=1, dry_run=True).run(iter(rows), errors)
+        self.assertEqual({"rows": 4, "created": 0, "updated": 0, "errors": 3}, summary)
+        report = [json.loads(line) for line in errors.getvalue().splitlines()]
+        self.assertEqual(
+            [(3, models.NoArticleForItem.code), (4, models.IncorrectValueForAttribute.code),
+             (5, models.NoTitleForItem.code)],
+            [(error["line"], error["error"]["code"]) for error in report]
+        )
+
+    def test_batch_is_upserted_by_article(self):
+        """ Пачка сохраняется по артикулу: существующие товары обновляются, новые создаются, при повторе артикула
+        побеждает последняя строка, а ошибки записи и разбора попадают в отчет со своими номерами строк
+        """
+        self.db.items.insert_one({"_id": 100, "id": 100, "article": "A-1", "title": "Кеды", "cost": 100})
+        # Уникальный индекс по названию, чтобы получить ошибку записи одного товара из пачки
+        self.db.items.create_index("title", unique=True)
+        batch = [
+            (2, {"article": "A-1", "title": "Кеды 2", "cost": 150, "categories": "shoes"}, None),
+            (3, {"article": "A-2", "title": "Сапоги", "cost": 200, "categories": "shoes"}, None),
+            (4, None, "Некорректный JSON"),
+            (5, {"article": "A-2", "title": "Сапоги 2", "cost": 250, "categories": "shoes"}, None),
+            (6, {"article": "A-3", "title": "Кеды 2", "cost": 300, "categories": "shoes"}, None),
+        ]
+        with patch.object(models.catalog, "items", UpsertsCollection(models.catalog.items)):
+            result = import_batch(batch)
+        created = self.db.items.find_one({"article": "A-2"})
+        self.assertEqual([created["_id"]], result["created"])
+        self.assertEqual([100], result["updated"])
+        self.assertEqual([(4, None, None), (6, "A-3", None)], [
+            (error["line"], error["article"], error["error"]["code"]) for error in result["errors"]
+        ])
+        self.assertEqual(
+            [("A-1", "Кеды 2", 150), ("A-2", "Сапоги 2", 250)],
+            [(item["article"], item["title"], item["cost"]) for item in self.db.items.find().sort("article", 1)]
+        )
+        self.assertEqual(created["_id"], created["id"])
+
+
+class FacetsTestCase(MongoTestCase):
+    """ Тесты фильтров по аттрибутам и счетчиков фасетов """
+
+    def setUp(self):
+        super().setUp()
+        self.db.attributes.insert_many([
+            {"_id": 1, "id": 1, "name": "Цвет", "options": ["red", "green"]},
+            {"_id": 2, "id": 2, "name": "Размер", "regex": r"^\d+$", "categories": "shoes"},
+        ])
+
+    def save_item(self, title: str, category: str, attributes: list, item_id: int=None) -> int:
+        item = models.Item()
+        item.id, item.title, item.categories = item_id, title, category
+        item.set_attributes(attributes)
+        return item.save()
+
+    def facet_counts(self, category: str=None) -> dict:
+        return {
+            (facet["id"], value["value"]): value["count"]
+            for facet in models.catalog.get_facets(category) for value in facet["values"]
+        }
+
+    def test_facet_counts_follow_item_changes(self):
+        """ Счетчики изменяются при сохранении и удалении товаров и совпадают с подсчетом по товарам """
+        kedy = self.save_item("Кеды", "shoes", [{"id": 1, "value": "red"}, {"id": 2, "value": "42"}])
+        self.save_item("Сапоги", "shoes", [{"id": 1, "value": "red"}, {"id": 2, "value": "44"}])
+        hat = self.save_item("Шляпа", "hats", [{"id": 1, "value": "green"}])
+        self.save_item("Кеды", "shoes", [{"id": 1, "value": "green"}, {"id": 2, "value": "42"}], item_id=kedy)
+        models.catalog.delete_item(hat)
+
+        self.assertEqual({(1, "red"): 1, (1, "green"): 1, (2, "42"): 1, (2, "44"): 1}, self.facet_counts("shoes"))
+        self.assertEqual({}, self.facet_counts("hats"))
+        expected = {}
+        for item_data in self.db.items.find():
+            for category, attribute_id, value in facet_keys(item_data):
+                if category is None:
+                    expected[(attribute_id, value)] = expected.get((attribute_id, value), 0) + 1
+        self.assertEqual(expected, self.facet_counts())
+        size = [facet for facet in models.catalog.get_facets("shoes") if facet["id"] == 2][0]
+        self.assertEqual((42, 44), (size["min"], size["max"]))
+
+    def test_items_are_filtered_by_attributes(self):
+        """ Фильтр attr[<id>] выбирает товары по значению и по диапазону числового аттрибута """
+        self.save_item("Кеды", "shoes", [{"id": 1, "value": "red"}, {"id": 2, "value": "42"}])
+        self.save_item("Сапоги", "shoes", [{"id": 1, "value": "red"}, {"id": 2, "value": "44"}])
+        self.save_item("Туфли", "shoes", [{"id": 1, "value": "green"}, {"id": 2, "value": "38"}])
+
+        def get_items(query: str):
+            return asyncio.run(async_controllers.AsyncController.get_items(ParamsRequest(parse_params(query))))
+
+        def titles(query: str) -> list:
+            return sorted(item["title"] for item in get_items(query)["items"])
+
+        self.assertEqual(["Кеды", "Сапоги"], titles("category=shoes&attr[1]=red"))
+        self.assertEqual(["Кеды", "Туфли"], titles("category=shoes&attr[2][to]=42"))
+        self.assertEqual(["Кеды"], titles("attr[1]=red&attr[1]=green&attr[2][from]=40&attr[2][to]=43"))
+        self.assertEqual(
+            models.IncorrectAttributeFilter.code, json.loads(get_items("attr[2][from]=big"))["error"]["code"]
+        )
+
+
+class ExporterTestCase(MongoTestCase):
+    """ Тесты выгрузки каталога """
+
+    def setUp(self):
+        super().setUp()
+        self.db.items.insert_many([
+            {"_id": i, "id": i, "title": "Товар %s" % i, "cost": 100, "categories": "shoes" if i % 2 else "hats",
+             "attributes": [{"id": 1, "name": "Цвет", "value": "red"}]}
+            for i in range(1, 8)
+        ])
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "items.jsonl")
+
+    def tearDown(self):
+        self.directory.cleanup()
+        super().tearDown()
+
+    def exporter(self, writer=None) -> Exporter:
+        return Exporter(self.db.items, writer or JsonlExportWriter(self.path), self.path + ".checkpoint", batch_size=2)
+
+    def test_incorrect_batch_size_is_streamed_as_error(self):
+        """ Некорректный размер пачки в запросе выгрузки отдается последней строкой потока, а не ответом 500 """
+        http = {"type": "http", "path": "/export_items/", "headers": []}
+        sent = self.asgi_request(dict(http, query_string=b"category=hats&batch_size=2"))
+        self.assertEqual(200, sent[0]["status"])
+        lines = [json.loads(line) for line in b"".join(message.get("body", b"") for message in sent[1:]).splitlines()]
+        self.assertEqual([2, 4, 6], [line["id"] for line in lines])
+        for batch_size in (b"abc", b"0"):
+            sent = self.asgi_request(dict(http, query_string=b"batch_size=" + batch_size))
+            self.assertEqual(200, sent[0]["status"])
+            lines = b"".join(message.get("body", b"") for message in sent[1:]).splitlines()
+            self.assertEqual([IncorrectParameter.code], [json.loads(line)["error"]["code"] for line in lines])
+
+    def test_interrupted_export_is_resumed_from_checkpoint(self):
+        """ Прерванная выгрузка продолжается с последнего чекпоинта без повторов и пропусков """
+        def interrupt(message):
+            raise KeyboardInterrupt()
+        with self.assertRaises(KeyboardInterrupt):
+            self.exporter().run(category="shoes", report=interrupt)
+        self.assertEqual(4, self.exporter().run(category="shoes", report=lambda message: None))
+        with open(self.path) as file:
+            self.assertEqual([1, 3, 5, 7], [json.loads(line)["id"] for line in file])
+        with self.assertRaises(KeyboardInterrupt):
+            self.exporter().run(report=interrupt)
+        with self.assertRaises(ValueError):
+            self.exporter().run(category="shoes", report=lambda message: None)
+
+    @unittest.skipUnless(pyarrow, "pyarrow не установлен")
+    def test_parquet_export(self):
+        """ Выгрузка в Parquet разбивается на файлы, рубрика-строка становится списком """
+        path = os.path.join(self.directory.name, "items.parquet")
+        writer = ParquetExportWriter(path, rows_per_part=4)
+        Exporter(self.db.items, writer, path + ".checkpoint", batch_size=2).run(report=lambda message: None)
+        self.assertEqual(["part-00000.parquet", "part-00001.parquet"], sorted(os.listdir(path)))
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(list(range(1, 8)), table.column("id").to_pylist())
+        self.assertEqual(["shoes"], table.column("categories").to_pylist()[0])
+
+
+class SearchTestCase(unittest.TestCase):
+    """ Тесты поискового индекса """
+
+    def setUp(self):
+        self.es = FakeElasticsearch()
+        self.db = mongomock.MongoClient().db
+        self.db.items.insert_many([{"_id": i, "title": "item %s" % i} for i in range(1, 5)])
+        self.es.indices.create(index="items_old")
+        self.es.indices.update_aliases(body={"actions": [{"add": {"index": "items_old", "alias": ITEMS_ALIAS}}]})
+        self.queue = SearchQueue(self.db.search_queue)
+        self.worker = SearchSyncWorker(self.es, self.db.items, self.db.search_queue, self.db.reindex_checkpoints)
+
+    def test_changes_during_rebuild_reach_new_index(self):
+        """ Изменения, обработанные воркером во время перестройки, не теряются при переключении алиаса """
+        def change_items(message: str):
+            if message.startswith("2 docs"):
+                self.db.items.update_one({"_id": 1}, {"$set": {"title": "renamed"}})
+                self.db.items.delete_many({"_id": {"$in": [2, 3]}})
+                for item_id, op in ((1, "index"), (2, "delete"), (3, "delete")):
+                    self.queue.push(item_id, op)
+                self.assertEqual(3, self.worker.drain_once())
+        reindexer = Reindexer(self.es, self.db.items, self.db.reindex_checkpoints, batch_size=2, threads=1)
+        index = reindexer.run(report=change_items)
+        self.assertEqual([index], self.es.aliases[ITEMS_ALIAS])
+        self.assertNotIn("items_old", self.es.indexes)
+        self.assertEqual({1: {"title": "renamed"}, 4: {"title": "item 4"}}, self.es.docs(ITEMS_ALIAS))
+        self.assertEqual([ITEMS_ALIAS], self.worker.get_indexes())
+
+    def test_item_deleted_while_copied_is_removed_from_new_index(self):
+        """ Товар, удаленный из бд после чтения пачки, но до ее копирования, не остается в новом индексе """
+        db, es = self.db, self.es
+
+        class DeletingItems(object):
+            def find(self, query, projection):
+                if "$gt" not in query.get("_id", {}):
+                    return db.items.find(query, projection)
+                batch = list(db.items.find(query, projection).sort("_id").limit(2))
+                db.items.delete_one({"_id": 3})
+                return SimpleNamespace(sort=lambda *args: SimpleNamespace(limit=lambda *args: batch))
+
+        Reindexer(es, DeletingItems(), db.reindex_checkpoints, batch_size=2, threads=1).run(report=lambda _: None)
+        self.assertEqual([1, 2, 4], sorted(es.docs(ITEMS_ALIAS)))
+
+    def test_index_and_alias_are_created_before_sync(self):
+        """ На пустом кластере создается версионный индекс с полем подсказок под алиасом, а не индекс items """
+        es = self.worker.es = FakeElasticsearch()
+        self.assertTrue(ensure_items_index(es))
+        self.assertTrue(ensure_items_index(es))
+        index, = es.aliases[ITEMS_ALIAS]
+        self.assertEqual([index], list(es.indexes))
+        self.queue.push(1, "index")
+        self.worker.drain_once()
+        self.assertEqual({1: {"title": "item 1"}}, es.indexes[index]["docs"])
+
+    def test_index_without_autocomplete_field_is_reported(self):
+        """ Индекс старого формата без title.autocomplete не подменяется, но требует перестройки """
+        es = FakeElasticsearch()
+        es.indices.create(index=ITEMS_ALIAS, body={"mappings": {"properties": {"title": {"type": "text"}}}})
+        self.assertFalse(ensure_items_index(es))
+        self.assertEqual([ITEMS_ALIAS], list(es.indexes))
+        self.assertNotIn(ITEMS_ALIAS, es.aliases)
+
+    def test_interrupted_rebuild_is_resumed(self):
+        """ Прерванная перестройка продолжается с сохраненного _id в тот же индекс """
+        self.es.indices.create(index="items_partial")
+        self.es.indexes["items_partial"]["docs"] = {1: {"title": "item 1"}, 2: {"title": "item 2"}}
+        self.db.reindex_checkpoints.insert_one(
+            {"_id": ITEMS_ALIAS, "index": "items_partial", "last_id": 2, "indexed": 2, "done": False}
+        )
+        reports = []
+        index = Reindexer(self.es, self.db.items, self.db.reindex_checkpoints, threads=1).run(report=reports.append)
+        self.assertEqual("items_partial", index)
+        self.assertEqual("resuming items_partial from _id > 2", reports[0])
+        self.assertEqual([1, 2, 3, 4], sorted(self.es.docs(ITEMS_ALIAS)))
+        self.assertEqual(["items_partial"], self.es.aliases[ITEMS_ALIAS])
+        self.assertNotIn("items_old", self.es.indexes)
+        checkpoint = self.db.reindex_checkpoints.find_one({"_id": ITEMS_ALIAS})
+        self.assertEqual((4, True), (checkpoint["indexed"], checkpoint["done"]))
+
+    def test_failed_events_are_retried_with_backoff(self):
+        """ Неудачные события откладываются с растущей задержкой, удаление отсутствующего товара - успех """
+        self.es.failing_ids.add(1)
+        self.queue.push(1, "index")
+        self.queue.push(9, "delete")
+        self.assertEqual(2, self.worker.drain_once())
+        event, = self.db.search_queue.find()
+        self.assertEqual((1, 1), (event["item_id"], event["attempts"]))
+        self.assertGreater(event["next_attempt_datetime"], datetime.now())
+        self.assertEqual(0, self.worker.drain_once())
+        self.assertEqual((2, 4, 300), tuple(self.worker.get_delay(attempts) for attempts in (1, 2, 20)))
+
+        self.es.failing_ids.clear()
+        self.db.search_queue.update_one({}, {"$set": {"next_attempt_datetime": datetime.now()}})
+        self.assertEqual(1, self.worker.drain_once())
+        self.assertEqual(0, self.db.search_queue.count_documents({}))
+        self.assertEqual({1: {"title": "item 1"}}, self.es.docs(ITEMS_ALIAS))
+
+    def test_autocomplete_size(self):
+        """ Количество подсказок ограничивается от 1 до максимума, нечисловое значение - ошибка параметра """
+        self.assertEqual(
+            [1, 1, 5, AUTOCOMPLETE_MAX_SIZE],
+            [autocomplete_query("red", size)["size"] for size in (0, -5, "5", 1000)]
+        )
+        query = autocomplete_query("red sh")["query"]["bool"]
+        self.assertEqual({"query": "red sh", "operator": "and"}, query["must"]["match"]["title.autocomplete"])
+        for size in ("ten", None, ""):
+            with self.assertRaises(IncorrectParameter):
+                autocomplete_query("red", size)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """ Тесты кэша ответов """
+
+    def test_invalidation_is_shared_between_workers(self):
+        """ Инвалидация на одном воркере делает недействительными ответы, закэшированные другим воркером """
+        collection = BulkUpdatesCollection(mongomock.MongoClient().db.response_cache)
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertIsInstance(create_cache_backend(collection), SharedTagsCacheBackend)
+        first, second = ResponseCache(create_cache_backend(collection)), ResponseCache(create_cache_backend(collection))
+
+        def key() -> str:
+            return first.request_key("get_item", ParamsRequest({"item_id": 1}), ["item_id"], ["item:{item_id}"])
+        first.set(key(), {"item": "old"}, 300)
+        self.assertEqual({"item": "old"}, first.get(key()))
+        second.invalidate(["item:1"])
+        self.assertIsNone(first.get(key()))
+
+
+class AllocatorsTestCase(unittest.TestCase):
+    """ Тесты генераторов идентификаторов """
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.queries = []
+        self.counters = CountingCollection(self.db.counters, self.queries)
+
+    def test_base_allocator_is_abstract(self):
+        """ Генератор без next_id создать нельзя """
+        with self.assertRaises(TypeError):
+            IdAllocator()
+
+    def test_blocks_are_leased_and_refilled(self):
+        """ Счетчик увеличивается сразу на блок, новый блок арендуется, когда прежний закончился,
+        а счетчик заполненной коллекции начинается с ее максимального _id
+        """
+        self.db.items.insert_one({"_id": 10})
+        allocator = BlockIdAllocator(self.counters, block_size=3)
+        self.assertEqual([11, 12, 13, 14, 15, 16, 17], [allocator.next_id(self.db.items) for _ in range(7)])
+        leases = [query for query in self.queries if query[1] == "find_one_and_update"]
+        self.assertEqual(3, len(leases))
+        self.assertEqual(19, self.db.counters.find_one({"_id": "items"})["seq"])
+        self.assertEqual([1, 2], [allocator.next_id(self.db.orders) for _ in range(2)])
+
+    def test_workers_lease_separate_blocks(self):
+        """ Воркеры получают разные блоки: идентификаторы уникальны, но чередуются между воркерами """
+        first, second = BlockIdAllocator(self.counters, block_size=3), BlockIdAllocator(self.counters, block_size=3)
+        ids = [allocator.next_id(self.db.items) for allocator in (first, second, first, second, first, second, first)]
+        self.assertEqual([1, 4, 2, 5, 3, 6, 7], ids)
+
+    def test_concurrent_leases_do_not_collide(self):
+        """ Одновременные аренды из многих потоков и воркеров не выдают один идентификатор дважды """
+        counters = AtomicCollection(self.db.counters, threading.Lock())
+        allocators = [BlockIdAllocator(counters, block_size=5) for _ in range(3)]
+        barrier, ids, lock = threading.Barrier(6), [], threading.Lock()
+
+        def allocate(allocator):
+            barrier.wait()
+            allocated = [allocator.next_id(self.db.items) for _ in range(40)]
+            with lock:
+                ids.extend(allocated)
+        threads = [threading.Thread(target=allocate, args=(allocators[i % 3],)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(240, len(set(ids)))
+        self.assertEqual(list(range(1, 241)), sorted(ids))
+
+    def test_async_allocator_shares_counters(self):
+        """ Асинхронный генератор арендует блоки у тех же счетчиков, что и синхронный """
+        allocator = AsyncBlockIdAllocator(AsyncCollection(self.db.counters), block_size=2)
+        items = AsyncCollection(self.db.items)
+
+        async def allocate():
+            return [await allocator.next_id(items) for _ in range(3)]
+        self.assertEqual([1, 2, 3], asyncio.run(allocate()))
+        self.assertEqual([5], [BlockIdAllocator(self.db.counters, block_size=2).next_id(self.db.items)])
+
+
+class ClientsTestCase(unittest.TestCase):
+    """ Тесты фабрики клиентов """
+
+    def test_client_is_created_lazily_per_process(self):
+        """ Клиент создается при первом обращении и пересоздается в новом процессе """
+        created = []
+        client = LazyClient(lambda: created.append(SimpleNamespace(close=lambda: None)) or created[-1])
+        self.assertEqual([], created)
+        self.assertIs(client.get(), client.get())
+        client._pid = -1
+        client.get()
+        self.assertEqual(2, len(created))
+
+    def test_lazy_mongo_client_forwards_client_attributes(self):
+        """ Ленивый клиент mongodb отдает базу сервиса без подключения, а методы клиента берет у клиента процесса """
+        created = []
+        client = LazyMongoClient(lambda: created.append(mongomock.MongoClient()) or created[-1])
+        items = client.db.items
+        self.assertEqual(("db", "other", []), (client.db.name, client["other"].name, created))
+        items.insert_one({"_id": 1})
+        self.assertEqual(["db"], client.list_database_names())
+        self.assertIs(created[0], client.start_session.__self__)
+        client.drop_database("db")
+        self.assertEqual(0, items.count_documents({}))
+
+    def test_mongo_options_from_environment(self):
+        """ Настройки пула, чтения и записи берутся из окружения """
+        with patch.dict(os.environ, {"MONGO_MAX_POOL_SIZE": "20", "MONGO_W": "majority", "MONGO_WTIMEOUT_MS": "500"}):
+            options = mongo_client_options()
+        self.assertEqual((20, "majority", 500), (options["maxPoolSize"], options["w"], options["wTimeoutMS"]))
+
+    def test_catalog_reads_are_routed_to_secondaries(self):
+        """ Чтения каталога идут на реплики с ограничением отставания, внутри primary_reads - на primary """
+        collection = mongomock.MongoClient().db.items
+        reader = models.catalog.reader(collection)
+        self.assertEqual(
+            ("secondaryPreferred", 90), (reader.read_preference.mongos_mode, reader.read_preference.max_staleness)
+        )
+        with primary_reads():
+            self.assertIs(collection, models.catalog.reader(collection))
+
+    def test_pool_metrics(self):
+        """ Метрики пула считают занятые соединения и ожидание соединения """
+        metrics = PoolMetrics()
+        for _ in range(2):
+            metrics.connection_check_out_started(None)
+            metrics.connection_checked_out(None)
+        metrics.connection_checked_in(None)
+        stats = metrics.stats()
+        self.assertEqual((1, 2, 2), (stats["checked_out"], stats["max_checked_out"], stats["checkouts"]))
+        self.assertGreaterEqual(stats["wait_time_max_ms"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()